@@ -0,0 +1,819 @@
+# binance_simulator.py
+"""Máy chủ giả lập Binance USDⓈ-M Futures để chạy thử / đo tải bot mà không đụng tới production
+
+Chạy:   uvicorn binance_simulator:app --port 9000
+Bot:    BINANCE_FAPI_URL=http://127.0.0.1:9000 BINANCE_WS_URL=ws://127.0.0.1:9000
+
+- Giá mỗi symbol là random walk theo từng giây (có sẵn lịch sử SIM_HISTORY_SECONDS để dựng kline).
+- Matching engine: lệnh MARKET khớp ngay (có trượt giá), lệnh LIMIT nằm chờ tới khi giá chạm,
+  vị thế one-way có entry trung bình, PnL đã chốt, phí taker, kiểm tra ký quỹ.
+- Tiêm độ trễ và lỗi (429 / 5xx / 451) cấu hình qua env hoặc POST /sim/config lúc đang chạy;
+  1 phần lỗi 5xx xảy ra SAU khi lệnh đã khớp để thử đường đặt lệnh idempotent.
+- clientOrderId như Binance: chỉ bị từ chối trùng (-4116) khi lệnh cùng id còn mở (NEW); lệnh đã
+  FILLED/CANCELED vẫn tra được theo origClientOrderId trong SIM_ORDER_RETENTION_SECONDS rồi bị xóa.
+- Chữ ký HMAC không được kiểm tra: mỗi API key bất kỳ là 1 tài khoản mới với SIM_START_BALANCE USDC.
+"""
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Dict
+
+import numpy as np
+
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse
+
+# ==================== CẤU HÌNH ====================
+DEFAULT_SYMBOLS = {
+    "BTCUSDC": 60000.0, "ETHUSDC": 3000.0, "BNBUSDC": 550.0, "SOLUSDC": 150.0,
+    "XRPUSDC": 0.6, "DOGEUSDC": 0.15, "ADAUSDC": 0.45, "LINKUSDC": 14.0,
+}
+SIM_SYMBOL_COUNT = int(os.getenv("SIM_SYMBOL_COUNT", str(len(DEFAULT_SYMBOLS))))
+SIM_HISTORY_SECONDS = int(os.getenv("SIM_HISTORY_SECONDS", str(3 * 3600)))
+SIM_VOLATILITY = float(os.getenv("SIM_VOLATILITY", "0.0004"))  # độ lệch chuẩn log-return mỗi giây
+SIM_START_BALANCE = float(os.getenv("SIM_START_BALANCE", "10000"))
+SIM_TAKER_FEE = float(os.getenv("SIM_TAKER_FEE", "0.0005"))
+SIM_SLIPPAGE_BPS = float(os.getenv("SIM_SLIPPAGE_BPS", "1"))
+SIM_TICK_SECONDS = float(os.getenv("SIM_TICK_SECONDS", "1"))
+SIM_SEED = int(os.getenv("SIM_SEED", "42"))
+# Lệnh đã đóng (FILLED/CANCELED) còn tra cứu được bao lâu (Binance: ~3 ngày với lệnh hủy không khớp)
+SIM_ORDER_RETENTION_SECONDS = float(os.getenv("SIM_ORDER_RETENTION_SECONDS", str(3 * 86400)))
+
+# Tiêm lỗi / độ trễ - đổi được lúc chạy qua POST /sim/config
+FAULTS = {
+    "latency_ms": float(os.getenv("SIM_LATENCY_MS", "0")),
+    "latency_jitter_ms": float(os.getenv("SIM_LATENCY_JITTER_MS", "0")),
+    "error_429": float(os.getenv("SIM_ERROR_429", "0")),
+    "error_5xx": float(os.getenv("SIM_ERROR_5XX", "0")),
+    "error_451": float(os.getenv("SIM_ERROR_451", "0")),
+    "weight_limit": int(os.getenv("SIM_WEIGHT_LIMIT", "2400")),
+}
+
+KLINE_INTERVAL_SECONDS = {
+    "1m": 60, "3m": 180, "5m": 300, "15m": 900, "30m": 1800, "1h": 3600,
+    "2h": 7200, "4h": 14400, "6h": 21600, "8h": 28800, "12h": 43200, "1d": 86400,
+}
+
+
+def _fmt(value, decimals=8):
+    return f"{value:.{decimals}f}"
+
+
+def _decimals(step):
+    return max(0, -int(math.floor(math.log10(step))))
+
+
+def binance_error(status, code, msg):
+    return JSONResponse(status_code=status, content={"code": code, "msg": msg})
+
+
+class SimulatorError(Exception):
+    """Lỗi nghiệp vụ trả về cho client theo định dạng {code, msg} của Binance"""
+    def __init__(self, code, msg, status=400):
+        super().__init__(msg)
+        self.code = code
+        self.msg = msg
+        self.status = status
+
+
+# ==================== THỊ TRƯỜNG GIẢ LẬP ====================
+class MarketSimulator:
+    """Giá + khối lượng từng giây cho mọi symbol (mảng NumPy 2 chiều symbol × giây, tự nới dung lượng)"""
+    def __init__(self, symbols: Dict[str, float], history_seconds, volatility, seed):
+        self.symbols = list(symbols)
+        self.index = {s: i for i, s in enumerate(self.symbols)}
+        self.volatility = volatility
+        self.rng = np.random.default_rng(seed)
+        self.t0 = int(time.time()) - history_seconds
+        self._initial = np.array([symbols[s] for s in self.symbols], dtype=float)
+        # Khối lượng nền ~ 200k USDC mỗi phút cho mỗi symbol
+        self._base_volume = 200_000 / 60 / self._initial
+        self._capacity = history_seconds + 3600
+        self.prices = np.empty((len(self.symbols), self._capacity), dtype=np.float32)
+        self.volumes = np.empty((len(self.symbols), self._capacity), dtype=np.float32)
+        self.length = 0
+        self._minute_factor = {}
+        self.lock = threading.Lock()
+        self.step_size = {s: min(1.0, 10.0 ** math.ceil(math.log10(1 / p))) for s, p in symbols.items()}
+        self.tick_size = {s: 10.0 ** (math.floor(math.log10(p)) - 4) for s, p in symbols.items()}
+        self.advance()
+
+    def _grow(self, needed):
+        capacity = self._capacity
+        while capacity < needed:
+            capacity *= 2
+        if capacity == self._capacity:
+            return
+        for name in ("prices", "volumes"):
+            grown = np.empty((len(self.symbols), capacity), dtype=np.float32)
+            grown[:, :self.length] = getattr(self, name)[:, :self.length]
+            setattr(self, name, grown)
+        self._capacity = capacity
+
+    def advance(self, now=None):
+        """Sinh dữ liệu tới giây hiện tại; trả về số giây mới"""
+        with self.lock:
+            target = int(now or time.time()) - self.t0 + 1
+            new = target - self.length
+            if new <= 0:
+                return 0
+            self._grow(target)
+            start = self.length
+            steps = self.rng.normal(0, self.volatility, (len(self.symbols), new))
+            last = self._initial if start == 0 else self.prices[:, start - 1].astype(float)
+            self.prices[:, start:target] = last[:, None] * np.exp(np.cumsum(steps, axis=1))
+
+            # Khối lượng: hệ số theo từng phút (tạo các pha volume tăng/giảm) × nhiễu theo giây
+            minutes = (self.t0 + np.arange(start, target)) // 60
+            for minute in np.unique(minutes):
+                if minute not in self._minute_factor:
+                    self._minute_factor[minute] = np.exp(self.rng.normal(0, 0.5, len(self.symbols)))
+            factors = np.stack([self._minute_factor[m] for m in minutes], axis=1)
+            noise = self.rng.lognormal(0, 0.3, (len(self.symbols), new))
+            self.volumes[:, start:target] = self._base_volume[:, None] * factors * noise
+            self.length = target
+            return new
+
+    def price(self, symbol):
+        """Giá hiện tại làm tròn theo tickSize (dữ liệu lưu float32)"""
+        return round(float(self.prices[self.index[symbol], self.length - 1]), _decimals(self.tick_size[symbol]))
+
+    def klines(self, symbol, interval, start_ms=None, end_ms=None, limit=500):
+        """Dòng kline theo định dạng Binance, gộp từ dữ liệu từng giây"""
+        step = KLINE_INTERVAL_SECONDS[interval]
+        i = self.index[symbol]
+        with self.lock:
+            length = self.length
+            prices = self.prices[i, :length]
+            volumes = self.volumes[i, :length]
+        now_sec = self.t0 + length - 1
+        first_bucket = -(-self.t0 // step) * step  # nến đầu tiên có đủ dữ liệu
+        last_bucket = (now_sec // step) * step
+        if end_ms is not None:
+            last_bucket = min(last_bucket, (int(end_ms) // 1000 // step) * step)
+        if start_ms is not None:
+            first_bucket = max(first_bucket, -(-(int(start_ms) // 1000) // step) * step)
+            last_bucket = min(last_bucket, first_bucket + (limit - 1) * step)
+        else:
+            first_bucket = max(first_bucket, last_bucket - (limit - 1) * step)
+        if last_bucket < first_bucket:
+            return []
+
+        buckets = np.arange(first_bucket, last_bucket + step, step)
+        offsets = buckets - self.t0
+        stop = min(length, int(offsets[-1]) + step)
+        segment_p = prices[offsets[0]:stop].astype(float)
+        segment_v = volumes[offsets[0]:stop].astype(float)
+        rel = offsets - offsets[0]
+        opens = segment_p[rel]
+        highs = np.maximum.reduceat(segment_p, rel)
+        lows = np.minimum.reduceat(segment_p, rel)
+        closes = segment_p[np.append(rel[1:], segment_p.size) - 1]
+        vols = np.add.reduceat(segment_v, rel)
+        quote = np.add.reduceat(segment_v * segment_p, rel)
+
+        qty_dec = _decimals(self.step_size[symbol])
+        price_dec = _decimals(self.tick_size[symbol])
+        rows = []
+        for k, bucket in enumerate(buckets):
+            rows.append([
+                int(bucket) * 1000, _fmt(opens[k], price_dec), _fmt(highs[k], price_dec),
+                _fmt(lows[k], price_dec), _fmt(closes[k], price_dec), _fmt(vols[k], qty_dec),
+                (int(bucket) + step) * 1000 - 1, _fmt(quote[k], 4), max(1, int(quote[k] / 1000)),
+                _fmt(vols[k] / 2, qty_dec), _fmt(quote[k] / 2, 4), "0",
+            ])
+        return rows
+
+
+# ==================== MATCHING ENGINE ====================
+class SimAccount:
+    def __init__(self, balance):
+        self.wallet = balance
+        self.positions = {}     # symbol -> [amt, entry]
+        self.leverage = defaultdict(lambda: 20)
+        self.orders = {}        # orderId -> order dict
+        self.client_ids = {}    # (symbol, clientOrderId) -> orderId của lệnh gần nhất mang id đó
+        self.trades = defaultdict(list)
+
+
+class MatchingEngine:
+    """Sổ lệnh theo tài khoản: MARKET khớp ngay, LIMIT chờ giá chạm, vị thế one-way (BOTH)"""
+    MAX_LEVERAGE = 125
+
+    def __init__(self, market: MarketSimulator):
+        self.market = market
+        self.accounts = {}
+        self._order_id = 1_000_000
+        self._trade_id = 1
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+        self._expired_at = time.time()
+
+    def account(self, api_key):
+        acc = self.accounts.get(api_key)
+        if acc is None:
+            acc = self.accounts.setdefault(api_key, SimAccount(SIM_START_BALANCE))
+        return acc
+
+    def _check_symbol(self, symbol):
+        if symbol not in self.market.index:
+            raise SimulatorError(-1121, "Invalid symbol.")
+        return symbol
+
+    def _unrealized(self, acc, symbol):
+        amt, entry = acc.positions.get(symbol, (0.0, 0.0))
+        return (self.market.price(symbol) - entry) * amt if amt else 0.0
+
+    def _margin_used(self, acc):
+        return sum(abs(amt) * self.market.price(s) / acc.leverage[s]
+                   for s, (amt, _) in acc.positions.items() if amt)
+
+    def _available(self, acc):
+        upnl = sum(self._unrealized(acc, s) for s in acc.positions)
+        return acc.wallet + upnl - self._margin_used(acc)
+
+    def set_leverage(self, api_key, symbol, leverage):
+        self._check_symbol(symbol)
+        if not 1 <= leverage <= self.MAX_LEVERAGE:
+            raise SimulatorError(-4028, f"Leverage {leverage} is not valid")
+        with self.lock:
+            self.account(api_key).leverage[symbol] = leverage
+        return {"leverage": leverage, "maxNotionalValue": "1000000", "symbol": symbol}
+
+    def _fill(self, acc, order, price):
+        """Khớp toàn bộ lệnh ở `price`: cập nhật vị thế, ví, fill"""
+        symbol, qty = order["symbol"], order["origQty"]
+        signed = qty if order["side"] == "BUY" else -qty
+        amt, entry = acc.positions.get(symbol, (0.0, 0.0))
+        realized = 0.0
+        if amt == 0 or (amt > 0) == (signed > 0):
+            new_amt = amt + signed
+            entry = (abs(amt) * entry + qty * price) / abs(new_amt)
+        else:
+            closing = min(qty, abs(amt))
+            realized = (price - entry) * closing * (1 if amt > 0 else -1)
+            new_amt = amt + signed
+            if abs(new_amt) < 1e-12:
+                new_amt, entry = 0.0, 0.0
+            elif (new_amt > 0) != (amt > 0):
+                entry = price
+        acc.positions[symbol] = (new_amt, entry)
+
+        commission = qty * price * SIM_TAKER_FEE
+        acc.wallet += realized - commission
+        now_ms = int(time.time() * 1000)
+        acc.trades[symbol].append({
+            "symbol": symbol, "id": self._trade_id, "orderId": order["orderId"], "side": order["side"],
+            "price": _fmt(price), "qty": _fmt(qty), "realizedPnl": _fmt(realized),
+            "marginAsset": "USDC", "quoteQty": _fmt(qty * price), "commission": _fmt(commission),
+            "commissionAsset": "USDC", "time": now_ms, "positionSide": "BOTH",
+            "buyer": order["side"] == "BUY", "maker": order["type"] == "LIMIT",
+        })
+        self._trade_id += 1
+        order.update(status="FILLED", executedQty=qty, cumQuote=qty * price, avgPrice=price, updateTime=now_ms)
+        self.stats["fills"] += 1
+
+    def place_order(self, api_key, params):
+        symbol = self._check_symbol(params.get("symbol", "").upper())
+        side = params.get("side", "").upper()
+        order_type = params.get("type", "").upper()
+        if side not in ("BUY", "SELL"):
+            raise SimulatorError(-1102, "Mandatory parameter 'side' was not sent, was empty/null, or malformed.")
+        if order_type not in ("MARKET", "LIMIT"):
+            raise SimulatorError(-1116, "Invalid orderType.")
+        try:
+            qty = float(params.get("quantity", 0))
+        except ValueError:
+            raise SimulatorError(-1102, "Mandatory parameter 'quantity' was not sent, was empty/null, or malformed.")
+        step = self.market.step_size[symbol]
+        if qty <= 0:
+            raise SimulatorError(-4003, "Quantity less than or equal to zero.")
+        if abs(round(qty / step) * step - qty) > step * 1e-6:
+            raise SimulatorError(-1111, "Precision is over the maximum defined for this asset.")
+        limit_price = None
+        if order_type == "LIMIT":
+            try:
+                limit_price = float(params["price"])
+            except (KeyError, ValueError):
+                raise SimulatorError(-1102, "Mandatory parameter 'price' was not sent, was empty/null, or malformed.")
+        reduce_only = str(params.get("reduceOnly", "false")).lower() == "true"
+        client_id = params.get("newClientOrderId") or f"sim{self._order_id}"
+
+        with self.lock:
+            acc = self.account(api_key)
+            previous = acc.orders.get(acc.client_ids.get((symbol, client_id)))
+            if previous is not None and previous["status"] == "NEW":
+                # Binance chỉ yêu cầu id duy nhất trong các lệnh đang mở; id của lệnh đã đóng dùng lại được
+                raise SimulatorError(-4116, "ClientOrderId is duplicated.")
+            amt, _ = acc.positions.get(symbol, (0.0, 0.0))
+            increases = amt == 0 or (amt > 0) == (side == "BUY") or qty > abs(amt)
+            if reduce_only and increases:
+                raise SimulatorError(-2022, "ReduceOnly Order is rejected.")
+            price = self.market.price(symbol)
+            if increases and qty * price / acc.leverage[symbol] > self._available(acc):
+                raise SimulatorError(-2019, "Margin is insufficient.")
+
+            self._order_id += 1
+            now_ms = int(time.time() * 1000)
+            order = {
+                "orderId": self._order_id, "symbol": symbol, "status": "NEW", "clientOrderId": client_id,
+                "price": limit_price or 0.0, "avgPrice": 0.0, "origQty": qty, "executedQty": 0.0,
+                "cumQuote": 0.0, "timeInForce": params.get("timeInForce", "GTC"), "type": order_type,
+                "reduceOnly": reduce_only, "side": side, "positionSide": "BOTH", "updateTime": now_ms,
+            }
+            acc.orders[order["orderId"]] = order
+            acc.client_ids[(symbol, client_id)] = order["orderId"]
+            self.stats["orders"] += 1
+
+            slip = price * SIM_SLIPPAGE_BPS / 10_000
+            fill_price = price + slip if side == "BUY" else price - slip
+            if order_type == "MARKET":
+                self._fill(acc, order, fill_price)
+            elif (side == "BUY" and price <= limit_price) or (side == "SELL" and price >= limit_price):
+                self._fill(acc, order, price)
+            return self._order_view(order)
+
+    def _expire_orders(self, now):
+        """Xóa lệnh đã đóng quá SIM_ORDER_RETENTION_SECONDS cùng ánh xạ clientOrderId của nó"""
+        cutoff_ms = (now - SIM_ORDER_RETENTION_SECONDS) * 1000
+        for acc in self.accounts.values():
+            expired = [order_id for order_id, order in acc.orders.items()
+                       if order["status"] != "NEW" and order["updateTime"] < cutoff_ms]
+            for order_id in expired:
+                order = acc.orders.pop(order_id)
+                key = (order["symbol"], order["clientOrderId"])
+                if acc.client_ids.get(key) == order_id:
+                    del acc.client_ids[key]
+            self.stats["orders_expired"] += len(expired)
+
+    def match_resting(self):
+        """Khớp các lệnh LIMIT đang chờ theo giá hiện tại (gọi mỗi tick); dọn lệnh cũ mỗi phút"""
+        with self.lock:
+            now = time.time()
+            if now - self._expired_at >= 60:
+                self._expired_at = now
+                self._expire_orders(now)
+            for acc in self.accounts.values():
+                for order in acc.orders.values():
+                    if order["status"] != "NEW":
+                        continue
+                    price = self.market.price(order["symbol"])
+                    if ((order["side"] == "BUY" and price <= order["price"]) or
+                            (order["side"] == "SELL" and price >= order["price"])):
+                        self._fill(acc, order, order["price"])
+
+    def get_order(self, api_key, params):
+        symbol = self._check_symbol(params.get("symbol", "").upper())
+        with self.lock:
+            acc = self.account(api_key)
+            order_id = params.get("orderId")
+            if order_id is None and params.get("origClientOrderId"):
+                order_id = acc.client_ids.get((symbol, params["origClientOrderId"]))
+            order = acc.orders.get(int(order_id)) if order_id is not None else None
+            if order is None or order["symbol"] != symbol:
+                raise SimulatorError(-2013, "Order does not exist.")
+            return self._order_view(order)
+
+    def cancel_all(self, api_key, symbol):
+        symbol = self._check_symbol(symbol.upper())
+        with self.lock:
+            for order in self.account(api_key).orders.values():
+                if order["symbol"] == symbol and order["status"] == "NEW":
+                    order["status"] = "CANCELED"
+        return {"code": 200, "msg": "The operation of cancel all open order is done."}
+
+    def user_trades(self, api_key, params):
+        symbol = self._check_symbol(params.get("symbol", "").upper())
+        limit = min(int(params.get("limit", 500)), 1000)
+        with self.lock:
+            trades = list(self.account(api_key).trades.get(symbol, []))
+        if params.get("orderId") is not None:
+            trades = [t for t in trades if t["orderId"] == int(params["orderId"])]
+        if params.get("startTime") is not None:
+            trades = [t for t in trades if t["time"] >= int(params["startTime"])]
+        return trades[-limit:]
+
+    def _position_view(self, acc, symbol, risk=True):
+        amt, entry = acc.positions.get(symbol, (0.0, 0.0))
+        mark = self.market.price(symbol)
+        view = {
+            "symbol": symbol, "positionAmt": _fmt(amt), "entryPrice": _fmt(entry),
+            "leverage": str(acc.leverage[symbol]), "positionSide": "BOTH",
+            "notional": _fmt(amt * mark), "updateTime": int(time.time() * 1000),
+        }
+        upnl = (mark - entry) * amt if amt else 0.0
+        if risk:
+            view.update(markPrice=_fmt(mark), unRealizedProfit=_fmt(upnl), liquidationPrice="0",
+                        marginType="cross", isolatedMargin="0")
+        else:
+            view.update(unrealizedProfit=_fmt(upnl), initialMargin=_fmt(abs(amt) * mark / acc.leverage[symbol]))
+        return view
+
+    def position_risk(self, api_key, symbol=None):
+        with self.lock:
+            acc = self.account(api_key)
+            symbols = [self._check_symbol(symbol.upper())] if symbol else self.market.symbols
+            return [self._position_view(acc, s) for s in symbols]
+
+    def account_info(self, api_key):
+        with self.lock:
+            acc = self.account(api_key)
+            upnl = sum(self._unrealized(acc, s) for s in acc.positions)
+            margin = self._margin_used(acc)
+            available = acc.wallet + upnl - margin
+            asset = {
+                "asset": "USDC", "walletBalance": _fmt(acc.wallet), "unrealizedProfit": _fmt(upnl),
+                "marginBalance": _fmt(acc.wallet + upnl), "initialMargin": _fmt(margin),
+                "availableBalance": _fmt(available), "maxWithdrawAmount": _fmt(max(available, 0)),
+            }
+            return {
+                "totalWalletBalance": _fmt(acc.wallet), "totalUnrealizedProfit": _fmt(upnl),
+                "totalMarginBalance": _fmt(acc.wallet + upnl), "availableBalance": _fmt(available),
+                "assets": [asset],
+                "positions": [self._position_view(acc, s, risk=False) for s in acc.positions],
+            }
+
+    @staticmethod
+    def _order_view(order):
+        view = dict(order)
+        for key in ("price", "avgPrice", "origQty", "executedQty", "cumQuote"):
+            view[key] = _fmt(order[key])
+        return view
+
+
+# ==================== KHỞI TẠO ====================
+def build_symbols(count, seed):
+    symbols = dict(list(DEFAULT_SYMBOLS.items())[:count])
+    rng = random.Random(seed)
+    for k in range(len(symbols), count):
+        symbols[f"SIM{k:03d}USDC"] = round(10 ** rng.uniform(-2, 3), 4)
+    return symbols
+
+
+market = MarketSimulator(build_symbols(SIM_SYMBOL_COUNT, SIM_SEED), SIM_HISTORY_SECONDS, SIM_VOLATILITY, SIM_SEED)
+engine = MatchingEngine(market)
+
+app = FastAPI(title="Binance Futures Simulator", version="1.0")
+
+
+# ==================== TIÊM ĐỘ TRỄ / LỖI / GIỚI HẠN WEIGHT ====================
+REQUEST_WEIGHTS = {
+    "/fapi/v1/exchangeInfo": 1, "/fapi/v2/account": 5, "/fapi/v2/positionRisk": 5,
+    "/fapi/v1/allOpenOrders": 1, "/fapi/v1/userTrades": 5, "/fapi/v1/ticker/24hr": 1,
+}
+_weight_log = defaultdict(deque)   # ip -> deque[(ts, weight)]
+_weight_used = defaultdict(int)
+
+
+def _request_weight(request: Request):
+    path = request.url.path
+    if path == "/fapi/v1/klines":
+        limit = int(request.query_params.get("limit", 500))
+        return 1 if limit < 100 else 2 if limit < 500 else 5 if limit <= 1000 else 10
+    if path == "/fapi/v1/ticker/24hr" and "symbol" not in request.query_params:
+        return 40
+    return REQUEST_WEIGHTS.get(path, 1)
+
+
+def _use_weight(ip, weight):
+    now = time.time()
+    log = _weight_log[ip]
+    while log and now - log[0][0] >= 60:
+        _weight_used[ip] -= log.popleft()[1]
+    log.append((now, weight))
+    _weight_used[ip] += weight
+    return _weight_used[ip]
+
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    if not request.url.path.startswith("/fapi"):
+        return await call_next(request)
+    engine.stats["requests"] += 1
+
+    delay = FAULTS["latency_ms"] + random.uniform(0, FAULTS["latency_jitter_ms"])
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+
+    used = _use_weight(request.client.host if request.client else "local", _request_weight(request))
+    if used > FAULTS["weight_limit"]:
+        engine.stats["rejected_weight"] += 1
+        return binance_error(429, -1003, "Too many requests; current limit of IP is exceeded.")
+
+    roll = random.random()
+    if roll < FAULTS["error_451"]:
+        engine.stats["injected_451"] += 1
+        return binance_error(451, 0, "Service unavailable from a restricted location according to 'b. Eligibility'.")
+    roll -= FAULTS["error_451"]
+    if roll < FAULTS["error_429"]:
+        engine.stats["injected_429"] += 1
+        return binance_error(429, -1003, "Too many requests; current limit of IP is exceeded.")
+    roll -= FAULTS["error_429"]
+    server_error = roll < FAULTS["error_5xx"]
+    # Một nửa lỗi 5xx xảy ra TRƯỚC khi xử lý, nửa còn lại SAU khi xử lý (client không biết lệnh đã khớp)
+    if server_error and random.random() < 0.5:
+        engine.stats["injected_5xx"] += 1
+        return binance_error(503, -1001, "Internal error; unable to process your request. Please try again.")
+
+    response = await call_next(request)
+    if server_error:
+        engine.stats["injected_5xx_after"] += 1
+        return binance_error(503, -1001, "Internal error; unable to process your request. Please try again.")
+    response.headers["X-MBX-USED-WEIGHT-1M"] = str(used)
+    return response
+
+
+@app.exception_handler(SimulatorError)
+async def simulator_error_handler(request: Request, exc: SimulatorError):
+    return binance_error(exc.status, exc.code, exc.msg)
+
+
+async def _signed_params(request: Request):
+    """Gộp tham số từ query + body form; yêu cầu API key và signature như Binance"""
+    params = dict(request.query_params)
+    body = (await request.body()).decode()
+    if body:
+        for pair in body.split("&"):
+            key, _, value = pair.partition("=")
+            if key:
+                params[key] = value
+    api_key = request.headers.get("X-MBX-APIKEY")
+    if not api_key:
+        raise SimulatorError(-2014, "API-key format invalid.", status=401)
+    if "signature" not in params:
+        raise SimulatorError(-1102, "Mandatory parameter 'signature' was not sent, was empty/null, or malformed.")
+    return api_key, params
+
+
+# ==================== REST CÔNG KHAI ====================
+@app.get("/fapi/v1/ping")
+async def ping():
+    return {}
+
+
+@app.get("/fapi/v1/time")
+async def server_time():
+    return {"serverTime": int(time.time() * 1000)}
+
+
+@app.get("/fapi/v1/exchangeInfo")
+async def exchange_info():
+    symbols = []
+    for symbol in market.symbols:
+        step = market.step_size[symbol]
+        tick = market.tick_size[symbol]
+        symbols.append({
+            "symbol": symbol, "pair": symbol, "contractType": "PERPETUAL", "status": "TRADING",
+            "onboardDate": market.t0 * 1000, "baseAsset": symbol[:-4], "quoteAsset": "USDC",
+            "marginAsset": "USDC", "pricePrecision": _decimals(tick), "quantityPrecision": _decimals(step),
+            "filters": [
+                {"filterType": "PRICE_FILTER", "tickSize": _fmt(tick), "minPrice": _fmt(tick), "maxPrice": "10000000"},
+                {"filterType": "LOT_SIZE", "stepSize": _fmt(step), "minQty": _fmt(step), "maxQty": "10000000"},
+                {"filterType": "MARKET_LOT_SIZE", "stepSize": _fmt(step), "minQty": _fmt(step), "maxQty": "10000000"},
+                {"filterType": "MIN_NOTIONAL", "notional": "5"},
+                # Binance thật không có filter này; trading_bot_lib đọc nó để lấy đòn bẩy tối đa
+                {"filterType": "LEVERAGE", "maxLeverage": MatchingEngine.MAX_LEVERAGE},
+            ],
+        })
+    return {
+        "timezone": "UTC", "serverTime": int(time.time() * 1000),
+        "rateLimits": [{"rateLimitType": "REQUEST_WEIGHT", "interval": "MINUTE", "intervalNum": 1,
+                        "limit": FAULTS["weight_limit"]}],
+        "symbols": symbols,
+    }
+
+
+@app.get("/fapi/v1/klines")
+async def klines(symbol: str, interval: str, startTime: int = None, endTime: int = None, limit: int = 500):
+    symbol = engine._check_symbol(symbol.upper())
+    if interval not in KLINE_INTERVAL_SECONDS:
+        raise SimulatorError(-1120, "Invalid interval.")
+    return market.klines(symbol, interval, startTime, endTime, max(1, min(limit, 1500)))
+
+
+@app.get("/fapi/v1/ticker/price")
+async def ticker_price(symbol: str = None):
+    now_ms = int(time.time() * 1000)
+    if symbol:
+        symbol = engine._check_symbol(symbol.upper())
+        return {"symbol": symbol, "price": _fmt(market.price(symbol)), "time": now_ms}
+    return [{"symbol": s, "price": _fmt(market.price(s)), "time": now_ms} for s in market.symbols]
+
+
+def _ticker_24hr(symbol):
+    row = market.klines(symbol, "1d", limit=1)
+    if not row:
+        return {"symbol": symbol, "lastPrice": _fmt(market.price(symbol))}
+    _, o, h, l, c, v, _, q = row[-1][:8]
+    change = float(c) - float(o)
+    return {
+        "symbol": symbol, "priceChange": _fmt(change), "priceChangePercent": _fmt(change / float(o) * 100, 3),
+        "lastPrice": c, "openPrice": o, "highPrice": h, "lowPrice": l, "volume": v, "quoteVolume": q,
+        "closeTime": int(time.time() * 1000),
+    }
+
+
+@app.get("/fapi/v1/ticker/24hr")
+async def ticker_24hr(symbol: str = None):
+    if symbol:
+        return _ticker_24hr(engine._check_symbol(symbol.upper()))
+    return [_ticker_24hr(s) for s in market.symbols]
+
+
+# ==================== REST CÓ KÝ ====================
+@app.get("/fapi/v2/positionRisk")
+async def position_risk(request: Request):
+    api_key, params = await _signed_params(request)
+    return engine.position_risk(api_key, params.get("symbol"))
+
+
+@app.get("/fapi/v2/account")
+async def account(request: Request):
+    api_key, _ = await _signed_params(request)
+    return engine.account_info(api_key)
+
+
+@app.post("/fapi/v1/leverage")
+async def leverage(request: Request):
+    api_key, params = await _signed_params(request)
+    try:
+        value = int(params.get("leverage", 0))
+    except ValueError:
+        raise SimulatorError(-1102, "Mandatory parameter 'leverage' was not sent, was empty/null, or malformed.")
+    return engine.set_leverage(api_key, params.get("symbol", "").upper(), value)
+
+
+@app.post("/fapi/v1/order")
+async def new_order(request: Request):
+    api_key, params = await _signed_params(request)
+    return engine.place_order(api_key, params)
+
+
+@app.get("/fapi/v1/order")
+async def query_order(request: Request):
+    api_key, params = await _signed_params(request)
+    return engine.get_order(api_key, params)
+
+
+@app.delete("/fapi/v1/allOpenOrders")
+async def cancel_all_open_orders(request: Request):
+    api_key, params = await _signed_params(request)
+    return engine.cancel_all(api_key, params.get("symbol", ""))
+
+
+@app.get("/fapi/v1/userTrades")
+async def user_trades(request: Request):
+    api_key, params = await _signed_params(request)
+    return engine.user_trades(api_key, params)
+
+
+# ==================== ĐIỀU KHIỂN GIẢ LẬP ====================
+@app.get("/sim/config")
+async def get_sim_config():
+    return FAULTS
+
+
+@app.post("/sim/config")
+async def update_sim_config(request: Request):
+    """Đổi độ trễ / tỷ lệ lỗi lúc đang chạy, vd. {"latency_ms": 200, "error_429": 0.05}"""
+    changes = await request.json()
+    for key, value in changes.items():
+        if key in FAULTS:
+            FAULTS[key] = type(FAULTS[key])(value)
+    return FAULTS
+
+
+@app.get("/sim/stats")
+async def sim_stats():
+    return dict(engine.stats, accounts=len(engine.accounts), stream_clients=len(stream_hub.clients),
+                symbols=len(market.symbols), seconds=market.length)
+
+
+# ==================== WEBSOCKET: @trade VÀ @kline_<interval> ====================
+class StreamHub:
+    """Mỗi tick phát trade/kline cho các client đăng ký - mỗi client 1 hàng đợi, client chậm bị bỏ bớt tin"""
+    QUEUE_SIZE = 256
+
+    def __init__(self):
+        self.clients = {}       # id(ws) -> (streams, queue, combined)
+        self._trade_id = 1
+        self._kline_open = {}   # (symbol, interval) -> open_time của nến đang chạy
+
+    def register(self, ws, streams, combined):
+        queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        self.clients[id(ws)] = (streams, queue, combined)
+        return queue
+
+    def unregister(self, ws):
+        self.clients.pop(id(ws), None)
+
+    @staticmethod
+    def _kline_event(symbol, interval, row, now_ms, closed):
+        return {
+            "e": "kline", "E": now_ms, "s": symbol,
+            "k": {"t": row[0], "T": row[6], "s": symbol, "i": interval, "o": row[1], "c": row[4],
+                  "h": row[2], "l": row[3], "v": row[5], "n": row[8], "q": row[7], "V": row[9], "Q": row[10],
+                  "x": closed},
+        }
+
+    def _events(self, symbol, kind, now_ms):
+        if kind == "trade":
+            qty = market.step_size[symbol] * random.randint(1, 50)
+            event = {"e": "trade", "E": now_ms, "T": now_ms, "s": symbol, "t": self._trade_id,
+                     "p": _fmt(market.price(symbol)), "q": _fmt(qty), "X": "MARKET", "m": random.random() < 0.5}
+            self._trade_id += 1
+            return [event]
+        rows = market.klines(symbol, kind, limit=2)
+        if not rows:
+            return []
+        events = []
+        previous_open = self._kline_open.get((symbol, kind))
+        # Nến vừa chuyển sang kỳ mới → gửi bản cuối của nến đã đóng (x = true) trước
+        if previous_open is not None and rows[-1][0] > previous_open and len(rows) > 1:
+            events.append(self._kline_event(symbol, kind, rows[-2], now_ms, True))
+        self._kline_open[(symbol, kind)] = rows[-1][0]
+        events.append(self._kline_event(symbol, kind, rows[-1], now_ms, False))
+        return events
+
+    def publish(self):
+        """Tạo sự kiện cho các stream đang có người nghe và đẩy vào hàng đợi từng client"""
+        now_ms = int(time.time() * 1000)
+        events = {}
+        for streams, queue, combined in list(self.clients.values()):
+            for name, symbol, kind in streams:
+                if name not in events:
+                    events[name] = self._events(symbol, kind, now_ms)
+                for payload in events[name]:
+                    try:
+                        queue.put_nowait({"stream": name, "data": payload} if combined else payload)
+                    except asyncio.QueueFull:
+                        engine.stats["stream_dropped"] += 1
+
+
+stream_hub = StreamHub()
+
+
+def _parse_streams(names):
+    streams = []
+    for name in names:
+        symbol, _, kind = name.partition("@")
+        symbol = symbol.upper()
+        if symbol not in market.index:
+            continue
+        if kind == "trade":
+            streams.append((name, symbol, "trade"))
+        elif kind.startswith("kline_") and kind[6:] in KLINE_INTERVAL_SECONDS:
+            streams.append((name, symbol, kind[6:]))
+    return streams
+
+
+async def _serve_stream(ws: WebSocket, names, combined):
+    await ws.accept()
+    queue = stream_hub.register(ws, _parse_streams(names), combined)
+    try:
+        while True:
+            await ws.send_json(await queue.get())
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        stream_hub.unregister(ws)
+
+
+@app.websocket("/ws/{streams:path}")
+async def raw_stream(ws: WebSocket, streams: str):
+    await _serve_stream(ws, [s for s in streams.split("/") if s], combined=False)
+
+
+@app.websocket("/stream")
+async def combined_stream(ws: WebSocket, streams: str = ""):
+    await _serve_stream(ws, [s for s in streams.split("/") if s], combined=True)
+
+
+# ==================== VÒNG TICK THỊ TRƯỜNG ====================
+async def _market_loop():
+    while True:
+        try:
+            market.advance()
+            engine.match_resting()
+            stream_hub.publish()
+        except Exception as e:
+            print(f"❌ Lỗi tick giả lập: {e}")
+        await asyncio.sleep(SIM_TICK_SECONDS)
+
+
+@app.on_event("startup")
+async def start_market_loop():
+    asyncio.create_task(_market_loop())
+    print(f"🧪 Binance simulator: {len(market.symbols)} symbol, lịch sử {SIM_HISTORY_SECONDS}s, "
+          f"số dư khởi tạo {SIM_START_BALANCE} USDC")
+
+
+# ==================== CHẠY LOCAL ====================
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run("binance_simulator:app", host="0.0.0.0", port=int(os.getenv("SIM_PORT", "9000")))
@@ -11,8 +11,11 @@ let currentUsername = null;
 let priceChart = null;
 let priceData = [];
 let labelData = [];
+let priceTimes = []; // epoch giây của từng điểm (ghép backfill với giá realtime)
+const MAX_CHART_POINTS = 300;
 let ws = null;
 let currentSymbol = "BTCUSDT"; // 👈 coin đang vẽ biểu đồ
+const watchedSymbols = new Set(); // các coin đang theo dõi trên socket /ws/market
 
 // ================= API helper =================
 async function apiRequest(path, { method = "GET", body = null, auth = true } = {}) {
@@ -394,25 +397,25 @@ function renderDashboard() {
         btnApplySymbol.addEventListener("click", () => {
             const sym = symbolInput.value.trim().toUpperCase();
             if (!sym) return;
+            const previous = currentSymbol;
             currentSymbol = sym;
     
-            // reset dữ liệu chart khi đổi coin
-            priceData = [];
-            labelData = [];
-            if (priceChart) {
-                priceChart.data.labels = labelData;
-                priceChart.data.datasets[0].data = priceData;
-                priceChart.update();
-            }
+            // reset dữ liệu chart khi đổi coin rồi nạp lịch sử từ server
+            resetChartData();
+            loadPriceHistory(sym);
     
-            connectPriceWS(currentSymbol);
+            // cùng 1 socket: bỏ coin cũ, theo dõi coin mới
+            if (previous && previous !== sym) unwatchSymbols([previous]);
+            watchSymbols([sym]);
         });
     }
     // 👆 HẾT PHẦN THÊM
     
     setupSidebarEvents();
     initChart();
-    connectPriceWS(currentSymbol);  // 👈 truyền currentSymbol
+    loadPriceHistory(currentSymbol);
+    connectMarketWS();
+    watchSymbols([currentSymbol]);  // 👈 theo dõi currentSymbol
     connectPnlWS();
     loadBotStatus();
 }
@@ -429,6 +432,7 @@ function setupSidebarEvents() {
             currentUsername = null;
             localStorage.removeItem("authToken");
             localStorage.removeItem("username");
+            watchedSymbols.clear();
             if (ws) {
                 ws.close();
                 ws = null;
@@ -469,6 +473,7 @@ function initChart() {
 
     priceData = [];
     labelData = [];
+    priceTimes = [];
 
     priceChart = new Chart(ctx, {
         type: "line",
@@ -506,16 +511,93 @@ function initChart() {
     });
 }
 
+function formatTimeLabel(ts) {
+    const t = new Date(ts * 1000);
+    return `${t.getHours()}:${String(t.getMinutes()).padStart(2, "0")}:${String(t.getSeconds()).padStart(2, "0")}`;
+}
+
+function resetChartData() {
+    priceData = [];
+    labelData = [];
+    priceTimes = [];
+    if (priceChart) {
+        priceChart.data.labels = labelData;
+        priceChart.data.datasets[0].data = priceData;
+        priceChart.update();
+    }
+}
+
+// Nạp lịch sử giá từ ring buffer của server để biểu đồ có dữ liệu ngay khi mở/đổi coin
+async function loadPriceHistory(symbol, resolution = "1s") {
+    try {
+        const hist = await apiRequest(
+            `/api/price-history?symbol=${encodeURIComponent(symbol)}&resolution=${resolution}&limit=${MAX_CHART_POINTS}`
+        );
+        if (symbol !== currentSymbol || !hist.t.length) return;
+
+        // giữ các điểm realtime đã nhận sau điểm cuối của lịch sử
+        const lastTs = hist.t[hist.t.length - 1];
+        const liveIdx = priceTimes.findIndex((ts) => ts > lastTs);
+        const livePrices = liveIdx >= 0 ? priceData.slice(liveIdx) : [];
+        const liveTimes = liveIdx >= 0 ? priceTimes.slice(liveIdx) : [];
+
+        priceTimes = hist.t.concat(liveTimes).slice(-MAX_CHART_POINTS);
+        priceData = hist.p.concat(livePrices).slice(-MAX_CHART_POINTS);
+        labelData = priceTimes.map(formatTimeLabel);
+        if (priceChart) {
+            priceChart.data.labels = labelData;
+            priceChart.data.datasets[0].data = priceData;
+            priceChart.update("none");
+        }
+    } catch (err) {
+        console.error("Load price history error", err);
+    }
+}
+
 // =============== WebSocket ===============
-function connectPriceWS(symbol) {
-    // cập nhật symbol hiện tại (nếu người dùng nhập)
-    if (symbol) {
-        currentSymbol = symbol.toUpperCase();
+// 1 socket /ws/market cho mọi coin: subscribe/unsubscribe thay vì mở lại socket
+function sendMarketOp(op, symbols) {
+    if (ws && ws.readyState === WebSocket.OPEN && symbols.length) {
+        ws.send(JSON.stringify({ op, symbols }));
+    }
+}
+
+function watchSymbols(symbols) {
+    symbols.forEach((s) => watchedSymbols.add(s.toUpperCase()));
+    sendMarketOp("subscribe", symbols.map((s) => s.toUpperCase()));
+}
+
+function unwatchSymbols(symbols) {
+    symbols.forEach((s) => watchedSymbols.delete(s.toUpperCase()));
+    sendMarketOp("unsubscribe", symbols.map((s) => s.toUpperCase()));
+}
+
+function onPrice(symbol, price, timestamp) {
+    if (symbol !== currentSymbol) return;
+
+    if (priceData.length >= MAX_CHART_POINTS) {
+        priceData.shift();
+        labelData.shift();
+        priceTimes.shift();
     }
-    if (!currentSymbol) {
-        currentSymbol = "BTCUSDT";
+
+    priceData.push(price);
+    priceTimes.push(timestamp);
+    labelData.push(formatTimeLabel(timestamp));
+
+    if (priceChart) {
+        if (
+          priceChart.options &&
+          priceChart.options.plugins &&
+          priceChart.options.plugins.title
+        ) {
+            priceChart.options.plugins.title.text = currentSymbol + " price";
+        }
+        priceChart.update("none");
     }
+}
 
+function connectMarketWS() {
     if (ws) {
         ws.close();
         ws = null;
@@ -523,51 +605,40 @@ function connectPriceWS(symbol) {
 
     const url = (location.protocol === "https:" ? "wss://" : "ws://") +
         location.host +
-        `/ws/price?token=${encodeURIComponent(authToken)}&symbol=${encodeURIComponent(currentSymbol)}`;
+        `/ws/market?token=${encodeURIComponent(authToken)}`;
 
-    ws = new WebSocket(url);
-    ws.onopen = () => {
-        console.log("WS price connected for", currentSymbol);
+    const sock = new WebSocket(url);
+    ws = sock;
+    sock.onopen = () => {
+        console.log("WS market connected");
+        // (re)subscribe toàn bộ coin đang theo dõi
+        sendMarketOp("subscribe", Array.from(watchedSymbols));
     };
-    ws.onmessage = (ev) => {
+    sock.onmessage = (ev) => {
         try {
             const data = JSON.parse(ev.data);
-            if (data.error) {
-                console.error("WS price error:", data);
-                return;
-            }
-
-            if (priceData.length > 50) {
-                priceData.shift();
-                labelData.shift();
-            }
-
-            priceData.push(data.price);
-            const t = new Date(data.timestamp * 1000);
-            labelData.push(
-              `${t.getHours()}:${String(t.getMinutes()).padStart(2, "0")}:${String(t.getSeconds()).padStart(2, "0")}`
-            );
-
-            if (priceChart) {
-                if (
-                  priceChart.options &&
-                  priceChart.options.plugins &&
-                  priceChart.options.plugins.title
-                ) {
-                    priceChart.options.plugins.title.text = currentSymbol + " price";
-                }
-                priceChart.update("none");
+            if (data.type === "prices") {
+                // 1 khung = nhiều coin, chỉ các coin đổi giá
+                Object.entries(data.d).forEach(([sym, price]) => onPrice(sym, price, data.t));
+            } else if (data.type === "error") {
+                console.error("WS market error:", data);
             }
         } catch (e) {
             console.error("WS parse error", e);
         }
     };
-    ws.onclose = () => {
-        console.log("WS price closed");
+    sock.onclose = () => {
+        console.log("WS market closed");
+        // tự nối lại nếu vẫn đăng nhập và socket này chưa bị thay thế
+        if (ws === sock && authToken) {
+            ws = null;
+            setTimeout(() => {
+                if (!ws && authToken) connectMarketWS();
+            }, 3000);
+        }
     };
 }
 
-
 function connectPnlWS() {
     const url = (location.protocol === "https:" ? "wss://" : "ws://") +
         location.host +
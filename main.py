@@ -1,12 +1,24 @@
 # backend/main.py
 import asyncio
+import hashlib
+import json
+import logging
 import random
+import threading
 import time
 import os
 import secrets
+import subprocess
+import sys
 import requests
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from typing import Dict, Optional
 
+import jwt
+import numpy as np
+
 from fastapi import (
     FastAPI,
     Depends,
@@ -15,19 +27,36 @@ from fastapi import (
     WebSocketDisconnect,
     Header,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, RedirectResponse
 
 from pydantic import BaseModel, Field
 
-from sqlalchemy import create_engine, Column, Integer, String, Float
+from sqlalchemy import create_engine, event, text, Column, Index, Integer, String, Float
 from sqlalchemy.orm import declarative_base, sessionmaker, Session
 
 # 🚨 BOT MANAGER — dùng trading_bot_lib thật nếu có
 try:
-    from trading_bot_lib import BotManager, get_balance
+    from trading_bot_lib import (
+        BotManager,
+        get_account_state,
+        telegram_router,
+        WebSocketManager,
+        trade_journal,
+        account_tag,
+        BINANCE_FAPI_URL,
+        market_universe,
+    )
 except ImportError:
+    telegram_router = None
+    market_universe = None
+    WebSocketManager = None
+    BINANCE_FAPI_URL = os.getenv("BINANCE_FAPI_URL", "https://fapi.binance.com").rstrip("/")
+    trade_journal = None
+    account_tag = None
+
     # Nếu chưa có file thật — dùng fake để UI vẫn chạy, KHÔNG giao dịch thật
     class BotManager:
         def __init__(self, *args, **kwargs):
@@ -37,7 +66,7 @@ except ImportError:
             print("📌 add_bot FAKE:", kwargs)
             return True
 
-        def stop_all(self):
+        def stop_all(self, deadline=None):
             print("🔴 stop_all FAKE")
 
         def stop_all_coins(self):
@@ -46,6 +75,12 @@ except ImportError:
         def stop_bot(self, bot_id):
             print(f"🔇 stop_bot {bot_id} FAKE")
 
+        def close(self):
+            pass
+
+        def get_runtime_status(self):
+            return {"running": False, "bot_count": 0, "bot_ids": [], "active_symbols": [], "symbol_owners": {}}
+
         def get_position_summary(self):
             return {
                 "total_long_count": 0,
@@ -56,16 +91,62 @@ except ImportError:
                 "binance_positions": [],
             }
 
-    def get_balance(api_key, api_secret):
-        """Dummy get_balance nếu thiếu trading_bot_lib thật"""
-        return 1000.0
+    def get_account_state(api_key, api_secret):
+        """Dummy get_account_state nếu thiếu trading_bot_lib thật"""
+        return {
+            "balance": 1000.0,
+            "wallet_balance": 1000.0,
+            "total_unrealized_pnl": 0.0,
+            "positions": [],
+        }
+
+
+logger = logging.getLogger(__name__)
 
 
 # ==================== DATABASE ====================
-DATABASE_URL = "sqlite:///./app.db"
+# DATABASE_URL: sqlite (1 node, mặc định) hoặc postgresql (nhiều node, psycopg2)
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
+if DATABASE_URL.startswith("postgres://"):
+    # Heroku/Render dùng scheme cũ mà SQLAlchemy không nhận
+    DATABASE_URL = "postgresql+psycopg2://" + DATABASE_URL[len("postgres://"):]
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+
+
+def create_db_engine(url: str):
+    """Engine có connection pool; SQLite bật WAL để đọc không chặn ghi (login/status song song save config)"""
+    if url.startswith("sqlite"):
+        db_engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False, "timeout": 30},
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_pre_ping=True,
+        )
+
+        @event.listens_for(db_engine, "connect")
+        def _sqlite_pragmas(dbapi_conn, _record):
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute("PRAGMA busy_timeout=30000")
+            cur.close()
+
+        return db_engine
+
+    return create_engine(
+        url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_pre_ping=True,
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    )
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine)
+
+engine = create_db_engine(DATABASE_URL)
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
 Base = declarative_base()
 
 
@@ -95,8 +176,122 @@ class BotConfig(Base):
     roi_trigger = Column(Float, nullable=True)
     bot_count = Column(Integer, nullable=False, default=1)
 
+    # "config mới nhất của user" = lọc user_id + sắp id giảm dần → chỉ đọc 1 mục index
+    __table_args__ = (Index("ix_bot_configs_user_id_id", "user_id", "id"),)
+
+
+class RunningBot(Base):
+    """Cấu hình đang chạy (đã bấm start, chưa stop) - dùng để khôi phục bot khi server khởi động lại"""
+
+    __tablename__ = "running_bots"
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    config_id = Column(Integer, nullable=False)
+    started_at = Column(Float, nullable=False)
+
 
 Base.metadata.create_all(bind=engine)
+# create_all không thêm index cho bảng đã tồn tại từ trước
+for _index in BotConfig.__table__.indexes:
+    _index.create(bind=engine, checkfirst=True)
+
+
+# ==================== CACHE USER / CONFIG ====================
+@dataclass(frozen=True)
+class CachedUser:
+    """Bản chụp bất biến của User (an toàn dùng chung giữa các request/thread)"""
+
+    id: int
+    username: str
+    api_key: Optional[str]
+    api_secret: Optional[str]
+
+    @classmethod
+    def from_row(cls, row: User) -> "CachedUser":
+        return cls(row.id, row.username, row.api_key, row.api_secret)
+
+
+@dataclass(frozen=True)
+class CachedBotConfig:
+    """Bản chụp bất biến của BotConfig mới nhất"""
+
+    id: int
+    user_id: int
+    bot_mode: str
+    symbol: Optional[str]
+    lev: int
+    percent: float
+    tp: float
+    sl: float
+    roi_trigger: Optional[float]
+    bot_count: int
+
+    @classmethod
+    def from_row(cls, row: BotConfig) -> "CachedBotConfig":
+        return cls(
+            row.id, row.user_id, row.bot_mode, row.symbol, row.lev,
+            row.percent, row.tp, row.sl, row.roi_trigger, row.bot_count,
+        )
+
+
+# TTL giới hạn độ cũ khi nhiều tiến trình web cùng ghi (mỗi tiến trình chỉ tự làm mới cache của nó)
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+
+class UserConfigCache:
+    """Cache ghi xuyên (write-through) user + BotConfig mới nhất theo user_id.
+
+    Handler ghi DB xong thì gọi put_* với bản ghi vừa commit; dashboard poll chỉ đọc cache.
+    """
+
+    _NO_CONFIG = object()
+
+    def __init__(self, ttl: float = USER_CACHE_TTL):
+        self.ttl = ttl
+        self._users: Dict[int, tuple] = {}
+        self._configs: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, entry) -> bool:
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def get_user(self, db: Session, user_id: int) -> Optional[CachedUser]:
+        entry = self._users.get(user_id)
+        if self._fresh(entry):
+            return entry[1]
+        row = db.query(User).filter(User.id == user_id).first()
+        return self.put_user(row) if row else None
+
+    def put_user(self, row: User) -> CachedUser:
+        user = CachedUser.from_row(row)
+        with self._lock:
+            self._users[user.id] = (time.time(), user)
+        return user
+
+    def get_latest_config(self, db: Session, user_id: int) -> Optional[CachedBotConfig]:
+        entry = self._configs.get(user_id)
+        if not self._fresh(entry):
+            row = (
+                db.query(BotConfig)
+                .filter(BotConfig.user_id == user_id)
+                .order_by(BotConfig.id.desc())
+                .first()
+            )
+            if row is None:
+                with self._lock:
+                    self._configs[user_id] = (time.time(), self._NO_CONFIG)
+                return None
+            return self.put_config(row)
+        return None if entry[1] is self._NO_CONFIG else entry[1]
+
+    def put_config(self, row: BotConfig) -> CachedBotConfig:
+        cfg = CachedBotConfig.from_row(row)
+        with self._lock:
+            self._configs[cfg.user_id] = (time.time(), cfg)
+        return cfg
+
+
+user_cache = UserConfigCache()
 
 
 # ==================== FASTAPI APP ====================
@@ -129,13 +324,54 @@ async def root():
 
 
 # ==================== TOKEN / AUTH ====================
-TOKEN_STORE: Dict[str, int] = {}  # token -> user_id mapping
+# Token JWT (HS256) không lưu trạng thái: mọi worker uvicorn dùng chung secret đều xác thực được,
+# restart server không đăng xuất người dùng
+TOKEN_TTL = int(os.getenv("TOKEN_TTL", str(7 * 24 * 3600)))
+
+
+def _load_auth_secret() -> str:
+    """AUTH_SECRET từ env; nếu thiếu thì tạo 1 lần vào file (dùng chung cho các worker cùng máy)"""
+    secret = os.getenv("AUTH_SECRET")
+    if secret:
+        return secret
+    path = os.getenv("AUTH_SECRET_FILE", "./.auth_secret")
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+    except FileExistsError:
+        pass
+    # worker khác có thể vừa tạo file nhưng chưa ghi xong
+    for _ in range(50):
+        with open(path) as f:
+            secret = f.read().strip()
+        if secret:
+            return secret
+        time.sleep(0.1)
+    raise RuntimeError(f"Không đọc được auth secret từ {path}")
+
+
+AUTH_SECRET = _load_auth_secret()
 
 
 def create_token(user_id: int) -> str:
-    token = secrets.token_hex(32)
-    TOKEN_STORE[token] = user_id
-    return token
+    now = int(time.time())
+    return jwt.encode(
+        {"sub": str(user_id), "iat": now, "exp": now + TOKEN_TTL},
+        AUTH_SECRET,
+        algorithm="HS256",
+    )
+
+
+def decode_token(token: Optional[str]) -> Optional[int]:
+    """user_id trong token, None nếu token sai chữ ký / hết hạn"""
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, AUTH_SECRET, algorithms=["HS256"])
+        return int(payload["sub"])
+    except (jwt.PyJWTError, KeyError, ValueError):
+        return None
 
 
 # Dependency: DB session
@@ -147,20 +383,39 @@ def get_db():
         db.close()
 
 
-async def get_current_user(
+# Dependency đồng bộ: FastAPI chạy trong threadpool nên truy vấn DB không chặn event loop
+def get_current_user(
     x_auth_token: str = Header(..., alias="X-Auth-Token"),
     db: Session = Depends(get_db),
 ):
-    uid = TOKEN_STORE.get(x_auth_token)
+    uid = decode_token(x_auth_token)
     if not uid:
         raise HTTPException(401, detail="Token hết hạn hoặc không hợp lệ")
 
-    user = db.query(User).filter(User.id == uid).first()
+    user = user_cache.get_user(db, uid)
     if not user:
         raise HTTPException(401, detail="User không tồn tại")
     return user
 
 
+def load_ws_user(token: Optional[str]):
+    """Xác thực socket: trả về ((user_id, api_key, api_secret), None) hoặc (None, (mã đóng, thông báo)).
+
+    Chạy qua run_in_threadpool từ handler websocket (async) để không chặn event loop.
+    """
+    uid = decode_token(token)
+    if not uid:
+        return None, (4001, "Token không hợp lệ hoặc đã hết hạn")
+    db = SessionLocal()
+    try:
+        user = user_cache.get_user(db, uid)
+        if not user or not user.api_key or not user.api_secret:
+            return None, (4002, "User chưa cấu hình API Binance")
+        return (user.id, user.api_key, user.api_secret), None
+    finally:
+        db.close()
+
+
 # ==================== Pydantic MODELS ====================
 class RegisterReq(BaseModel):
     username: str
@@ -203,39 +458,341 @@ class AddBotReq(BaseModel):
 # ==================== BOT MANAGER STORE ====================
 BOT_MANAGERS: Dict[int, BotManager] = {}
 
+# BOT_WORKERS > 0: chạy BotManager trong các tiến trình worker riêng (chia shard theo user_id)
+# thay vì chung tiến trình/GIL với web server. Bắt buộc khi chạy uvicorn nhiều worker:
+# các tiến trình web dùng chung bộ bot worker nên lệnh điều khiển luôn tới đúng tiến trình sở hữu bot.
+# Worker thuộc tiến trình giám sát `python main.py bot-workers` (tách khỏi vòng đời tiến trình web);
+# BOT_WORKERS_AUTOSTART=1: tiến trình web tự chạy nó nền nếu chưa có, 0: tự quản (systemd, supervisord...).
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "0"))
+BOT_WORKERS_AUTOSTART = os.getenv("BOT_WORKERS_AUTOSTART", "1") == "1"
+# Chỉ 1 tiến trình sở hữu bot (khôi phục + chạy bot): tiến trình giám sát khi BOT_WORKERS > 0,
+# ngược lại là tiến trình web giữ được khóa. SQLite: khóa file; Postgres: advisory lock (nhiều node).
+BOT_OWNER_LOCK = os.getenv("BOT_OWNER_LOCK", "./.bot_owner.lock")
+BOT_OWNER_LOCK_KEY = 0x6B6F74  # khóa advisory Postgres
+# BOT_WORKERS = 0 mà nhiều tiến trình web: bot nằm rải rác trong từng tiến trình → từ chối chạy bot
+BOT_IN_PROCESS_REFUSED = BOT_WORKERS == 0 and int(os.getenv("WEB_CONCURRENCY", "1")) > 1
+if BOT_IN_PROCESS_REFUSED:
+    print("⚠ WEB_CONCURRENCY > 1 nhưng BOT_WORKERS = 0: không khôi phục/chạy bot, hãy đặt BOT_WORKERS > 0")
+# Thời hạn tối đa (giây) để đóng vị thế khi /api/bot-stop
+BOT_STOP_DEADLINE = float(os.getenv("BOT_STOP_DEADLINE", "20"))
+BOT_POOL = None
+BOT_OWNER = False
+_bot_owner_handle = None
+
+
+def acquire_bot_owner_lock() -> bool:
+    """Giữ khóa sở hữu bot suốt đời tiến trình; False nếu tiến trình khác đang giữ"""
+    global _bot_owner_handle
+    if _bot_owner_handle is not None:
+        return True
+    if engine.dialect.name == "postgresql":
+        # Khóa gắn với phiên: giữ riêng 1 kết nối, không trả về pool
+        conn = engine.connect()
+        if not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": BOT_OWNER_LOCK_KEY}).scalar():
+            conn.close()
+            return False
+        _bot_owner_handle = conn
+        return True
+
+    import fcntl
+
+    lock_file = open(BOT_OWNER_LOCK, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _bot_owner_handle = lock_file
+    return True
+
+
+def bot_pool_authkey() -> bytes:
+    # authkey suy ra từ AUTH_SECRET để mọi tiến trình web gắn được vào cùng bộ worker
+    return hashlib.sha256(f"bot-pool|{AUTH_SECRET}".encode()).digest()
+
+
+def launch_bot_supervisor():
+    """Chạy `main.py bot-workers` thành tiến trình riêng (session mới): web thoát không kéo worker theo.
+
+    Nhiều tiến trình web cùng gọi cũng không sao - bản thừa không lấy được khóa sở hữu bot và tự thoát.
+    """
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "bot-workers"],
+        stdin=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+@app.on_event("startup")
+def start_bot_pool():
+    global BOT_POOL, BOT_OWNER
+    if BOT_WORKERS > 0:
+        from trading_bot_lib import BotWorkerPool
+
+        BOT_POOL = BotWorkerPool(BOT_WORKERS, authkey=bot_pool_authkey())
+        if BOT_WORKERS_AUTOSTART and not BOT_POOL.ping(0):
+            launch_bot_supervisor()
+            BOT_POOL.start(timeout=20)
+        else:
+            BOT_POOL.start()
+    elif not BOT_IN_PROCESS_REFUSED:
+        BOT_OWNER = acquire_bot_owner_lock()
+        if not BOT_OWNER:
+            print("⚠ Tiến trình khác đang sở hữu bot (BOT_WORKERS = 0): tiến trình này không chạy bot")
+
+
+@app.on_event("shutdown")
+def stop_bot_pool():
+    # Chỉ đóng kết nối: worker thuộc tiến trình giám sát, các tiến trình web khác vẫn dùng
+    if BOT_POOL is not None:
+        BOT_POOL.stop()
+
+
+BOT_MANAGER_LOCKS: Dict[int, threading.Lock] = defaultdict(threading.Lock)
+
+
+def get_bm(user: CachedUser) -> BotManager:
+    """Lấy BotManager đã tồn tại, hoặc khởi tạo mới (khóa theo user: restore + request song song không tạo trùng)."""
+    with BOT_MANAGER_LOCKS[user.id]:
+        bm = BOT_MANAGERS.get(user.id)
+        if bm is None:
+            if not (user.api_key and user.api_secret):
+                raise HTTPException(400, "User chưa cấu hình API Binance")
+            bm = BotManager(api_key=user.api_key, api_secret=user.api_secret)
+            BOT_MANAGERS[user.id] = bm
+        return bm
 
-def restore_bots(user: User, bm: BotManager, db: Session):
-    """Khôi phục bot từ DB vào RAM (nếu cần). Hiện tại mình chỉ dùng cấu hình + start thủ công."""
-    configs = db.query(BotConfig).filter(BotConfig.user_id == user.id).all()
+
+def start_user_bot(user: CachedUser, **bot_kwargs) -> bool:
+    """Thêm bot cho user - chạy trong worker sở hữu user (BOT_WORKERS > 0) hoặc ngay trong tiến trình."""
+    if BOT_POOL is None:
+        if not BOT_OWNER:
+            raise HTTPException(503, "Tiến trình này không sở hữu bot - hãy đặt BOT_WORKERS > 0 khi chạy nhiều worker web")
+        return get_bm(user).add_bot(**bot_kwargs)
+
+    if not (user.api_key and user.api_secret):
+        raise HTTPException(400, "User chưa cấu hình API Binance")
+    try:
+        return BOT_POOL.start_bot(user.id, user.api_key, user.api_secret, **bot_kwargs)
+    except Exception as e:
+        print(f"❌ Lỗi start bot qua worker cho user {user.id}: {e}")
+        return False
+
+
+def config_bot_kwargs(cfg) -> dict:
+    """Tham số add_bot từ 1 BotConfig; bot_id cố định theo id cấu hình để restart khôi phục đúng bot"""
+    prefix = "STATIC" if cfg.bot_mode == "static" and cfg.symbol else "DYNAMIC"
+    return {
+        "symbol": cfg.symbol,
+        "lev": cfg.lev,
+        "percent": cfg.percent,
+        "tp": cfg.tp,
+        "sl": cfg.sl,
+        "roi_trigger": cfg.roi_trigger,
+        "bot_mode": cfg.bot_mode,
+        "bot_count": cfg.bot_count,
+        "strategy_type": "RSI-volume-auto",
+        "bot_id": f"{prefix}_RSI-volume-auto_{cfg.id}",
+    }
+
+
+def mark_bot_running(db: Session, user_id: int, config_id: int):
+    exists = (
+        db.query(RunningBot)
+        .filter(RunningBot.user_id == user_id, RunningBot.config_id == config_id)
+        .first()
+    )
+    if not exists:
+        db.add(RunningBot(user_id=user_id, config_id=config_id, started_at=time.time()))
+        db.commit()
+
+
+def clear_running_bots(db: Session, user_id: int):
+    db.query(RunningBot).filter(RunningBot.user_id == user_id).delete()
+    db.commit()
+
+
+def get_user_bot_runtime(user_id: int) -> dict:
+    """Trạng thái bot đang chạy của user: running / bot_count / active_symbols / symbol_owners."""
+    stopped = {"running": False, "bot_count": 0, "bot_ids": [], "active_symbols": [], "symbol_owners": {}}
+    if BOT_POOL is not None:
+        try:
+            return BOT_POOL.status(user_id)
+        except Exception as e:
+            print(f"⚠ Lỗi đọc trạng thái bot từ worker: {e}")
+            return stopped
+
+    bm = BOT_MANAGERS.get(user_id)
+    if not bm or not getattr(bm, "bots", None):
+        # Không có bot trong memory
+        return stopped
+    try:
+        return bm.get_runtime_status()
+    except Exception as e:
+        print(f"⚠ Lỗi đọc active_symbols: {e}")
+        return stopped
+
+
+# ==================== KHÔI PHỤC BOT KHI KHỞI ĐỘNG ====================
+RESTORE_BOTS_ON_BOOT = os.getenv("RESTORE_BOTS_ON_BOOT", "1") == "1"
+RESTORE_CONCURRENCY = int(os.getenv("RESTORE_CONCURRENCY", "8"))
+# Khoảng cách tối thiểu (giây) giữa 2 lần start bot trên toàn hệ thống - giãn tải lên API Binance
+RESTORE_STAGGER = float(os.getenv("RESTORE_STAGGER", "0.25"))
+RESTORE_PROGRESS = {
+    "state": "idle",
+    "users": 0,
+    "total": 0,
+    "done": 0,
+    "ok": 0,
+    "already_running": 0,
+    "failed": 0,
+    "elapsed": 0.0,
+}
+RESTORE_LOCK = threading.Lock()
+
+
+class StaggerGate:
+    """Cấp lượt theo nhịp cố định cho nhiều luồng (mỗi lượt cách nhau ít nhất `interval` giây)"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _restore_user_bots(user: CachedUser, configs: list, gate: StaggerGate, started: float):
     for cfg in configs:
+        gate.wait()
+        bot_kwargs = config_bot_kwargs(cfg)
         try:
-            # Nếu muốn auto start tất cả bot theo DB khi login thì bật đoạn này:
-            # bm.add_bot(
-            #     symbol=cfg.symbol,
-            #     lev=cfg.lev,
-            #     percent=cfg.percent,
-            #     tp=cfg.tp,
-            #     sl=cfg.sl,
-            #     roi_trigger=cfg.roi_trigger,
-            #     bot_mode=cfg.bot_mode,
-            #     bot_count=cfg.bot_count,
-            #     strategy_type="RSI-volume-auto",
-            # )
-            pass
+            result = "ok" if start_user_bot(user, **bot_kwargs) else "failed"
         except Exception as e:
-            print("⚠ restore_bots lỗi:", e)
+            print(f"⚠ Lỗi khôi phục bot cfg={cfg.id} user={user.id}: {e}")
+            result = "failed"
+        # add_bot trả False cả khi bot_id đã chạy (vd. /api/bot-start song song) → không tính là lỗi
+        if result == "failed" and bot_kwargs["bot_id"] in get_user_bot_runtime(user.id).get("bot_ids", ()):
+            result = "already_running"
+        with RESTORE_LOCK:
+            RESTORE_PROGRESS["done"] += 1
+            RESTORE_PROGRESS[result] += 1
+            RESTORE_PROGRESS["elapsed"] = round(time.time() - started, 2)
+            done, total = RESTORE_PROGRESS["done"], RESTORE_PROGRESS["total"]
+        label = {"ok": "OK", "already_running": "ĐANG CHẠY", "failed": "LỖI"}[result]
+        print(f"♻️ Khôi phục bot {done}/{total}: user={user.id} cfg={cfg.id} {label}")
+
+
+def restore_bots(worker: Optional[int] = None):
+    """Dựng lại bot của mọi user từ running_bots: song song theo user, start giãn nhịp toàn cục
+
+    worker: chỉ dựng lại user thuộc shard của bot worker đó (worker vừa được dựng lại sau khi chết).
+    """
+    started = time.time()
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(RunningBot, BotConfig, User)
+            .join(BotConfig, BotConfig.id == RunningBot.config_id)
+            .join(User, User.id == RunningBot.user_id)
+            .order_by(RunningBot.started_at)
+            .all()
+        )
+        by_user: Dict[int, tuple] = {}
+        for _run, cfg, user in rows:
+            if not (user.api_key and user.api_secret):
+                continue
+            if worker is not None and BOT_POOL.worker_for(user.id) != worker:
+                continue
+            entry = by_user.setdefault(user.id, (CachedUser.from_row(user), []))
+            entry[1].append(CachedBotConfig.from_row(cfg))
+    finally:
+        db.close()
+
+    with RESTORE_LOCK:
+        RESTORE_PROGRESS.update(
+            state="running",
+            users=len(by_user),
+            total=sum(len(c) for _, c in by_user.values()),
+            done=0,
+            ok=0,
+            already_running=0,
+            failed=0,
+            elapsed=0.0,
+        )
+    print(f"♻️ Bắt đầu khôi phục {RESTORE_PROGRESS['total']} bot của {len(by_user)} user")
+
+    gate = StaggerGate(RESTORE_STAGGER)
+    if by_user:
+        with ThreadPoolExecutor(max_workers=max(1, RESTORE_CONCURRENCY)) as ex:
+            for user, configs in by_user.values():
+                ex.submit(_restore_user_bots, user, configs, gate, started)
+
+    with RESTORE_LOCK:
+        RESTORE_PROGRESS["state"] = "done"
+        RESTORE_PROGRESS["elapsed"] = round(time.time() - started, 2)
+    print(
+        f"♻️ Khôi phục xong: {RESTORE_PROGRESS['ok']} OK, {RESTORE_PROGRESS['already_running']} đang chạy, "
+        f"{RESTORE_PROGRESS['failed']} lỗi "
+        f"trong {RESTORE_PROGRESS['elapsed']}s"
+    )
 
 
-def get_bm(user: User, db: Session) -> BotManager:
-    """Lấy BotManager đã tồn tại, hoặc khởi tạo mới."""
-    bm = BOT_MANAGERS.get(user.id)
-    if bm is None:
-        if not (user.api_key and user.api_secret):
-            raise HTTPException(400, "User chưa cấu hình API Binance")
-        bm = BotManager(api_key=user.api_key, api_secret=user.api_secret)
-        BOT_MANAGERS[user.id] = bm
-        restore_bots(user, bm, db)
-    return bm
+@app.on_event("startup")
+def start_restore_bots():
+    # Chạy nền: server nhận request ngay, bot được dựng lại song song
+    # BOT_WORKERS > 0: tiến trình giám sát bot worker tự khôi phục từng shard (run_bot_workers);
+    # BOT_WORKERS = 0: chỉ tiến trình web giữ khóa sở hữu bot khôi phục
+    if BOT_IN_PROCESS_REFUSED:
+        with RESTORE_LOCK:
+            RESTORE_PROGRESS["state"] = "refused"
+        return
+    if RESTORE_BOTS_ON_BOOT and BOT_WORKERS == 0 and BOT_OWNER:
+        threading.Thread(target=restore_bots, name="restore-bots", daemon=True).start()
+
+
+def run_bot_workers():
+    """`python main.py bot-workers`: tiến trình giám sát sở hữu các bot worker (BOT_WORKERS > 0)
+
+    Khóa sở hữu bot đảm bảo chỉ 1 tiến trình giám sát; worker dựng (lại) xong thì nạp lại bot
+    của shard đó từ running_bots.
+    """
+    global BOT_POOL, BOT_OWNER
+    import signal
+    from trading_bot_lib import BotWorkerPool
+
+    if BOT_WORKERS <= 0:
+        print("⚠ BOT_WORKERS = 0: bot chạy trong tiến trình web, không cần bot-workers")
+        return
+    if not acquire_bot_owner_lock():
+        print("🧩 Đã có tiến trình giám sát bot worker khác, thoát")
+        return
+    BOT_OWNER = True
+
+    BOT_POOL = BotWorkerPool(BOT_WORKERS, authkey=bot_pool_authkey())
+    signal.signal(signal.SIGTERM, lambda *_: BOT_POOL.stop())
+    signal.signal(signal.SIGINT, lambda *_: BOT_POOL.stop())
+    booted = set()
+
+    def on_worker_start(worker: int):
+        # Lần đầu theo RESTORE_BOTS_ON_BOOT; dựng lại sau khi chết thì luôn nạp lại shard
+        if worker in booted or RESTORE_BOTS_ON_BOOT:
+            restore_bots(worker)
+        booted.add(worker)
+
+    BOT_POOL.supervise(on_start=on_worker_start)
+
+
+@app.get("/api/restore-status")
+def restore_status(current: CachedUser = Depends(get_current_user)):
+    with RESTORE_LOCK:
+        return dict(RESTORE_PROGRESS)
 
 
 # ==================== AUTH API ====================
@@ -247,6 +804,7 @@ def register(payload: RegisterReq, db: Session = Depends(get_db)):
     db.add(user)
     db.commit()
     db.refresh(user)
+    user_cache.put_user(user)
     token = create_token(user.id)
     return {"token": token, "username": user.username}
 
@@ -263,12 +821,13 @@ def login(payload: LoginReq, db: Session = Depends(get_db)):
     )
     if not user:
         raise HTTPException(401, "Sai username hoặc password")
+    user_cache.put_user(user)
     token = create_token(user.id)
     return {"token": token, "username": user.username}
 
 
 @app.get("/api/me")
-def me(current: User = Depends(get_current_user)):
+def me(current: CachedUser = Depends(get_current_user)):
     return {
         "id": current.id,
         "username": current.username,
@@ -278,26 +837,27 @@ def me(current: User = Depends(get_current_user)):
 
 # ==================== SETUP BINANCE API ====================
 @app.get("/api/setup-account")
-def get_setup(current: User = Depends(get_current_user)):
+def get_setup(current: CachedUser = Depends(get_current_user)):
     return {"configured": bool(current.api_key and current.api_secret)}
 
 
 @app.post("/api/setup-account")
 def setup(
     payload: SetupReq,
-    current: User = Depends(get_current_user),
+    current: CachedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    current.api_key = payload.api_key
-    current.api_secret = payload.api_secret
-    db.add(current)
+    user = db.query(User).filter(User.id == current.id).first()
+    user.api_key = payload.api_key
+    user.api_secret = payload.api_secret
     db.commit()
+    user_cache.put_user(user)
     return {"ok": True}
 
 
 # ==================== ACCOUNT STATUS (frontend dùng ở afterLogin) ====================
 @app.get("/api/account-status")
-def account_status(current: User = Depends(get_current_user)):
+def account_status(current: CachedUser = Depends(get_current_user)):
     """
     Frontend gọi /api/account-status để quyết định:
     - configured = True => vào Dashboard
@@ -309,15 +869,10 @@ def account_status(current: User = Depends(get_current_user)):
 # ==================== BOT CONFIG (khớp /api/bot-config của frontend) ====================
 @app.get("/api/bot-config")
 def get_bot_config(
-    current: User = Depends(get_current_user),
+    current: CachedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    cfg = (
-        db.query(BotConfig)
-        .filter(BotConfig.user_id == current.id)
-        .order_by(BotConfig.id.desc())
-        .first()
-    )
+    cfg = user_cache.get_latest_config(db, current.id)
     if not cfg:
         # Config mặc định nếu chưa lưu gì
         return {
@@ -346,7 +901,7 @@ def get_bot_config(
 @app.post("/api/bot-config")
 def save_bot_config(
     payload: BotConfigReq,
-    current: User = Depends(get_current_user),
+    current: CachedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     cfg = (
@@ -370,72 +925,69 @@ def save_bot_config(
 
     db.commit()
     db.refresh(cfg)
+    user_cache.put_config(cfg)
     return {"ok": True}
 
 
 # ==================== BOT START / STOP / STATUS (khớp frontend) ====================
 @app.post("/api/bot-start")
 def bot_start(
-    current: User = Depends(get_current_user),
+    current: CachedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    cfg = (
-        db.query(BotConfig)
-        .filter(BotConfig.user_id == current.id)
-        .order_by(BotConfig.id.desc())
-        .first()
-    )
+    cfg = user_cache.get_latest_config(db, current.id)
     if not cfg:
         raise HTTPException(400, "Chưa có cấu hình bot, hãy lưu config trước")
 
-    bm = get_bm(current, db)
-    ok = bm.add_bot(
-        symbol=cfg.symbol,
-        lev=cfg.lev,
-        percent=cfg.percent,
-        tp=cfg.tp,
-        sl=cfg.sl,
-        roi_trigger=cfg.roi_trigger,
-        bot_mode=cfg.bot_mode,
-        bot_count=cfg.bot_count,
-        strategy_type="RSI-volume-auto",
-    )
+    ok = start_user_bot(current, **config_bot_kwargs(cfg))
     if not ok:
         raise HTTPException(400, "Không thể khởi tạo bot, xem log server để biết chi tiết")
+    mark_bot_running(db, current.id, cfg.id)
     return {"ok": True}
 
 
 @app.post("/api/bot-stop")
 def bot_stop(
-    current: User = Depends(get_current_user),
+    current: CachedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
     Dừng TẤT CẢ bot của user hiện tại:
-    - Đóng toàn bộ bot (stop_all)
+    - Đóng song song toàn bộ vị thế (stop_all) trong BOT_STOP_DEADLINE giây
     - Xóa luôn BotManager khỏi BOT_MANAGERS để chắc chắn bot_status = False
+    - Trả về báo cáo: vị thế đã đóng, lỗi, quá hạn, thời gian
     """
+    report = None
+    if BOT_POOL is not None:
+        try:
+            report = BOT_POOL.stop_user(current.id, deadline=BOT_STOP_DEADLINE)
+        except Exception as e:
+            print(f"❌ Lỗi stop_all cho user {current.id}: {e}")
+        clear_running_bots(db, current.id)
+        return {"ok": True, "report": report}
+
+    clear_running_bots(db, current.id)
     bm = BOT_MANAGERS.get(current.id)
     if not bm:
         # Không có bot nào đang chạy -> coi như đã dừng
-        return {"ok": True}
+        return {"ok": True, "report": report}
 
     # Dừng tất cả bot trong manager
     try:
-        bm.stop_all()
+        report = bm.stop_all(deadline=BOT_STOP_DEADLINE)
     except Exception as e:
         print(f"❌ Lỗi stop_all cho user {current.id}: {e}")
 
     # Xoá hẳn BotManager khỏi bộ nhớ
+    bm.close()
     BOT_MANAGERS.pop(current.id, None)
 
-    return {"ok": True}
-
+    return {"ok": True, "report": report}
 
 
 @app.get("/api/bot-status")
 def bot_status(
-    current: User = Depends(get_current_user),
+    current: CachedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """
@@ -445,51 +997,25 @@ def bot_status(
     - bot_count: số bot trong BotManager
     - active_symbols: danh sách các symbol bot đang chạy
     """
-    bm = BOT_MANAGERS.get(current.id)
-    cfg = (
-        db.query(BotConfig)
-        .filter(BotConfig.user_id == current.id)
-        .order_by(BotConfig.id.desc())
-        .first()
-    )
+    cfg = user_cache.get_latest_config(db, current.id)
 
     mode = cfg.bot_mode if cfg else "unknown"
     symbol = cfg.symbol if cfg else None
 
-    if not bm or not getattr(bm, "bots", None):
-        # Không có bot trong memory
-        return {
-            "running": False,
-            "mode": mode,
-            "symbol": symbol,
-            "bot_count": 0,
-            "active_symbols": [],
-        }
-
-    # Gom thông tin các bot đang chạy
-    bot_count = len(bm.bots)
-    active_symbols = []
-    try:
-        for bot in bm.bots.values():
-            syms = getattr(bot, "active_symbols", None)
-            if syms:
-                active_symbols.extend(list(syms))
-    except Exception as e:
-        print(f"⚠ Lỗi đọc active_symbols: {e}")
-
+    runtime = get_user_bot_runtime(current.id)
     return {
-        "running": True,
+        "running": runtime["running"],
         "mode": mode,
         "symbol": symbol,
-        "bot_count": bot_count,
-        "active_symbols": active_symbols,
+        "bot_count": runtime["bot_count"],
+        "active_symbols": runtime["active_symbols"],
     }
 
 
 # ==================== (TÙY CHỌN) CÁC API CŨ GIỮ LẠI NẾU MUỐN DÙNG THÊM ====================
 @app.get("/api/summary")
 def summary(
-    current: User = Depends(get_current_user),
+    current: CachedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     configs = db.query(BotConfig).filter(BotConfig.user_id == current.id).all()
@@ -502,7 +1028,7 @@ def summary(
 
 @app.get("/api/bots")
 def get_bots(
-    current: User = Depends(get_current_user),
+    current: CachedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     configs = db.query(BotConfig).filter(BotConfig.user_id == current.id).all()
@@ -527,23 +1053,10 @@ def get_bots(
 @app.post("/api/add-bot")
 def add_bot_old(
     payload: AddBotReq,
-    current: User = Depends(get_current_user),
+    current: CachedUser = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
     """Endpoint cũ, giữ lại nếu bạn muốn quản lý nhiều bot kiểu danh sách riêng."""
-    bm = get_bm(current, db)
-    bm.add_bot(
-        symbol=payload.symbol,
-        lev=payload.lev,
-        percent=payload.percent,
-        tp=payload.tp,
-        sl=payload.sl,
-        roi_trigger=payload.roi_trigger,
-        bot_mode=payload.bot_mode,
-        bot_count=payload.bot_count,
-        strategy_type="RSI-volume-auto",
-    )
-
     cfg = BotConfig(
         user_id=current.id,
         bot_mode=payload.bot_mode,
@@ -558,113 +1071,689 @@ def add_bot_old(
     db.add(cfg)
     db.commit()
     db.refresh(cfg)
+    user_cache.put_config(cfg)
+
+    if start_user_bot(current, **config_bot_kwargs(cfg)):
+        mark_bot_running(db, current.id, cfg.id)
 
     return {"ok": True, "id": cfg.id}
 
 
+# ==================== TELEGRAM WEBHOOK ====================
+@app.post("/api/telegram/webhook/{token_id}")
+def telegram_webhook(
+    token_id: str,
+    update: dict,
+    x_telegram_bot_api_secret_token: Optional[str] = Header(None),
+):
+    """
+    Nhận update Telegram qua webhook (TELEGRAM_MODE=webhook) thay cho getUpdates long-poll.
+    Update chỉ được xếp hàng rồi trả về ngay; BotManager xử lý trong làn riêng của từng chat.
+    """
+    if BOT_POOL is not None:
+        accepted = BOT_POOL.dispatch_telegram_update(token_id, update, x_telegram_bot_api_secret_token)
+    elif telegram_router is not None:
+        accepted = telegram_router.dispatch(token_id, update, x_telegram_bot_api_secret_token)
+    else:
+        accepted = False
+    if not accepted:
+        raise HTTPException(403, "Webhook không hợp lệ")
+    return {"ok": True}
+
+
+# ==================== PRICE HUB ====================
+# 1 luồng giá Binance cho mỗi symbol, dùng chung cho mọi client đang xem symbol đó
+PRICE_PUSH_INTERVAL = float(os.getenv("PRICE_PUSH_INTERVAL", "0.25"))
+# Giữ luồng upstream thêm vài giây sau khi client cuối rời đi (đổi symbol qua lại không phải nối lại)
+PRICE_STREAM_LINGER = float(os.getenv("PRICE_STREAM_LINGER", "10"))
+
+
+class PriceSubscription:
+    """Hộp thư của 1 client: chỉ giữ giá mới nhất của mỗi symbol.
+
+    Hub chỉ ghi đè giá + bật event nên không bao giờ bị client chậm chặn lại;
+    các tick đến trong lúc client đang gửi dở được gộp thành 1 (conflation).
+    """
+
+    def __init__(self):
+        self.symbols = set()
+        self.pending: Dict[str, tuple] = {}
+        self.event = asyncio.Event()
+
+    def push(self, symbol: str, price: float, ts: float):
+        self.pending[symbol] = (price, ts)
+        self.event.set()
+
+    async def next_batch(self) -> Dict[str, tuple]:
+        await self.event.wait()
+        self.event.clear()
+        batch, self.pending = self.pending, {}
+        return batch
+
+
+# Độ phân giải lịch sử giá: tên -> (bước giây, số ô ring buffer)
+PRICE_HISTORY_RESOLUTIONS = {"1s": (1, 900), "5s": (5, 720), "1m": (60, 720)}
+PRICE_HISTORY_MAX_SYMBOLS = int(os.getenv("PRICE_HISTORY_MAX_SYMBOLS", "200"))
+
+
+class PriceRing:
+    """Ring buffer NumPy (thời điểm bucket, giá đóng bucket) cho 1 độ phân giải"""
+
+    def __init__(self, step: int, size: int):
+        self.step = step
+        self.size = size
+        self.times = np.zeros(size, dtype=np.int64)
+        self.prices = np.zeros(size, dtype=np.float64)
+        self.head = -1
+        self.count = 0
+
+    def add(self, ts: float, price: float):
+        bucket = int(ts // self.step) * self.step
+        if self.count:
+            last = self.times[self.head]
+            if bucket == last:
+                self.prices[self.head] = price
+                return
+            if bucket < last:
+                return
+        self.head = (self.head + 1) % self.size
+        self.times[self.head] = bucket
+        self.prices[self.head] = price
+        self.count = min(self.count + 1, self.size)
+
+    def tail(self, limit: int):
+        n = max(0, min(limit, self.count))
+        idx = np.arange(self.head - n + 1, self.head + 1) % self.size
+        return self.times[idx], self.prices[idx]
+
+
+class PriceHistory:
+    """Lịch sử giá gần đây theo symbol ở nhiều độ phân giải, dùng chung cho mọi client.
+
+    Được price hub ghi trên event loop; symbol lâu không cập nhật bị loại khi vượt giới hạn.
+    """
+
+    def __init__(self, resolutions=PRICE_HISTORY_RESOLUTIONS, max_symbols: int = PRICE_HISTORY_MAX_SYMBOLS):
+        self.resolutions = resolutions
+        self.max_symbols = max_symbols
+        self._rings: "OrderedDict[str, Dict[str, PriceRing]]" = OrderedDict()
+
+    def add(self, symbol: str, ts: float, price: float):
+        rings = self._rings.get(symbol)
+        if rings is None:
+            rings = {name: PriceRing(step, size) for name, (step, size) in self.resolutions.items()}
+            self._rings[symbol] = rings
+            while len(self._rings) > self.max_symbols:
+                self._rings.popitem(last=False)
+        else:
+            self._rings.move_to_end(symbol)
+        for ring in rings.values():
+            ring.add(ts, price)
+
+    def get(self, symbol: str, resolution: str, limit: int):
+        rings = self._rings.get(symbol)
+        if rings is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+        return rings[resolution].tail(limit)
+
+
+price_history = PriceHistory()
+
+
+class PriceHub:
+    """Fan-out giá realtime: đếm client theo symbol, mở/đóng luồng Binance theo nhu cầu.
+
+    Mọi thao tác subscribe/publish chạy trên event loop; luồng upstream (WebSocketManager
+    hoặc poller REST khi thiếu trading_bot_lib) chỉ đẩy giá qua call_soon_threadsafe.
+    """
+
+    def __init__(self, linger: float = PRICE_STREAM_LINGER):
+        self.linger = linger
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscribers: Dict[str, set] = {}
+        self._last: Dict[str, tuple] = {}
+        self._upstreams = set()
+        self._release_handles: Dict[str, asyncio.TimerHandle] = {}
+        self._ws_manager = WebSocketManager() if WebSocketManager is not None else None
+        # Mở/đóng stream upstream chạy tuần tự trên 1 thread: đóng rồi mở lại cùng symbol luôn đúng thứ tự
+        self._upstream_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="price-upstream")
+        self._generation: Dict[str, int] = {}
+
+    def subscribe(self, sub: PriceSubscription, symbol: str):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        symbol = symbol.upper()
+        if symbol in sub.symbols:
+            return
+        sub.symbols.add(symbol)
+        self._subscribers.setdefault(symbol, set()).add(sub)
+
+        handle = self._release_handles.pop(symbol, None)
+        if handle is not None:
+            handle.cancel()
+        if symbol not in self._upstreams:
+            self._start_upstream(symbol)
+        elif symbol in self._last:
+            sub.push(symbol, *self._last[symbol])
+
+    def unsubscribe(self, sub: PriceSubscription, symbol: str):
+        symbol = symbol.upper()
+        sub.symbols.discard(symbol)
+        sub.pending.pop(symbol, None)
+        subs = self._subscribers.get(symbol)
+        if subs is None:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._subscribers[symbol]
+            self._release_handles[symbol] = self.loop.call_later(
+                self.linger, self._stop_upstream, symbol
+            )
+
+    def unsubscribe_all(self, sub: PriceSubscription):
+        for symbol in list(sub.symbols):
+            self.unsubscribe(sub, symbol)
+
+    def close(self):
+        for handle in self._release_handles.values():
+            handle.cancel()
+        self._release_handles.clear()
+        self._upstreams.clear()
+        self._upstream_executor.shutdown(wait=False)
+        if self._ws_manager is not None:
+            self._ws_manager.stop()
+
+    def _start_upstream(self, symbol: str):
+        self._upstreams.add(symbol)
+        generation = self._generation[symbol] = self._generation.get(symbol, 0) + 1
+        if self._ws_manager is not None:
+            self._upstream_executor.submit(
+                self._ws_manager.add_symbol, symbol, lambda price, s=symbol: self._on_price(s, price)
+            )
+        else:
+            threading.Thread(target=self._poll_upstream, args=(symbol, generation), daemon=True).start()
+        print(f"📡 Price hub: mở luồng giá {symbol}")
+
+    def _stop_upstream(self, symbol: str):
+        self._release_handles.pop(symbol, None)
+        if self._subscribers.get(symbol) or symbol not in self._upstreams:
+            return
+        self._upstreams.discard(symbol)
+        self._last.pop(symbol, None)
+        generation = self._generation[symbol] = self._generation.get(symbol, 0) + 1
+        if self._ws_manager is not None:
+            # đóng socket có thể chặn vài trăm ms -> không chạy trên event loop
+            self._upstream_executor.submit(self._remove_upstream, symbol, generation)
+        print(f"📡 Price hub: đóng luồng giá {symbol}")
+
+    def _remove_upstream(self, symbol: str, generation: int):
+        # Client quay lại trước khi tới lượt đóng → lệnh mở mới đã xếp sau, không đóng stream
+        if self._generation.get(symbol) != generation:
+            return
+        self._ws_manager.remove_symbol(symbol)
+
+    def _poll_upstream(self, symbol: str, generation: int):
+        """Dự phòng khi không có trading_bot_lib: 1 poller REST cho mỗi symbol (không phải mỗi client)"""
+        while self._generation.get(symbol) == generation:
+            try:
+                resp = requests.get(
+                    f"{BINANCE_FAPI_URL}/fapi/v1/ticker/price",
+                    params={"symbol": symbol},
+                    timeout=5,
+                )
+                resp.raise_for_status()
+                self._on_price(symbol, float(resp.json().get("price", 0.0)))
+                time.sleep(1)
+            except Exception as e:
+                print(f"❌ Binance price error for {symbol}: {e}")
+                time.sleep(3)
+
+    def _on_price(self, symbol: str, price: float):
+        # Gọi từ luồng upstream
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._publish, symbol, price, time.time())
+
+    def _publish(self, symbol: str, price: float, ts: float):
+        if symbol not in self._upstreams:
+            return
+        self._last[symbol] = (price, ts)
+        price_history.add(symbol, ts, price)
+        for sub in self._subscribers.get(symbol, ()):
+            sub.push(symbol, price, ts)
+
+
+price_hub = PriceHub()
+
+
+@app.on_event("shutdown")
+def stop_price_hub():
+    price_hub.close()
+
+
+@app.get("/api/price-history")
+async def price_history_backfill(
+    symbol: str,
+    resolution: str = "1s",
+    limit: int = 300,
+    current: CachedUser = Depends(get_current_user),
+):
+    """Backfill biểu đồ từ bộ nhớ server (không gọi Binance): t = epoch giây, p = giá đóng mỗi bucket"""
+    if resolution not in PRICE_HISTORY_RESOLUTIONS:
+        raise HTTPException(400, f"resolution phải là một trong {list(PRICE_HISTORY_RESOLUTIONS)}")
+    times, prices = price_history.get(symbol.upper(), resolution, limit)
+    return {
+        "symbol": symbol.upper(),
+        "resolution": resolution,
+        "t": times.tolist(),
+        "p": np.round(prices, 4).tolist(),
+    }
+
+
+async def _drain_client(ws: WebSocket):
+    """Đọc (và bỏ qua) tin nhắn từ client để phát hiện ngắt kết nối kịp thời"""
+    while True:
+        await ws.receive_text()
+
+
+async def _run_until_disconnect(*coros):
+    """Chạy song song các coroutine của 1 socket, dừng tất cả khi 1 cái kết thúc"""
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+    for task in done:
+        exc = task.exception()
+        if exc is not None:
+            raise exc
+
+
+# ==================== ACCOUNT HUB ====================
+# 1 poller /fapi/v2/account cho mỗi user, dùng chung cho mọi tab /ws/pnl của user đó
+ACCOUNT_POLL_INTERVAL = float(os.getenv("ACCOUNT_POLL_INTERVAL", "3"))
+
+
+class AccountSubscription:
+    """Hộp thư của 1 socket PnL: chỉ giữ trạng thái tài khoản mới nhất"""
+
+    def __init__(self):
+        self.latest: Optional[dict] = None
+        self.event = asyncio.Event()
+
+    def push(self, payload: dict):
+        self.latest = payload
+        self.event.set()
+
+    async def next(self) -> dict:
+        await self.event.wait()
+        self.event.clear()
+        return self.latest
+
+
+class AccountHub:
+    """Mỗi user 1 task poll (lệnh ký chạy trong threadpool, không chặn event loop).
+
+    Chỉ đẩy khi số dư / PnL thay đổi; task dừng khi socket cuối của user đóng.
+    """
+
+    def __init__(self, interval: float = ACCOUNT_POLL_INTERVAL):
+        self.interval = interval
+        self._streams: Dict[int, dict] = {}
+
+    def subscribe(self, user_id: int, api_key: str, api_secret: str, sub: AccountSubscription):
+        stream = self._streams.get(user_id)
+        if stream is None:
+            stream = {"subscribers": set(), "last": None, "credentials": (api_key, api_secret)}
+            self._streams[user_id] = stream
+            stream["task"] = asyncio.ensure_future(self._poll(user_id, stream))
+        else:
+            stream["credentials"] = (api_key, api_secret)
+        stream["subscribers"].add(sub)
+        if stream["last"] is not None:
+            sub.push(stream["last"])
+
+    def unsubscribe(self, user_id: int, sub: AccountSubscription):
+        stream = self._streams.get(user_id)
+        if stream is None:
+            return
+        stream["subscribers"].discard(sub)
+        if not stream["subscribers"]:
+            stream["task"].cancel()
+            del self._streams[user_id]
+
+    def snapshot(self, user_id: int) -> Optional[dict]:
+        """Trạng thái mới nhất trong bộ nhớ (None nếu user chưa có stream đang chạy)"""
+        stream = self._streams.get(user_id)
+        return stream["last"] if stream else None
+
+    @staticmethod
+    def _build_payload(state: Optional[dict], owners: Dict[str, str]) -> dict:
+        if state is None:
+            return {"error": "Không lấy được số dư từ Binance"}
+        return {
+            "balance": round(float(state["balance"]), 2),
+            "wallet_balance": round(float(state.get("wallet_balance", 0.0)), 2),
+            "total_unrealized_pnl": round(float(state.get("total_unrealized_pnl", 0.0)), 2),
+            "positions": [
+                {
+                    "symbol": p["symbol"],
+                    "side": p["side"],
+                    "qty": p["qty"],
+                    "entry_price": p["entry_price"],
+                    "mark_price": round(float(p.get("mark_price", 0.0)), 4),
+                    "unrealized_pnl": round(float(p["unrealized_pnl"]), 2),
+                    "bot_id": owners.get(p["symbol"]),
+                }
+                for p in state.get("positions", [])
+            ],
+        }
+
+    async def load(self, user_id: int, api_key: str, api_secret: str) -> dict:
+        """1 lượt đọc tài khoản + bot sở hữu từng coin, chạy trong threadpool"""
+        loop = asyncio.get_running_loop()
+        try:
+            state = await loop.run_in_executor(None, get_account_state, api_key, api_secret)
+        except Exception as e:
+            print(f"❌ Account poll error user={user_id}: {e}")
+            state = None
+        try:
+            runtime = await loop.run_in_executor(None, get_user_bot_runtime, user_id)
+            owners = runtime.get("symbol_owners") or {}
+        except Exception:
+            owners = {}
+        return self._build_payload(state, owners)
+
+    async def _poll(self, user_id: int, stream: dict):
+        last_body = None
+        while True:
+            body = await self.load(user_id, *stream["credentials"])
+            if body != last_body:
+                last_body = body
+                payload = dict(body, timestamp=int(time.time()))
+                stream["last"] = payload
+                for sub in list(stream["subscribers"]):
+                    sub.push(payload)
+            await asyncio.sleep(self.interval)
+
+
+account_hub = AccountHub()
+
+
 # ==================== WEBSOCKET: GIÁ & PnL ====================
+# Số symbol tối đa 1 socket /ws/market được theo dõi
+MARKET_MAX_SYMBOLS = int(os.getenv("MARKET_MAX_SYMBOLS", "50"))
+
+
+def filter_market_symbols(symbols):
+    """Chỉ giữ symbol futures đang giao dịch (exchangeInfo) - chặn client mở luồng Binance tùy ý"""
+    symbols = [x for x in symbols if x.isalnum() and len(x) <= 20]
+    if market_universe is None:
+        return symbols
+    return [x for x in symbols if market_universe.contains(x)]
+
+
 @app.websocket("/ws/price")
 async def ws_price(ws: WebSocket, token: Optional[str] = None, symbol: str = "BTCUSDT"):
     """
-    WebSocket giá realtime: backend lấy giá Futures từ Binance rồi đẩy ra frontend.
+    WebSocket giá realtime: đọc giá từ price hub (1 luồng Binance/symbol dùng chung) rồi đẩy ra frontend.
 
     - Frontend gọi: /ws/price?token=...&symbol=BTCUSDT
-    - symbol: coin do người dùng nhập (BTCUSDT, ETHUSDT, XRPUSDT, ...)
+    - symbol: coin do người dùng nhập (BTCUSDT, ETHUSDT, XRPUSDT, ...); symbol không có trên sàn → đóng 4003
+    - Cần token đăng nhập như /ws/market
     """
     await ws.accept()
+    if not decode_token(token):
+        await ws.send_json({"error": "Token không hợp lệ hoặc đã hết hạn"})
+        await ws.close(code=4001)
+        return
     symbol = (symbol or "BTCUSDT").upper()
-    print(f"📡 WS /ws/price start for symbol={symbol}")
+    if not await run_in_threadpool(filter_market_symbols, [symbol]):
+        await ws.send_json({"error": f"Symbol không hợp lệ: {symbol}"})
+        await ws.close(code=4003)
+        return
+    logger.info(f"📡 WS /ws/price start for symbol={symbol}")
+    sub = PriceSubscription()
+    price_hub.subscribe(sub, symbol)
+
+    async def sender():
+        while True:
+            batch = await sub.next_batch()
+            if symbol not in batch:
+                continue
+            price, ts = batch[symbol]
+            await ws.send_json(
+                {
+                    "symbol": symbol,
+                    "price": round(price, 4),
+                    "timestamp": int(ts),
+                }
+            )
+            # giới hạn tần suất đẩy; tick đến trong lúc chờ được gộp lại
+            await asyncio.sleep(PRICE_PUSH_INTERVAL)
+
     try:
+        await _run_until_disconnect(sender(), _drain_client(ws))
+    except WebSocketDisconnect:
+        logger.info("🔌 Client đóng WebSocket /ws/price")
+    except Exception as e:
+        logger.error(f"❌ WS error /ws/price: {e}")
+    finally:
+        price_hub.unsubscribe_all(sub)
+
+
+@app.websocket("/ws/market")
+async def ws_market(ws: WebSocket, token: Optional[str] = None):
+    """
+    WebSocket giá nhiều symbol trên 1 kết nối (thay cho mở lại /ws/price mỗi lần đổi coin).
+
+    - Client gửi: {"op": "subscribe", "symbols": ["BTCUSDT", ...]}
+                  {"op": "unsubscribe", "symbols": ["BTCUSDT"]}
+    - Server xác nhận: {"type": "subscribed", "symbols": [...danh sách hiện tại...]}
+    - Server gửi theo khung (PRICE_PUSH_INTERVAL), chỉ symbol có giá đổi so với khung trước:
+        {"type": "prices", "t": 1700000000, "d": {"BTCUSDT": 65000.1, "ETHUSDT": 3400.5}}
+    - Cần token đăng nhập như /ws/pnl; symbol không có trên sàn bị bỏ qua.
+    """
+    await ws.accept()
+    if not decode_token(token):
+        await ws.send_json({"error": "Token không hợp lệ hoặc đã hết hạn"})
+        await ws.close(code=4001)
+        return
+    sub = PriceSubscription()
+    last_sent: Dict[str, float] = {}
+
+    async def sender():
+        while True:
+            batch = await sub.next_batch()
+            frame = {}
+            ts = 0.0
+            for sym, (price, price_ts) in batch.items():
+                price = round(price, 4)
+                if sym in sub.symbols and last_sent.get(sym) != price:
+                    frame[sym] = price
+                    last_sent[sym] = price
+                    ts = max(ts, price_ts)
+            if frame:
+                await ws.send_json({"type": "prices", "t": int(ts), "d": frame})
+            await asyncio.sleep(PRICE_PUSH_INTERVAL)
+
+    async def receiver():
         while True:
+            raw = await ws.receive_text()
             try:
-                # Gọi Binance Futures ticker
-                resp = requests.get(
-                    "https://fapi.binance.com/fapi/v1/ticker/price",
-                    params={"symbol": symbol},
-                    timeout=5,
-                )
-                resp.raise_for_status()
-                js = resp.json()
-                price = float(js.get("price", 0.0))
-            except Exception as e:
-                # Nếu lỗi, gửi message error nhẹ cho frontend rồi chờ 3s
-                print(f"❌ Binance price error for {symbol}: {e}")
-                await ws.send_json(
-                    {
-                        "error": "BINANCE_PRICE_ERROR",
-                        "message": str(e),
-                        "symbol": symbol,
-                        "timestamp": int(time.time()),
-                    }
-                )
-                await asyncio.sleep(3)
+                msg = json.loads(raw)
+                op = msg.get("op")
+                symbols = [str(x).upper() for x in msg.get("symbols") or []]
+            except (ValueError, AttributeError):
+                await ws.send_json({"type": "error", "message": "Tin nhắn không hợp lệ"})
                 continue
 
-            data = {
-                "symbol": symbol,
-                "price": round(price, 4),
-                "timestamp": int(time.time()),
-            }
-            await ws.send_json(data)
-            # cập nhật mỗi 1s ~ realtime cho biểu đồ
-            await asyncio.sleep(1)
+            if op == "subscribe":
+                symbols = await run_in_threadpool(filter_market_symbols, symbols)
+                for sym in symbols:
+                    if len(sub.symbols) >= MARKET_MAX_SYMBOLS:
+                        break
+                    price_hub.subscribe(sub, sym)
+            elif op == "unsubscribe":
+                for sym in symbols:
+                    price_hub.unsubscribe(sub, sym)
+                    last_sent.pop(sym, None)
+            else:
+                await ws.send_json({"type": "error", "message": f"op không hỗ trợ: {op}"})
+                continue
+            await ws.send_json({"type": "subscribed", "symbols": sorted(sub.symbols)})
+
+    try:
+        await _run_until_disconnect(sender(), receiver())
     except WebSocketDisconnect:
-        print("🔌 Client đóng WebSocket /ws/price")
+        logger.info("🔌 Client đóng WebSocket /ws/market")
     except Exception as e:
-        print("❌ WS error /ws/price:", e)
+        logger.error(f"❌ WS error /ws/market: {e}")
+    finally:
+        price_hub.unsubscribe_all(sub)
 
 
+def _position_key(p: dict) -> str:
+    return f"{p['symbol']}:{p['side']}"
+
+
+@app.get("/api/positions")
+async def positions_snapshot(current: CachedUser = Depends(get_current_user)):
+    """Snapshot vị thế (JSON) từ account hub; chỉ gọi Binance khi user chưa có stream nào đang chạy"""
+    if not current.api_key or not current.api_secret:
+        raise HTTPException(400, "User chưa cấu hình API Binance")
+    payload = account_hub.snapshot(current.id)
+    if payload is None:
+        payload = dict(
+            await account_hub.load(current.id, current.api_key, current.api_secret),
+            timestamp=int(time.time()),
+        )
+    if "error" in payload:
+        raise HTTPException(502, payload["error"])
+    return {"positions": payload["positions"], "timestamp": payload["timestamp"]}
+
+
+@app.get("/api/trades")
+def trade_history(
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    symbol: Optional[str] = None,
+    event: Optional[str] = None,
+    limit: int = 500,
+    current: CachedUser = Depends(get_current_user),
+):
+    """Nhật ký giao dịch của tài khoản user trong khoảng [start, end) (epoch giây)"""
+    if trade_journal is None or not current.api_key:
+        return {"trades": []}
+    trades = trade_journal.query(
+        start=start,
+        end=end,
+        account=account_tag(current.api_key),
+        symbol=symbol.upper() if symbol else None,
+        event=event.upper() if event else None,
+        limit=max(1, min(limit, 5000)),
+    )
+    return {"trades": trades}
+
+
+@app.websocket("/ws/positions")
+async def ws_positions(ws: WebSocket, token: str):
+    """
+    WebSocket vị thế realtime (chung nguồn với /ws/pnl qua account hub).
+
+    - Gửi đầu tiên: {"type": "snapshot", "positions": [...], "t": ...}
+    - Sau đó chỉ gửi phần thay đổi:
+        {"type": "update", "changed": [...vị thế mới/đổi...], "removed": ["BTCUSDC:LONG", ...], "t": ...}
+    Mỗi vị thế: symbol, side, qty, entry_price, mark_price, unrealized_pnl, bot_id.
+    """
+    await ws.accept()
+    subscribed = False
+    try:
+        credentials, error = await run_in_threadpool(load_ws_user, token)
+        if error:
+            await ws.send_json({"error": error[1]})
+            await ws.close(code=error[0])
+            return
+        user_id, api_key, api_secret = credentials
+
+        sub = AccountSubscription()
+        account_hub.subscribe(user_id, api_key, api_secret, sub)
+        subscribed = True
+
+        async def sender():
+            sent: Optional[Dict[str, dict]] = None
+            while True:
+                payload = await sub.next()
+                if "error" in payload:
+                    await ws.send_json(payload)
+                    continue
+                current = {_position_key(p): p for p in payload["positions"]}
+                if sent is None:
+                    await ws.send_json(
+                        {"type": "snapshot", "positions": list(current.values()), "t": payload["timestamp"]}
+                    )
+                else:
+                    changed = [p for k, p in current.items() if sent.get(k) != p]
+                    removed = [k for k in sent if k not in current]
+                    if changed or removed:
+                        await ws.send_json(
+                            {"type": "update", "changed": changed, "removed": removed, "t": payload["timestamp"]}
+                        )
+                sent = current
+
+        await _run_until_disconnect(sender(), _drain_client(ws))
+
+    except WebSocketDisconnect:
+        logger.info("🔌 Client đóng WebSocket /ws/positions")
+    except Exception as e:
+        logger.error(f"❌ WS error /ws/positions: {e}")
+    finally:
+        if subscribed:
+            account_hub.unsubscribe(user_id, sub)
+
 
 @app.websocket("/ws/pnl")
 async def ws_pnl(ws: WebSocket, token: str):
     """
-    WebSocket gửi số dư thực từ Binance Futures (thông qua trading_bot_lib.get_balance)
+    WebSocket gửi số dư + PnL từng vị thế từ Binance Futures (account hub, 1 nguồn/user)
     Frontend đang gọi: /ws/pnl?token=authToken
+    Chỉ gửi khi số liệu thay đổi.
     """
     await ws.accept()
-    db: Session = SessionLocal()
+    subscribed = False
     try:
-        uid = TOKEN_STORE.get(token)
-        if not uid:
-            await ws.send_json({"error": "Token không hợp lệ hoặc đã hết hạn"})
-            await ws.close(code=4001)
+        credentials, error = await run_in_threadpool(load_ws_user, token)
+        if error:
+            await ws.send_json({"error": error[1]})
+            await ws.close(code=error[0])
             return
+        user_id, api_key, api_secret = credentials
 
-        user = db.query(User).filter(User.id == uid).first()
-        if not user or not user.api_key or not user.api_secret:
-            await ws.send_json({"error": "User chưa cấu hình API Binance"})
-            await ws.close(code=4002)
-            return
+        sub = AccountSubscription()
+        account_hub.subscribe(user_id, api_key, api_secret, sub)
+        subscribed = True
 
-        while True:
-            bal = get_balance(user.api_key, user.api_secret)
-            if bal is None:
-                await ws.send_json(
-                    {
-                        "error": "Không lấy được số dư từ Binance",
-                        "timestamp": int(time.time()),
-                    }
-                )
-            else:
-                await ws.send_json(
-                    {
-                        "balance": round(float(bal), 2),
-                        "timestamp": int(time.time()),
-                    }
-                )
-            # cập nhật 5 giây/lần để tránh spam API
-            await asyncio.sleep(5)
+        async def sender():
+            while True:
+                await ws.send_json(await sub.next())
+
+        await _run_until_disconnect(sender(), _drain_client(ws))
 
     except WebSocketDisconnect:
-        print("🔌 Client đóng WebSocket /ws/pnl")
+        logger.info("🔌 Client đóng WebSocket /ws/pnl")
     except Exception as e:
-        print("❌ WS error /ws/pnl:", e)
+        logger.error(f"❌ WS error /ws/pnl: {e}")
     finally:
-        db.close()
+        if subscribed:
+            account_hub.unsubscribe(user_id, sub)
 
 
 # ==================== CHẠY LOCAL ====================
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["bot-workers"]:
+        run_bot_workers()
+        sys.exit(0)
+
     import uvicorn
 
     uvicorn.run("main:app", host="0.0.0.0", port=8080, reload=True)
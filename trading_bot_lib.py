@@ -16,17 +16,30 @@ import traceback
 import random
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait
 from collections import defaultdict
 import time
 import ssl
+import bisect
+import queue
+import sqlite3
+import shutil
+import tempfile
+import itertools
+import uuid
+import multiprocessing
+from multiprocessing.connection import Listener, Client, AuthenticationError, deliver_challenge, answer_challenge
+
+# ========== ĐỊA CHỈ BINANCE (CẤU HÌNH ĐƯỢC, VD. TRỎ VỀ binance_simulator) ==========
+BINANCE_FAPI_URL = os.getenv("BINANCE_FAPI_URL", "https://fapi.binance.com").rstrip("/")
+BINANCE_WS_URL = os.getenv("BINANCE_WS_URL", "wss://fstream.binance.com").rstrip("/")
 
 # ========== BYPASS SSL VERIFICATION ==========
 ssl._create_default_https_context = ssl._create_unverified_context
 
 def _last_closed_1m_quote_volume(symbol):
     data = binance_api_request(
-        "https://fapi.binance.com/fapi/v1/klines",
+        f"{BINANCE_FAPI_URL}/fapi/v1/klines",
         params={"symbol": symbol, "interval": "1m", "limit": 2}
     )
     if not data or len(data) < 2:
@@ -58,16 +71,11 @@ def escape_html(text):
                 .replace('>', '&gt;')
                 .replace('"', '&quot;'))
 
-def send_telegram(message, chat_id=None, reply_markup=None, bot_token=None, default_chat_id=None):
-    if not bot_token:
-        logger.warning("Telegram Bot Token chưa được thiết lập")
-        return
-    
-    chat_id = chat_id or default_chat_id
-    if not chat_id:
-        logger.warning("Telegram Chat ID chưa được thiết lập")
-        return
-    
+def _send_telegram_now(message, chat_id, reply_markup=None, bot_token=None):
+    """Gửi ĐỒNG BỘ 1 tin nhắn - chỉ dùng trong luồng gửi của TelegramOutbox
+
+    Trả về số giây cần chờ nếu bị Telegram giới hạn (429), ngược lại None.
+    """
     url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
     
     # ESCAPE MESSAGE ĐỂ TRÁNH LỖI HTML
@@ -80,16 +88,308 @@ def send_telegram(message, chat_id=None, reply_markup=None, bot_token=None, defa
     }
     
     if reply_markup:
-        payload["reply_markup"] = json.dumps(reply_markup)
+        payload["reply_markup"] = reply_markup if isinstance(reply_markup, str) else json.dumps(reply_markup)
     
     try:
         response = requests.post(url, json=payload, timeout=15)
+        if response.status_code == 429:
+            try:
+                retry_after = response.json().get('parameters', {}).get('retry_after', 5)
+            except Exception:
+                retry_after = 5
+            logger.warning(f"Telegram giới hạn tần suất, chờ {retry_after}s")
+            return float(retry_after)
         if response.status_code != 200:
             logger.error(f"Lỗi Telegram ({response.status_code}): {response.text}")
     except Exception as e:
         logger.error(f"Lỗi kết nối Telegram: {str(e)}")
+    return None
+
+# Mức ưu tiên tin nhắn: HIGH không bị bỏ khi quá tải (lệnh giao dịch, phản hồi người dùng)
+TELEGRAM_PRIORITY_HIGH = 0
+TELEGRAM_PRIORITY_LOW = 1
+TELEGRAM_MAX_MESSAGE_LENGTH = 4000
+
+class TelegramOutbox:
+    """Hàng đợi gửi Telegram chạy nền: giới hạn tần suất theo chat, gộp tin nhắn liên tiếp,
+    bỏ tin ưu tiên thấp khi quá tải - luồng giao dịch không bao giờ phải chờ Telegram"""
+    def __init__(self, max_pending=500, per_chat_interval=1.0, global_rate=25, sender_threads=2):
+        self.max_pending = max_pending
+        self.per_chat_interval = per_chat_interval
+        self.global_interval = 1.0 / global_rate
+        self.sender_threads = sender_threads
+        self._queues = defaultdict(list)      # (bot_token, chat_id) -> [(priority, message, reply_markup)]
+        self._next_allowed = defaultdict(float)
+        self._dropped = defaultdict(int)
+        self._in_flight = set()
+        self._pending = 0
+        self._last_global_send = 0
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        for i in range(self.sender_threads):
+            thread = threading.Thread(target=self._sender_loop, name=f"telegram-outbox-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, message, chat_id, reply_markup=None, bot_token=None, priority=TELEGRAM_PRIORITY_HIGH):
+        """Đưa tin nhắn vào hàng đợi - không chặn"""
+        key = (bot_token, str(chat_id))
+        if reply_markup and not isinstance(reply_markup, str):
+            reply_markup = json.dumps(reply_markup)
+        with self._cond:
+            self._ensure_started()
+            if self._pending >= self.max_pending:
+                if priority == TELEGRAM_PRIORITY_LOW or not self._evict_low_priority(key):
+                    self._dropped[key] += 1
+                    return False
+            self._queues[key].append((priority, message, reply_markup))
+            self._pending += 1
+            self._cond.notify()
+        return True
+
+    def _evict_low_priority(self, preferred_key):
+        """Bỏ tin ưu tiên thấp cũ nhất (ưu tiên cùng chat) để nhường chỗ cho tin quan trọng"""
+        keys = [preferred_key] + [k for k in self._queues if k != preferred_key]
+        for key in keys:
+            pending = self._queues.get(key)
+            if not pending:
+                continue
+            for i, item in enumerate(pending):
+                if item[0] == TELEGRAM_PRIORITY_LOW:
+                    del pending[i]
+                    if not pending:
+                        del self._queues[key]
+                    self._pending -= 1
+                    self._dropped[key] += 1
+                    return True
+        return False
+
+    def _take_batch(self, key):
+        """Lấy tin đầu hàng đợi; gộp các tin không có bàn phím liên tiếp thành 1 tin"""
+        pending = self._queues[key]
+        priority, message, reply_markup = pending.pop(0)
+        taken = 1
+        if self._dropped.get(key):
+            message = f"⚠️ Đã bỏ qua {self._dropped.pop(key)} thông báo do quá tải\n\n{message}"
+        if reply_markup is None:
+            while pending and pending[0][2] is None:
+                next_message = pending[0][1]
+                if len(message) + len(next_message) + 2 > TELEGRAM_MAX_MESSAGE_LENGTH:
+                    break
+                message = f"{message}\n\n{next_message}"
+                pending.pop(0)
+                taken += 1
+        self._pending -= taken
+        if not pending:
+            del self._queues[key]
+        return message, reply_markup
+
+    def _next_ready_key(self, now):
+        """Chat sẵn sàng gửi tiếp theo và thời gian chờ nếu chưa có chat nào sẵn sàng"""
+        wait_time = None
+        for key, pending in self._queues.items():
+            if not pending or key in self._in_flight:
+                continue
+            ready_at = max(self._next_allowed[key], self._last_global_send + self.global_interval)
+            if ready_at <= now:
+                return key, None
+            wait_time = ready_at - now if wait_time is None else min(wait_time, ready_at - now)
+        return None, wait_time
+
+    def _sender_loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    key, wait_time = self._next_ready_key(time.time())
+                    if key is not None:
+                        break
+                    self._cond.wait(timeout=wait_time)
+                message, reply_markup = self._take_batch(key)
+                self._in_flight.add(key)
+                self._last_global_send = time.time()
+
+            retry_after = None
+            try:
+                retry_after = _send_telegram_now(message, key[1], reply_markup, bot_token=key[0])
+            finally:
+                with self._cond:
+                    self._in_flight.discard(key)
+                    if retry_after:
+                        # Bị giới hạn → trả tin về đầu hàng đợi và chờ theo yêu cầu của Telegram
+                        self._queues[key].insert(0, (TELEGRAM_PRIORITY_HIGH, message, reply_markup))
+                        self._pending += 1
+                        self._next_allowed[key] = time.time() + retry_after
+                    else:
+                        self._next_allowed[key] = time.time() + self.per_chat_interval
+                    self._cond.notify_all()
+
+    def flush(self, timeout=10):
+        """Chờ gửi hết hàng đợi (dùng khi tắt hệ thống)"""
+        deadline = time.time() + timeout
+        with self._cond:
+            while (self._pending or self._in_flight) and time.time() < deadline:
+                self._cond.wait(timeout=0.2)
+            return self._pending == 0
+
+telegram_outbox = TelegramOutbox()
+
+def send_telegram(message, chat_id=None, reply_markup=None, bot_token=None, default_chat_id=None,
+                  priority=TELEGRAM_PRIORITY_HIGH):
+    """Gửi Telegram BẤT ĐỒNG BỘ qua telegram_outbox - trả về ngay, không chặn luồng gọi"""
+    if not bot_token:
+        logger.warning("Telegram Bot Token chưa được thiết lập")
+        return
+    
+    chat_id = chat_id or default_chat_id
+    if not chat_id:
+        logger.warning("Telegram Chat ID chưa được thiết lập")
+        return
+    
+    telegram_outbox.enqueue(message, chat_id, reply_markup, bot_token=bot_token, priority=priority)
+
+# ========== TELEGRAM WEBHOOK - NHẬN UPDATE QUA HTTP ==========
+def telegram_token_id(bot_token):
+    """ID công khai của bot token (dùng trong URL webhook, không lộ token)"""
+    return hashlib.sha256(bot_token.encode()).hexdigest()[:16]
+
+def telegram_webhook_secret(bot_token):
+    """Secret token cho header X-Telegram-Bot-Api-Secret-Token - suy ra từ bot token"""
+    return hashlib.sha256(f"webhook|{bot_token}".encode()).hexdigest()[:32]
+
+def set_telegram_webhook(bot_token, url):
+    """Đăng ký webhook với Telegram (thay cho getUpdates long-poll)"""
+    try:
+        response = requests.post(
+            f"https://api.telegram.org/bot{bot_token}/setWebhook",
+            json={"url": url, "secret_token": telegram_webhook_secret(bot_token),
+                  "allowed_updates": ["message"]},
+            timeout=15
+        )
+        if response.status_code != 200:
+            logger.error(f"Lỗi đăng ký webhook Telegram ({response.status_code}): {response.text}")
+            return False
+        logger.info(f"✅ Đã đăng ký webhook Telegram: {url}")
+        return True
+    except Exception as e:
+        logger.error(f"Lỗi kết nối Telegram khi đăng ký webhook: {str(e)}")
+        return False
+
+class TelegramUpdateRouter:
+    """Định tuyến update webhook tới BotManager theo (bot token, chat id) qua hàng đợi công việc
+
+    Mỗi chat luôn đi cùng 1 làn xử lý (giữ thứ tự hội thoại); lệnh chậm chỉ chặn làn của nó.
+    """
+    def __init__(self, lanes=4, public_url=None):
+        self.lanes = lanes
+        self.public_url = public_url if public_url is not None else os.getenv("TELEGRAM_WEBHOOK_URL", "")
+        self._managers = {}          # (bot_token, chat_id) -> BotManager
+        self._tokens = {}            # token_id -> bot_token
+        self._webhook_set = set()
+        self._recent_updates = {}    # token_id -> danh sách update_id gần đây (chống nhận trùng)
+        self._lock = threading.Lock()
+        self._queues = []
+
+    def _ensure_started(self):
+        if self._queues:
+            return
+        for i in range(self.lanes):
+            lane = queue.Queue(maxsize=1000)
+            threading.Thread(target=self._lane_loop, args=(lane,), name=f"telegram-lane-{i}", daemon=True).start()
+            self._queues.append(lane)
+
+    def register(self, bot_manager):
+        """Gắn BotManager vào router (thay vì chạy thread long-poll riêng)"""
+        bot_token = bot_manager.telegram_bot_token
+        token_id = telegram_token_id(bot_token)
+        with self._lock:
+            self._ensure_started()
+            self._managers[(bot_token, str(bot_manager.telegram_chat_id))] = bot_manager
+            self._tokens[token_id] = bot_token
+            need_webhook = self.public_url and token_id not in self._webhook_set
+            if need_webhook:
+                self._webhook_set.add(token_id)
+        if need_webhook:
+            url = f"{self.public_url.rstrip('/')}/api/telegram/webhook/{token_id}"
+            threading.Thread(target=set_telegram_webhook, args=(bot_token, url), daemon=True).start()
+
+    def token_ids(self):
+        """Các token_id webhook mà tiến trình này đang nhận"""
+        with self._lock:
+            return list(self._tokens)
+
+    def unregister(self, bot_manager):
+        with self._lock:
+            key = (bot_manager.telegram_bot_token, str(bot_manager.telegram_chat_id))
+            if self._managers.get(key) is bot_manager:
+                del self._managers[key]
+
+    def dispatch(self, token_id, update, secret=None):
+        """Nhận 1 update từ webhook - chỉ xếp hàng, không xử lý trong luồng HTTP
+
+        Trả về True nếu update được nhận (kể cả khi không có BotManager tương ứng).
+        """
+        with self._lock:
+            bot_token = self._tokens.get(token_id)
+            if not bot_token:
+                return False
+            if secret != telegram_webhook_secret(bot_token):
+                logger.warning("⚠️ Webhook Telegram sai secret token")
+                return False
+
+            update_id = update.get('update_id')
+            recent = self._recent_updates.setdefault(token_id, [])
+            if update_id in recent:
+                return True
+            recent.append(update_id)
+            if len(recent) > 200:
+                del recent[:100]
+
+            message = update.get('message') or {}
+            chat_id = str(message.get('chat', {}).get('id'))
+            text = (message.get('text') or '').strip()
+            bot_manager = self._managers.get((bot_token, chat_id))
+            if bot_manager is None or not text:
+                return True
+            lane = self._queues[hash(chat_id) % self.lanes]
+
+        try:
+            lane.put_nowait((bot_manager, chat_id, text))
+        except queue.Full:
+            logger.error(f"❌ Hàng đợi Telegram đầy, bỏ tin nhắn từ chat {chat_id}")
+        return True
+
+    def _lane_loop(self, lane):
+        while True:
+            bot_manager, chat_id, text = lane.get()
+            try:
+                bot_manager._handle_telegram_message(chat_id, text)
+            except Exception as e:
+                logger.error(f"Lỗi xử lý tin nhắn Telegram: {str(e)}")
+
+telegram_router = TelegramUpdateRouter()
 
 # ========== MENU TELEGRAM HOÀN CHỈNH ==========
+# Bàn phím được dựng và json.dumps 1 lần; send_telegram nhận thẳng chuỗi JSON đã serialise
+_KEYBOARD_CACHE = {}
+_KEYBOARD_CACHE_LOCK = threading.Lock()
+
+def _prepared_keyboard(builder):
+    """Decorator cho bàn phím tĩnh: trả về chuỗi JSON dựng sẵn thay vì dict mới mỗi lần"""
+    def wrapper(*args, **kwargs):
+        prepared = _KEYBOARD_CACHE.get(builder.__name__)
+        if prepared is None:
+            prepared = json.dumps(builder())
+            _KEYBOARD_CACHE[builder.__name__] = prepared
+        return prepared
+    wrapper.__name__ = builder.__name__
+    wrapper.__doc__ = builder.__doc__
+    return wrapper
+
+@_prepared_keyboard
 def create_cancel_keyboard():
     return {
         "keyboard": [[{"text": "❌ Hủy bỏ"}]],
@@ -97,6 +397,7 @@ def create_cancel_keyboard():
         "one_time_keyboard": True
     }
 
+@_prepared_keyboard
 def create_strategy_keyboard():
     return {
         "keyboard": [
@@ -107,6 +408,7 @@ def create_strategy_keyboard():
         "one_time_keyboard": True
     }
 
+@_prepared_keyboard
 def create_exit_strategy_keyboard():
     return {
         "keyboard": [
@@ -117,6 +419,7 @@ def create_exit_strategy_keyboard():
         "one_time_keyboard": True
     }
 
+@_prepared_keyboard
 def create_bot_mode_keyboard():
     return {
         "keyboard": [
@@ -127,17 +430,19 @@ def create_bot_mode_keyboard():
         "one_time_keyboard": True
     }
 
+DEFAULT_KEYBOARD_SYMBOLS = ["BTCUSDC", "ETHUSDC", "BNBUSDC", "ADAUSDC", "DOGEUSDC", "XRPUSDC", "DOTUSDC", "LINKUSDC"]
+
 def create_symbols_keyboard(strategy=None):
-    try:
-        symbols = get_all_usdc_pairs(limit=12)
-        if not symbols:
-            symbols = ["BTCUSDC", "ETHUSDC", "BNBUSDC", "ADAUSDC", "DOGEUSDC", "XRPUSDC", "DOTUSDC", "LINKUSDC"]
-    except:
-        symbols = ["BTCUSDC", "ETHUSDC", "BNBUSDC", "ADAUSDC", "DOGEUSDC", "XRPUSDC", "DOTUSDC", "LINKUSDC"]
+    """Bàn phím chọn coin - dựng lại chỉ khi danh sách coin giao dịch thay đổi, không bao giờ chờ Binance"""
+    symbols, version = tradable_universe.snapshot()
+    cache_key = ('create_symbols_keyboard', version)
+    prepared = _KEYBOARD_CACHE.get(cache_key)
+    if prepared is not None:
+        return prepared
     
     keyboard = []
     row = []
-    for symbol in symbols:
+    for symbol in (symbols[:12] or DEFAULT_KEYBOARD_SYMBOLS):
         row.append({"text": symbol})
         if len(row) == 3:
             keyboard.append(row)
@@ -146,12 +451,18 @@ def create_symbols_keyboard(strategy=None):
         keyboard.append(row)
     keyboard.append([{"text": "❌ Hủy bỏ"}])
     
-    return {
+    prepared = json.dumps({
         "keyboard": keyboard,
         "resize_keyboard": True,
         "one_time_keyboard": True
-    }
+    })
+    with _KEYBOARD_CACHE_LOCK:
+        for key in [k for k in _KEYBOARD_CACHE if isinstance(k, tuple) and k[0] == 'create_symbols_keyboard']:
+            del _KEYBOARD_CACHE[key]
+        _KEYBOARD_CACHE[cache_key] = prepared
+    return prepared
 
+@_prepared_keyboard
 def create_main_menu():
     return {
         "keyboard": [
@@ -164,6 +475,7 @@ def create_main_menu():
         "one_time_keyboard": False
     }
 
+@_prepared_keyboard
 def create_leverage_keyboard(strategy=None):
     leverages = ["3", "5", "10", "15", "20", "25", "50", "75", "100"]
     
@@ -184,6 +496,7 @@ def create_leverage_keyboard(strategy=None):
         "one_time_keyboard": True
     }
 
+@_prepared_keyboard
 def create_percent_keyboard():
     return {
         "keyboard": [
@@ -195,6 +508,7 @@ def create_percent_keyboard():
         "one_time_keyboard": True
     }
 
+@_prepared_keyboard
 def create_tp_keyboard():
     return {
         "keyboard": [
@@ -206,6 +520,7 @@ def create_tp_keyboard():
         "one_time_keyboard": True
     }
 
+@_prepared_keyboard
 def create_sl_keyboard():
     return {
         "keyboard": [
@@ -217,6 +532,7 @@ def create_sl_keyboard():
         "one_time_keyboard": True
     }
 
+@_prepared_keyboard
 def create_bot_count_keyboard():
     return {
         "keyboard": [
@@ -228,6 +544,7 @@ def create_bot_count_keyboard():
         "one_time_keyboard": True
     }
 
+@_prepared_keyboard
 def create_roi_trigger_keyboard():
     return {
         "keyboard": [
@@ -309,23 +626,98 @@ def binance_api_request(url, method='GET', params=None, headers=None):
     logger.error(f"Không thể thực hiện yêu cầu API sau {max_retries} lần thử")
     return None
 
-def get_all_usdc_pairs(limit=100):
-    try:
-        url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
+class TradableUniverse:
+    """Danh sách coin đang TRADING lấy từ exchangeInfo - cache có TTL, làm mới ở nền
+
+    `version` tăng mỗi khi danh sách thay đổi để các bàn phím dựng sẵn biết lúc cần dựng lại.
+    quote_asset=None → mọi symbol futures đang giao dịch (dùng để kiểm tra symbol client gửi lên).
+    """
+    def __init__(self, ttl=600, quote_asset='USDC'):
+        self.ttl = ttl
+        self.quote_asset = quote_asset
+        self._symbols = []
+        self._symbol_set = frozenset()
+        self._version = 0
+        self._loaded_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _fetch(self):
+        url = f"{BINANCE_FAPI_URL}/fapi/v1/exchangeInfo"
         data = binance_api_request(url)
         if not data:
             logger.warning("Không lấy được dữ liệu từ Binance, trả về danh sách rỗng")
-            return []
+            return None
         
-        usdc_pairs = []
+        pairs = []
         for symbol_info in data.get('symbols', []):
             symbol = symbol_info.get('symbol', '')
-            if symbol.endswith('USDC') and symbol_info.get('status') == 'TRADING':
-                usdc_pairs.append(symbol)
+            if symbol_info.get('status') != 'TRADING':
+                continue
+            if self.quote_asset is None or symbol.endswith(self.quote_asset):
+                pairs.append(symbol)
         
-        logger.info(f"✅ Lấy được {len(usdc_pairs)} coin USDC từ Binance")
+        logger.info(f"✅ Lấy được {len(pairs)} coin {self.quote_asset or 'futures'} từ Binance")
+        return pairs
+
+    def refresh(self):
+        try:
+            symbols = self._fetch()
+        except Exception as e:
+            logger.error(f"❌ Lỗi lấy danh sách coin từ Binance: {str(e)}")
+            symbols = None
+        with self._lock:
+            self._refreshing = False
+            if symbols is None:
+                return False
+            if symbols != self._symbols:
+                self._symbols = symbols
+                self._symbol_set = frozenset(symbols)
+                self._version += 1
+            self._loaded_at = time.time()
+        return True
+
+    def _is_stale(self):
+        return time.time() - self._loaded_at >= self.ttl
+
+    def refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name="tradable-universe-refresh", daemon=True).start()
+
+    def _ensure_fresh(self, wait):
+        if self._is_stale():
+            if not self._symbols and wait:
+                self.refresh()
+            else:
+                self.refresh_async()
+
+    def get(self, wait=True):
+        """Danh sách coin hiện có; hết hạn thì làm mới ở nền (chỉ chờ khi chưa có dữ liệu và wait=True)"""
+        self._ensure_fresh(wait)
+        return list(self._symbols)
+
+    def snapshot(self):
+        """(symbols, version) không chờ mạng - dùng cho bàn phím Telegram"""
+        if self._is_stale():
+            self.refresh_async()
+        with self._lock:
+            return list(self._symbols), self._version
+
+    def contains(self, symbol):
+        """Symbol có đang giao dịch không (chỉ chờ mạng ở lần tải đầu tiên)"""
+        self._ensure_fresh(True)
+        return symbol in self._symbol_set
+
+tradable_universe = TradableUniverse()
+market_universe = TradableUniverse(quote_asset=None)
+
+def get_all_usdc_pairs(limit=100):
+    try:
+        usdc_pairs = tradable_universe.get()
         return usdc_pairs[:limit] if limit else usdc_pairs
-        
     except Exception as e:
         logger.error(f"❌ Lỗi lấy danh sách coin từ Binance: {str(e)}")
         return []
@@ -364,7 +756,7 @@ def get_top_volume_symbols(limit=100):
 def get_max_leverage(symbol, api_key, api_secret):
     """Lấy đòn bẩy tối đa cho một symbol"""
     try:
-        url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
+        url = f"{BINANCE_FAPI_URL}/fapi/v1/exchangeInfo"
         data = binance_api_request(url)
         if not data:
             return 100
@@ -385,7 +777,7 @@ def get_step_size(symbol, api_key, api_secret):
     if not symbol:
         logger.error("❌ Lỗi: Symbol là None khi lấy step size")
         return 0.001
-    url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
+    url = f"{BINANCE_FAPI_URL}/fapi/v1/exchangeInfo"
     try:
         data = binance_api_request(url)
         if not data:
@@ -412,7 +804,7 @@ def set_leverage(symbol, lev, api_key, api_secret):
         }
         query = urllib.parse.urlencode(params)
         sig = sign(query, api_secret)
-        url = f"https://fapi.binance.com/fapi/v1/leverage?{query}&signature={sig}"
+        url = f"{BINANCE_FAPI_URL}/fapi/v1/leverage?{query}&signature={sig}"
         headers = {'X-MBX-APIKEY': api_key}
         
         response = binance_api_request(url, method='POST', headers=headers)
@@ -432,7 +824,7 @@ def get_balance(api_key, api_secret):
         params = {"timestamp": ts}
         query = urllib.parse.urlencode(params)
         sig = sign(query, api_secret)
-        url = f"https://fapi.binance.com/fapi/v2/account?{query}&signature={sig}"
+        url = f"{BINANCE_FAPI_URL}/fapi/v2/account?{query}&signature={sig}"
         headers = {'X-MBX-APIKEY': api_key}
         
         data = binance_api_request(url, headers=headers)
@@ -452,28 +844,190 @@ def get_balance(api_key, api_secret):
         logger.error(f"Lỗi lấy số dư: {str(e)}")
         return None
 
-def place_order(symbol, side, qty, api_key, api_secret):
+# ========== ORDER GATEWAY - ĐẶT LỆNH IDEMPOTENT ==========
+ORDER_TIMEOUT = 5          # deadline ngắn cho đường đặt lệnh (giây)
+ORDER_MAX_ATTEMPTS = 4     # tổng số lượt gửi/tra cứu trạng thái
+ORDER_INTENT_RETRY_WINDOW = 120  # giây: lệnh chưa rõ kết quả được gửi lại với CÙNG client id trong khoảng này
+ORDER_NOT_FOUND_RECHECK = 1.5    # giây: chờ trước khi tra cứu lại lệnh "không tồn tại" (có thể còn đang tới sàn)
+
+def make_client_order_id(*parts):
+    """newClientOrderId từ ý định lệnh (bot, coin, hành động, nonce riêng của ý định) - tối đa 36 ký tự"""
+    digest = hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()
+    return f"qb{digest[:30]}"
+
+def _signed_order_request(method, path, params, api_key, api_secret, timeout=ORDER_TIMEOUT):
+    """Gửi 1 request đã ký, KHÔNG tự retry - trả về (trạng thái, dữ liệu)
+
+    Trạng thái: 'ok' | 'rejected' (Binance từ chối, chắc chắn không khớp)
+    | 'throttled' (429/418) | 'unknown' (timeout/mất kết nối/5xx - không rõ đã khớp chưa)
+    """
+    params = dict(params, timestamp=int(time.time() * 1000))
+    query = urllib.parse.urlencode(params)
+    url = f"{BINANCE_FAPI_URL}{path}?{query}&signature={sign(query, api_secret)}"
+    headers = {
+        'X-MBX-APIKEY': api_key,
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    }
+    req = urllib.request.Request(url, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return 'ok', json.loads(response.read().decode())
+    except urllib.error.HTTPError as e:
+        try:
+            payload = json.loads(e.read().decode())
+        except Exception:
+            payload = {'code': e.code, 'msg': str(e.reason)}
+        if e.code in (418, 429):
+            return 'throttled', payload
+        if e.code >= 500:
+            return 'unknown', payload
+        return 'rejected', payload
+    except Exception as e:
+        return 'unknown', {'msg': str(e)}
+
+def get_order(symbol, api_key, api_secret, order_id=None, orig_client_order_id=None, timeout=ORDER_TIMEOUT):
+    """Tra cứu trạng thái lệnh theo orderId/origClientOrderId - trả về (trạng thái, dữ liệu)"""
+    params = {"symbol": symbol.upper()}
+    if order_id is not None:
+        params["orderId"] = order_id
+    if orig_client_order_id is not None:
+        params["origClientOrderId"] = orig_client_order_id
+    return _signed_order_request('GET', '/fapi/v1/order', params, api_key, api_secret, timeout)
+
+def place_order(symbol, side, qty, api_key, api_secret, client_order_id=None, timeout=ORDER_TIMEOUT,
+                lookup_first=False):
+    """Đặt lệnh MARKET idempotent
+
+    Gắn newClientOrderId cố định cho cả ý định lệnh. Khi timeout/mất phản hồi KHÔNG gửi lại ngay
+    mà tra cứu trạng thái theo origClientOrderId; chỉ gửi lại khi 2 lần tra cứu cách nhau vẫn không thấy lệnh.
+    lookup_first: client id của lượt trước chưa rõ kết quả → tra cứu trước khi gửi (Binance chỉ chặn
+    trùng id với lệnh còn mở, lệnh MARKET đã khớp thì gửi lại sẽ khớp thêm lần nữa).
+    """
     if not symbol:
         logger.error("❌ Không thể đặt lệnh: symbol là None")
         return None
     try:
-        ts = int(time.time() * 1000)
+        client_order_id = client_order_id or make_client_order_id(symbol, side, qty, time.time(), random.random())
         params = {
             "symbol": symbol.upper(),
             "side": side,
             "type": "MARKET",
             "quantity": qty,
-            "timestamp": ts
+            "newClientOrderId": client_order_id,
+            "newOrderRespType": "RESULT",  # trả về avgPrice/executedQty thực tế khi khớp
         }
+
+        need_send = not lookup_first
+        not_found = 0
+        for attempt in range(ORDER_MAX_ATTEMPTS):
+            if need_send:
+                not_found = 0
+                status, data = _signed_order_request('POST', '/fapi/v1/order', params,
+                                                     api_key, api_secret, timeout)
+                if status == 'rejected' and data.get('code') == -4116:
+                    # Client id đã tồn tại → lượt gửi trước của CÙNG ý định đã được nhận, lấy lại kết quả đó
+                    need_send = False
+                elif status in ('ok', 'rejected'):
+                    return data
+                elif status == 'throttled':
+                    # Bị giới hạn tần suất → lệnh chưa được nhận, an toàn để gửi lại
+                    time.sleep(2 ** attempt)
+                    continue
+                else:
+                    logger.warning(f"⚠️ {symbol} - Không rõ kết quả lệnh {client_order_id}: {data.get('msg')}")
+
+            # Không rõ kết quả → tra cứu thay vì gửi lại (tránh khớp 2 lần)
+            status, data = get_order(symbol, api_key, api_secret,
+                                     orig_client_order_id=client_order_id, timeout=timeout)
+            if status == 'ok' and 'orderId' in data:
+                logger.info(f"✅ {symbol} - Tìm thấy lệnh {client_order_id} sau khi mất phản hồi: {data.get('status')}")
+                return data
+            if status == 'rejected' and data.get('code') == -2013:
+                # -2013: chưa thấy lệnh - lượt gửi trước có thể vẫn đang tới matching engine. Chỉ gửi lại
+                # (CÙNG client id) khi tra cứu lần 2 sau ORDER_NOT_FOUND_RECHECK giây vẫn không thấy
+                not_found += 1
+                need_send = not_found >= 2
+                if not need_send:
+                    time.sleep(ORDER_NOT_FOUND_RECHECK)
+                    continue
+            else:
+                need_send = False
+            time.sleep(min(2 ** attempt * 0.25, 2))
+
+        logger.error(f"❌ {symbol} - Không xác định được trạng thái lệnh {client_order_id}")
+    except Exception as e:
+        logger.error(f"Lỗi đặt lệnh: {str(e)}")
+    return None
+
+def get_user_trades(symbol, api_key, api_secret, order_id=None, start_time=None, limit=100):
+    """Lấy danh sách fill (/fapi/v1/userTrades) - lọc theo orderId hoặc từ start_time"""
+    if not symbol:
+        logger.error("❌ Không thể lấy fill: symbol là None")
+        return []
+    try:
+        ts = int(time.time() * 1000)
+        params = {"symbol": symbol.upper(), "limit": limit, "timestamp": ts}
+        if order_id is not None:
+            params["orderId"] = order_id
+        if start_time is not None:
+            params["startTime"] = int(start_time)
         query = urllib.parse.urlencode(params)
         sig = sign(query, api_secret)
-        url = f"https://fapi.binance.com/fapi/v1/order?{query}&signature={sig}"
+        url = f"{BINANCE_FAPI_URL}/fapi/v1/userTrades?{query}&signature={sig}"
         headers = {'X-MBX-APIKEY': api_key}
-        
-        return binance_api_request(url, method='POST', headers=headers)
+
+        trades = binance_api_request(url, headers=headers)
+        return trades if isinstance(trades, list) else []
     except Exception as e:
-        logger.error(f"Lỗi đặt lệnh: {str(e)}")
-    return None
+        logger.error(f"Lỗi lấy fill {symbol}: {str(e)}")
+    return []
+
+def build_execution_report(order_result, fills=None):
+    """Gộp phản hồi lệnh (RESULT) và các fill thành báo cáo khớp lệnh chính xác"""
+    order_result = order_result or {}
+    report = {
+        'order_id': order_result.get('orderId'),
+        'symbol': order_result.get('symbol'),
+        'side': order_result.get('side'),
+        'status': order_result.get('status'),
+        'qty': float(order_result.get('executedQty', 0) or 0),
+        'avg_price': float(order_result.get('avgPrice', 0) or 0),
+        'quote_qty': float(order_result.get('cumQuote', 0) or 0),
+        'commission': None,
+        'commission_asset': None,
+        'realized_pnl': None,
+        'source': 'order'
+    }
+    if report['avg_price'] <= 0 and report['qty'] > 0 and report['quote_qty'] > 0:
+        report['avg_price'] = report['quote_qty'] / report['qty']
+
+    if fills:
+        qty = sum(float(f.get('qty', 0)) for f in fills)
+        quote_qty = sum(float(f.get('quoteQty') or float(f.get('qty', 0)) * float(f.get('price', 0)))
+                        for f in fills)
+        if qty > 0:
+            report['qty'] = qty
+            report['quote_qty'] = quote_qty
+            report['avg_price'] = quote_qty / qty
+            report['commission'] = sum(float(f.get('commission', 0)) for f in fills)
+            report['commission_asset'] = fills[0].get('commissionAsset')
+            report['realized_pnl'] = sum(float(f.get('realizedPnl', 0)) for f in fills)
+            report['source'] = 'fills'
+    return report
+
+def get_execution_report(symbol, order_result, api_key, api_secret, retries=2, retry_delay=0.3):
+    """Báo cáo khớp lệnh: giá khớp trung bình, phí và PnL đã chốt từ fill thực tế của lệnh"""
+    order_id = (order_result or {}).get('orderId')
+    fills = []
+    if order_id is not None:
+        for attempt in range(retries + 1):
+            fills = get_user_trades(symbol, api_key, api_secret, order_id=order_id)
+            if fills:
+                break
+            # Fill có thể chưa kịp ghi nhận ngay sau khi lệnh MARKET khớp
+            if attempt < retries:
+                time.sleep(retry_delay)
+    return build_execution_report(order_result, fills)
 
 def cancel_all_orders(symbol, api_key, api_secret):
     if not symbol:
@@ -484,7 +1038,7 @@ def cancel_all_orders(symbol, api_key, api_secret):
         params = {"symbol": symbol.upper(), "timestamp": ts}
         query = urllib.parse.urlencode(params)
         sig = sign(query, api_secret)
-        url = f"https://fapi.binance.com/fapi/v1/allOpenOrders?{query}&signature={sig}"
+        url = f"{BINANCE_FAPI_URL}/fapi/v1/allOpenOrders?{query}&signature={sig}"
         headers = {'X-MBX-APIKEY': api_key}
         
         binance_api_request(url, method='DELETE', headers=headers)
@@ -498,7 +1052,7 @@ def get_current_price(symbol):
         logger.error("💰 Lỗi: Symbol là None khi lấy giá")
         return 0
     try:
-        url = f"https://fapi.binance.com/fapi/v1/ticker/price?symbol={symbol.upper()}"
+        url = f"{BINANCE_FAPI_URL}/fapi/v1/ticker/price?symbol={symbol.upper()}"
         data = binance_api_request(url)
         if data and 'price' in data:
             price = float(data['price'])
@@ -519,7 +1073,7 @@ def get_positions(symbol=None, api_key=None, api_secret=None):
             params["symbol"] = symbol.upper()
         query = urllib.parse.urlencode(params)
         sig = sign(query, api_secret)
-        url = f"https://fapi.binance.com/fapi/v2/positionRisk?{query}&signature={sig}"
+        url = f"{BINANCE_FAPI_URL}/fapi/v2/positionRisk?{query}&signature={sig}"
         headers = {'X-MBX-APIKEY': api_key}
         
         positions = binance_api_request(url, headers=headers)
@@ -534,6 +1088,864 @@ def get_positions(symbol=None, api_key=None, api_secret=None):
         logger.error(f"Lỗi lấy vị thế: {str(e)}")
     return []
 
+def get_account_state(api_key, api_secret, asset='USDC'):
+    """Số dư + PnL chưa thực hiện từng vị thế trong 1 lần gọi /fapi/v2/account
+
+    markPrice suy ra từ entryPrice + unrealizedProfit / positionAmt (account không trả mark).
+    """
+    try:
+        ts = int(time.time() * 1000)
+        query = urllib.parse.urlencode({"timestamp": ts})
+        sig = sign(query, api_secret)
+        url = f"{BINANCE_FAPI_URL}/fapi/v2/account?{query}&signature={sig}"
+        headers = {'X-MBX-APIKEY': api_key}
+        
+        data = binance_api_request(url, headers=headers)
+        if not data:
+            return None
+        
+        state = {'balance': 0.0, 'wallet_balance': 0.0, 'total_unrealized_pnl': 0.0, 'positions': []}
+        for item in data.get('assets', []):
+            if item.get('asset') == asset:
+                state['balance'] = float(item.get('availableBalance', 0))
+                state['wallet_balance'] = float(item.get('walletBalance', 0))
+                state['total_unrealized_pnl'] = float(item.get('unrealizedProfit', 0))
+                break
+        
+        for pos in data.get('positions', []):
+            position_amt = float(pos.get('positionAmt', 0))
+            if position_amt == 0:
+                continue
+            entry_price = float(pos.get('entryPrice', 0))
+            unrealized_pnl = float(pos.get('unrealizedProfit', 0))
+            state['positions'].append({
+                'symbol': pos.get('symbol'),
+                'side': 'LONG' if position_amt > 0 else 'SHORT',
+                'qty': abs(position_amt),
+                'entry_price': entry_price,
+                'mark_price': entry_price + unrealized_pnl / position_amt,
+                'unrealized_pnl': unrealized_pnl,
+                'leverage': int(float(pos.get('leverage', 0) or 0))
+            })
+        return state
+    except Exception as e:
+        logger.error(f"Lỗi lấy trạng thái tài khoản: {str(e)}")
+        return None
+
+# ========== ĐÁNH GIÁ DANH MỤC VECTOR HÓA ==========
+# Các mốc Fibonacci (% ROI âm tính trên entry_base) để nhồi lệnh
+FIB_AVERAGE_DOWN_LEVELS = np.array([200, 300, 500, 800, 1300, 2100, 3400], dtype=float)
+
+def _as_threshold(value, shape):
+    """Chuẩn hóa ngưỡng (scalar/mảng/None) thành mảng float - None → NaN (mọi so sánh đều False)"""
+    if value is None:
+        return np.full(shape, np.nan)
+    arr = np.array(value, dtype=float)
+    return np.broadcast_to(np.where(np.isfinite(arr), arr, np.nan), shape)
+
+def evaluate_positions(entry, qty, side, lev, price, high_water_mark_roi=None, tp=None, sl=None,
+                       roi_trigger=None, entry_base=None, average_down_count=None):
+    """Đánh giá TẤT CẢ vị thế trong 1 lượt NumPy: PnL, ROI, ROI cao nhất, TP/SL và mốc nhồi Fibonacci
+
+    Mọi tham số nhận scalar hoặc mảng cùng độ dài (side là "BUY"/"SELL").
+    Trả về dict các mảng NumPy, phần tử thứ i ứng với vị thế thứ i.
+    """
+    entry = np.atleast_1d(np.asarray(entry, dtype=float))
+    shape = entry.shape
+    qty = np.abs(np.broadcast_to(np.asarray(qty, dtype=float), shape))
+    price = np.broadcast_to(np.asarray(price, dtype=float), shape)
+    lev = np.broadcast_to(np.asarray(lev, dtype=float), shape)
+    direction = np.where(np.broadcast_to(np.asarray(side), shape) == "BUY", 1.0, -1.0)
+
+    # ROI theo giá vào trung bình (TP/SL, ROI trigger)
+    profit = (price - entry) * qty * direction
+    invested = np.divide(entry * qty, lev, out=np.zeros(shape), where=lev > 0)
+    valid = (invested > 0) & (price > 0)
+    roi = np.divide(profit * 100, invested, out=np.zeros(shape), where=valid)
+
+    if high_water_mark_roi is None:
+        previous_hwm = np.zeros(shape)
+    else:
+        previous_hwm = np.broadcast_to(np.asarray(high_water_mark_roi, dtype=float), shape)
+    hwm = np.where(valid, np.maximum(previous_hwm, roi), previous_hwm)
+
+    tp = _as_threshold(tp, shape)
+    sl = _as_threshold(sl, shape)
+    roi_trigger = _as_threshold(roi_trigger, shape)
+
+    roi_check_activated = valid & (hwm >= roi_trigger)
+    roi_exit_ready = roi_check_activated & (roi >= roi_trigger)
+    tp_hit = valid & (roi >= tp)
+    sl_hit = valid & ~tp_hit & (sl > 0) & (roi <= -sl)
+
+    # ROI theo giá vào GỐC (entry_base) để xét mốc nhồi lệnh Fibonacci
+    base = entry if entry_base is None else np.broadcast_to(np.asarray(entry_base, dtype=float), shape)
+    base_profit = (price - base) * qty * direction
+    base_invested = np.divide(base * qty, lev, out=np.zeros(shape), where=lev > 0)
+    base_valid = (base_invested > 0) & (price > 0)
+    base_roi = np.divide(base_profit * 100, base_invested, out=np.zeros(shape), where=base_valid)
+
+    if average_down_count is None:
+        count = np.zeros(shape, dtype=int)
+    else:
+        count = np.broadcast_to(np.asarray(average_down_count, dtype=int), shape)
+    in_ladder = count < len(FIB_AVERAGE_DOWN_LEVELS)
+    fib_level = FIB_AVERAGE_DOWN_LEVELS[np.clip(count, 0, len(FIB_AVERAGE_DOWN_LEVELS) - 1)]
+    fib_hit = base_valid & in_ladder & (base_roi < 0) & (-base_roi >= fib_level)
+
+    return {
+        'valid': valid,
+        'profit': profit,
+        'invested': invested,
+        'roi': roi,
+        'high_water_mark_roi': hwm,
+        'roi_check_activated': roi_check_activated,
+        'roi_exit_ready': roi_exit_ready,
+        'tp_hit': tp_hit,
+        'sl_hit': sl_hit,
+        'base_roi': base_roi,
+        'fib_level': fib_level,
+        'fib_hit': fib_hit,
+    }
+
+# ========== KHO LƯU TRỮ KLINE DẠNG CỘT (MEMMAP) ==========
+KLINE_INTERVAL_MS = {
+    '1m': 60_000, '3m': 180_000, '5m': 300_000, '15m': 900_000, '30m': 1_800_000,
+    '1h': 3_600_000, '2h': 7_200_000, '4h': 14_400_000, '6h': 21_600_000,
+    '8h': 28_800_000, '12h': 43_200_000, '1d': 86_400_000,
+}
+# Cột lưu trữ và vị trí tương ứng trong 1 dòng kline của Binance
+KLINE_COLUMNS = (
+    ('open_time', np.int64, 0),
+    ('open', np.float64, 1),
+    ('high', np.float64, 2),
+    ('low', np.float64, 3),
+    ('close', np.float64, 4),
+    ('volume', np.float64, 5),
+    ('quote_volume', np.float64, 7),
+    ('trades', np.int64, 8),
+    ('taker_buy_volume', np.float64, 9),
+)
+
+class KlineArchive:
+    """Kho OHLCV theo symbol/interval: mỗi chunk là 1 thư mục, mỗi cột là 1 file .npy mở bằng memmap
+
+    Vị trí nến cố định theo thời gian: slot = open_time // interval_ms, chunk k chứa các slot
+    [k*CHUNK_ROWS, (k+1)*CHUNK_ROWS). Slot chưa có dữ liệu có open_time = 0 → phát hiện gap
+    không cần quét JSON, và ghi lại cùng 1 nến là idempotent.
+    """
+    CHUNK_ROWS = 1 << 16
+
+    def __init__(self, root=None):
+        self.root = root or os.getenv("KLINE_ARCHIVE_DIR", "./kline_archive")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def interval_ms(interval):
+        try:
+            return KLINE_INTERVAL_MS[interval]
+        except KeyError:
+            raise ValueError(f"Interval không hỗ trợ lưu trữ: {interval}")
+
+    def _series_dir(self, symbol, interval):
+        return os.path.join(self.root, symbol.upper(), interval)
+
+    def _chunk_dir(self, symbol, interval, chunk):
+        return os.path.join(self._series_dir(symbol, interval), f"{chunk:08d}")
+
+    def _create_chunk(self, path):
+        """Tạo chunk rỗng (toàn bộ open_time = 0) - tạo ở thư mục tạm rồi đổi tên cho nguyên tử"""
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, dtype, _ in KLINE_COLUMNS:
+            column = np.lib.format.open_memmap(
+                os.path.join(tmp_path, f"{name}.npy"), mode='w+', dtype=dtype, shape=(self.CHUNK_ROWS,)
+            )
+            column[:] = 0 if np.issubdtype(dtype, np.integer) else np.nan
+            column.flush()
+            del column
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # Tiến trình khác đã tạo trước
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def _open_column(self, symbol, interval, chunk, name, mode='r'):
+        path = os.path.join(self._chunk_dir(symbol, interval, chunk), f"{name}.npy")
+        if mode == 'r':
+            return np.load(path, mmap_mode='r')
+        return np.lib.format.open_memmap(path, mode=mode)
+
+    def chunks(self, symbol, interval):
+        """Danh sách chỉ số chunk đang có của 1 series (tăng dần)"""
+        try:
+            names = os.listdir(self._series_dir(symbol, interval))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def append(self, symbol, interval, klines, now_ms=None):
+        """Ghi các nến ĐÃ ĐÓNG (dòng kline thô của Binance) vào kho, trả về số nến đã ghi
+
+        Nến chưa đóng (close_time >= hiện tại) bị bỏ qua để kho chỉ chứa dữ liệu cuối cùng.
+        """
+        step = self.interval_ms(interval)
+        if not klines:
+            return 0
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        rows = [k for k in klines if int(k[6]) < now_ms]
+        if not rows:
+            return 0
+
+        open_times = np.fromiter((int(k[0]) for k in rows), dtype=np.int64, count=len(rows))
+        slots = open_times // step
+        chunk_ids = slots // self.CHUNK_ROWS
+        offsets = slots % self.CHUNK_ROWS
+        values = {
+            name: np.array([k[index] for k in rows], dtype=float).astype(dtype)
+            for name, dtype, index in KLINE_COLUMNS
+        }
+
+        with self._lock:
+            os.makedirs(self._series_dir(symbol, interval), exist_ok=True)
+            for chunk in np.unique(chunk_ids):
+                chunk = int(chunk)
+                path = self._chunk_dir(symbol, interval, chunk)
+                if not os.path.isdir(path):
+                    self._create_chunk(path)
+                mask = chunk_ids == chunk
+                # open_time ghi sau cùng: nến chỉ "có mặt" khi mọi cột khác đã ghi xong
+                for name, _, _ in KLINE_COLUMNS[1:] + KLINE_COLUMNS[:1]:
+                    column = self._open_column(symbol, interval, chunk, name, mode='r+')
+                    column[offsets[mask]] = values[name][mask]
+                    column.flush()
+                    del column
+        return len(rows)
+
+    def read(self, symbol, interval, start_ms, end_ms, columns=None, dense=False):
+        """Đọc nến trong [start_ms, end_ms) → dict cột → mảng NumPy
+
+        dense=True giữ nguyên lưới slot (kể cả slot trống) và, nếu khoảng nằm trong 1 chunk,
+        trả về view memmap không sao chép. Mặc định chỉ trả về các nến có dữ liệu.
+        """
+        step = self.interval_ms(interval)
+        names = list(columns or [name for name, _, _ in KLINE_COLUMNS])
+        if 'open_time' not in names:
+            names.append('open_time')
+        dtypes = {name: dtype for name, dtype, _ in KLINE_COLUMNS}
+
+        first_slot = -(-int(start_ms) // step)
+        last_slot = -(-int(end_ms) // step)
+        parts = {name: [] for name in names}
+        available = set(self.chunks(symbol, interval))
+        slot = first_slot
+        while slot < last_slot:
+            chunk, offset = divmod(slot, self.CHUNK_ROWS)
+            stop = min(self.CHUNK_ROWS, offset + (last_slot - slot))
+            for name in names:
+                if chunk in available:
+                    parts[name].append(self._open_column(symbol, interval, chunk, name)[offset:stop])
+                else:
+                    filler = 0 if np.issubdtype(dtypes[name], np.integer) else np.nan
+                    parts[name].append(np.full(stop - offset, filler, dtype=dtypes[name]))
+            slot += stop - offset
+
+        result = {}
+        for name in names:
+            if not parts[name]:
+                result[name] = np.empty(0, dtype=dtypes[name])
+            elif len(parts[name]) == 1:
+                result[name] = parts[name][0]
+            else:
+                result[name] = np.concatenate(parts[name])
+        if not dense:
+            present = result['open_time'] > 0
+            result = {name: np.asarray(values[present]) for name, values in result.items()}
+        return result
+
+    def gaps(self, symbol, interval, start_ms, end_ms):
+        """Các khoảng thiếu nến [gap_start_ms, gap_end_ms) trong [start_ms, end_ms)"""
+        step = self.interval_ms(interval)
+        open_time = self.read(symbol, interval, start_ms, end_ms, columns=['open_time'], dense=True)['open_time']
+        if open_time.size == 0:
+            return []
+        first_slot = -(-int(start_ms) // step)
+        missing = np.concatenate(([0], (open_time == 0).astype(np.int8), [0]))
+        edges = np.flatnonzero(np.diff(missing))
+        return [((first_slot + int(a)) * step, (first_slot + int(b)) * step)
+                for a, b in zip(edges[0::2], edges[1::2])]
+
+    def last_open_time(self, symbol, interval):
+        """open_time của nến mới nhất đã lưu (None nếu series rỗng)"""
+        step = self.interval_ms(interval)
+        for chunk in reversed(self.chunks(symbol, interval)):
+            open_time = self._open_column(symbol, interval, chunk, 'open_time')
+            filled = np.flatnonzero(open_time)
+            if filled.size:
+                return int((chunk * self.CHUNK_ROWS + int(filled[-1])) * step)
+        return None
+
+kline_archive = KlineArchive()
+
+# ========== TẢI KLINE LỊCH SỬ SONG SONG (CÓ CHECKPOINT) ==========
+KLINE_PAGE_LIMIT = 1500
+KLINE_PAGE_WEIGHT = 10  # weight của /fapi/v1/klines khi limit > 1000
+
+class RequestWeightLimiter:
+    """Token bucket theo weight/phút của Binance, dùng chung cho mọi luồng tải"""
+    def __init__(self, weight_per_minute):
+        self.capacity = float(weight_per_minute)
+        self._tokens = self.capacity
+        self._rate = self.capacity / 60.0
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, weight):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= weight:
+                    self._tokens -= weight
+                    return
+                wait_time = (weight - self._tokens) / self._rate
+            time.sleep(wait_time)
+
+class KlineDownloader:
+    """Tải kline lịch sử USDC perpetual vào KlineArchive: chia trang 1500 nến, tải song song trong
+    giới hạn weight, lưu checkpoint theo series để lần chạy bị ngắt có thể tiếp tục.
+
+    Trang đã tải (hoặc đã đủ nến trong kho) được bỏ qua; trang lỗi sẽ được tải lại ở lần chạy sau.
+    """
+    CHECKPOINT_EVERY = 20
+
+    def __init__(self, archive=None, workers=8, weight_per_minute=None):
+        self.archive = archive or kline_archive
+        self.workers = workers
+        # Mặc định chỉ dùng ~50% hạn mức 2400 weight/phút để bot đang chạy vẫn còn chỗ
+        self.limiter = RequestWeightLimiter(
+            weight_per_minute or int(os.getenv("KLINE_DOWNLOAD_WEIGHT", "1200"))
+        )
+
+    def _checkpoint_path(self, symbol, interval):
+        return os.path.join(self.archive._series_dir(symbol, interval), "checkpoint.json")
+
+    def _load_checkpoint(self, symbol, interval):
+        try:
+            with open(self._checkpoint_path(symbol, interval), "r", encoding="utf-8") as f:
+                return set(json.load(f).get('done_pages', []))
+        except (OSError, ValueError):
+            return set()
+
+    def _save_checkpoint(self, symbol, interval, done_pages):
+        path = self._checkpoint_path(symbol, interval)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({'done_pages': sorted(done_pages), 'updated_at': time.time()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def perpetual_symbols(self):
+        """{symbol: onboardDate_ms} của các hợp đồng USDC PERPETUAL đang giao dịch"""
+        data = binance_api_request(f"{BINANCE_FAPI_URL}/fapi/v1/exchangeInfo")
+        if not data:
+            return {}
+        return {
+            s['symbol']: int(s.get('onboardDate') or 0)
+            for s in data.get('symbols', [])
+            if s.get('symbol', '').endswith('USDC') and s.get('status') == 'TRADING'
+            and s.get('contractType', 'PERPETUAL') == 'PERPETUAL'
+        }
+
+    def plan(self, symbol, interval, start_ms, end_ms, done_pages):
+        """Danh sách trang [page_start, page_end) còn thiếu của 1 series"""
+        page_ms = self.archive.interval_ms(interval) * KLINE_PAGE_LIMIT
+        first_page = (int(start_ms) // page_ms) * page_ms
+        pages = []
+        for page_start in range(first_page, int(end_ms), page_ms):
+            page_end = page_start + page_ms
+            if page_start in done_pages:
+                continue
+            if not self.archive.gaps(symbol, interval, max(page_start, start_ms), min(page_end, end_ms)):
+                continue
+            pages.append((page_start, page_end))
+        return pages
+
+    def _fetch_page(self, symbol, interval, page_start, page_end):
+        self.limiter.acquire(KLINE_PAGE_WEIGHT)
+        data = binance_api_request(
+            f"{BINANCE_FAPI_URL}/fapi/v1/klines",
+            params={"symbol": symbol, "interval": interval, "startTime": page_start,
+                    "endTime": page_end - 1, "limit": KLINE_PAGE_LIMIT}
+        )
+        if data is None:
+            return None
+        return self.archive.append(symbol, interval, data)
+
+    def run(self, symbols=None, intervals=('1m', '5m'), start_ms=None, end_ms=None, days=30):
+        """Tải [start_ms, end_ms) (mặc định {days} ngày gần nhất) cho các symbol × interval
+
+        Trả về thống kê {'pages', 'candles', 'failed', 'elapsed'}.
+        """
+        started = time.time()
+        end_ms = int(end_ms or time.time() * 1000)
+        start_ms = int(start_ms or end_ms - days * 86_400_000)
+        listings = self.perpetual_symbols()
+        if symbols is None:
+            symbols = sorted(listings)
+
+        jobs = []
+        checkpoints = {}
+        for symbol in symbols:
+            series_start = max(start_ms, listings.get(symbol, 0))
+            for interval in intervals:
+                done_pages = self._load_checkpoint(symbol, interval)
+                checkpoints[(symbol, interval)] = done_pages
+                for page_start, page_end in self.plan(symbol, interval, series_start, end_ms, done_pages):
+                    jobs.append((symbol, interval, page_start, page_end))
+
+        logger.info(f"📥 Tải kline: {len(jobs)} trang cho {len(symbols)} coin × {len(intervals)} interval")
+        stats = {'pages': 0, 'candles': 0, 'failed': 0}
+        now_ms = int(time.time() * 1000)
+        dirty = defaultdict(int)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._fetch_page, *job): job for job in jobs}
+            for future in as_completed(futures):
+                symbol, interval, page_start, page_end = futures[future]
+                try:
+                    written = future.result()
+                except Exception as e:
+                    logger.error(f"❌ Lỗi tải kline {symbol} {interval} @ {page_start}: {str(e)}")
+                    written = None
+                if written is None:
+                    stats['failed'] += 1
+                    continue
+                stats['pages'] += 1
+                stats['candles'] += written
+                # Trang còn chứa nến chưa đóng thì chưa đánh dấu xong
+                if page_end <= now_ms:
+                    key = (symbol, interval)
+                    checkpoints[key].add(page_start)
+                    dirty[key] += 1
+                    if dirty[key] >= self.CHECKPOINT_EVERY:
+                        self._save_checkpoint(symbol, interval, checkpoints[key])
+                        dirty[key] = 0
+                if stats['pages'] % 200 == 0:
+                    logger.info(f"📥 Đã tải {stats['pages']}/{len(jobs)} trang ({stats['candles']} nến)")
+
+        for (symbol, interval), count in dirty.items():
+            if count:
+                self._save_checkpoint(symbol, interval, checkpoints[(symbol, interval)])
+
+        stats['elapsed'] = round(time.time() - started, 1)
+        logger.info(f"✅ Tải kline xong: {stats['pages']} trang, {stats['candles']} nến, "
+                    f"{stats['failed']} trang lỗi, {stats['elapsed']}s")
+        return stats
+
+# ========== BACKTEST VECTOR HÓA CHO CHIẾN LƯỢC RSI + KHỐI LƯỢNG ==========
+SIGNAL_NONE, SIGNAL_BUY, SIGNAL_SELL = 0, 1, -1
+
+def rsi_signal_series(close, open_, volume, volume_threshold=20, period=14):
+    """Tín hiệu của SmartCoinFinder.get_rsi_signal cho MỌI nến trong 1 lượt NumPy
+
+    Phần tử i là tín hiệu khi nến i vừa đóng (nến i+1 vừa mở, giá hiện tại = open[i+1]),
+    giống cửa sổ 15 nến bot lấy qua REST. Trả về mảng int8: 1 = BUY, -1 = SELL, 0 = không có.
+    """
+    close = np.asarray(close, dtype=float)
+    open_ = np.asarray(open_, dtype=float)
+    volume = np.asarray(volume, dtype=float)
+    n = close.size
+    signal = np.zeros(n, dtype=np.int8)
+    if n < period + 2:
+        return signal
+
+    # RSI trung bình đơn giản trên 14 biến động: 13 biến động giữa các giá đóng + biến động của giá hiện tại
+    deltas = np.diff(close)
+    gain_sum = np.concatenate(([0.0], np.cumsum(np.where(deltas > 0, deltas, 0))))
+    loss_sum = np.concatenate(([0.0], np.cumsum(np.where(deltas < 0, -deltas, 0))))
+    i = np.arange(period - 1, n - 1)
+    live_delta = open_[i + 1] - close[i]
+    gains = (gain_sum[i] - gain_sum[i - (period - 1)] + np.maximum(live_delta, 0)) / period
+    losses = (loss_sum[i] - loss_sum[i - (period - 1)] + np.maximum(-live_delta, 0)) / period
+    rsi = np.where(losses == 0, 100.0,
+                   100 - 100 / (1 + np.divide(gains, losses, out=np.zeros_like(gains), where=losses > 0)))
+
+    price_change = close[i] - close[i - 1]
+    prev_volume = volume[i - 1]
+    # Bot chia cho khối lượng 2 nến trước → khối lượng 0 gây lỗi và không có tín hiệu
+    valid = (prev_volume > 0) & (volume[i - 2] > 0)
+    volume_change = np.divide((volume[i] - prev_volume) * 100, prev_volume,
+                              out=np.zeros_like(prev_volume), where=valid)
+    volume_increasing = valid & (volume_change > volume_threshold)
+    volume_decreasing = valid & (volume_change < -volume_threshold)
+    price_increasing = price_change > 0
+    price_decreasing = price_change < 0
+
+    # 6 điều kiện theo đúng thứ tự ưu tiên, sau đó logic cũ dự phòng (RSI 30-70 + volume tăng).
+    # Nhánh "RSI hồi từ vùng cực" không được mô phỏng: calculate_rsi(closes[:-1]) chỉ có 14 giá
+    # nên luôn trả về 50 và nhánh này không bao giờ kích hoạt trên bot thật.
+    conditions = [
+        (rsi > 80) & price_increasing & volume_increasing,
+        (rsi < 20) & price_decreasing & volume_decreasing,
+        (rsi > 80) & price_increasing & volume_decreasing,
+        (rsi < 20) & price_decreasing & volume_increasing,
+        (rsi > 20) & ~price_decreasing & volume_decreasing,
+        (rsi < 80) & ~price_increasing & volume_increasing,
+        (rsi >= 30) & (rsi <= 70) & volume_increasing & (rsi > 55),
+        (rsi >= 30) & (rsi <= 70) & volume_increasing & (rsi < 45),
+    ]
+    choices = [SIGNAL_SELL, SIGNAL_SELL, SIGNAL_BUY, SIGNAL_BUY, SIGNAL_BUY, SIGNAL_SELL, SIGNAL_BUY, SIGNAL_SELL]
+    signal[i] = np.select(conditions, choices, default=SIGNAL_NONE)
+    return signal
+
+class Backtester:
+    """Chạy lại nến lịch sử qua đúng luật vào/ra lệnh của BaseBot
+
+    - Vào lệnh: tín hiệu get_entry_signal (ngưỡng volume 30%), khớp ở giá mở nến kế tiếp,
+      chờ cooldown sau khi đóng (mặc định 1 giờ như bot). Hướng lệnh theo tín hiệu - việc chọn
+      hướng theo PnL toàn tài khoản không mô phỏng được trên dữ liệu 1 symbol.
+    - Ra lệnh: ROI trigger + get_exit_signal (ngưỡng 80%) tại giá mở nến, SL / nhồi Fibonacci / TP
+      trong nến theo high/low. Cùng 1 nến thì xét theo thứ tự bất lợi: SL → nhồi → TP.
+    - Quy mô lệnh tính theo số dư tại lúc vào lệnh, lợi nhuận mỗi lệnh là tỷ lệ trên số dư đó.
+
+    Tín hiệu được tính vector hóa cho toàn bộ chuỗi; chỉ vòng lặp trạng thái vị thế là tuần tự,
+    và mỗi bước tìm sự kiện kế tiếp trong 1 cửa sổ nến bằng NumPy.
+    """
+    SCAN_WINDOW = 256
+
+    def __init__(self, lev=10, percent=5, tp=100, sl=None, roi_trigger=None,
+                 entry_volume_threshold=30, exit_volume_threshold=80, fee_rate=0.0005,
+                 cooldown_seconds=3600, average_down=True, signal_cache=None):
+        self.lev = float(lev)
+        self.percent = float(percent)
+        self.tp = tp
+        self.sl = sl
+        self.roi_trigger = roi_trigger
+        self.entry_volume_threshold = entry_volume_threshold
+        self.exit_volume_threshold = exit_volume_threshold
+        self.fee_rate = fee_rate
+        self.cooldown_seconds = cooldown_seconds
+        self.average_down = average_down
+        # Dict dùng chung giữa nhiều Backtester (vd. khi quét tham số) - tín hiệu chỉ phụ thuộc ngưỡng volume
+        self.signal_cache = signal_cache
+
+    def _signals(self, symbol, close, open_, volume, volume_threshold):
+        if self.signal_cache is None:
+            return rsi_signal_series(close, open_, volume, volume_threshold)
+        key = (symbol, volume_threshold)
+        if key not in self.signal_cache:
+            self.signal_cache[key] = rsi_signal_series(close, open_, volume, volume_threshold)
+        return self.signal_cache[key]
+
+    @staticmethod
+    def load(symbols, interval='5m', start_ms=None, end_ms=None, archive=None):
+        """Nến từ KlineArchive cho backtest: {symbol: {'open_time', 'open', 'high', 'low', 'close', 'volume'}}"""
+        archive = archive or kline_archive
+        end_ms = int(end_ms or time.time() * 1000)
+        start_ms = int(start_ms or end_ms - 365 * 86_400_000)
+        columns = ['open_time', 'open', 'high', 'low', 'close', 'volume']
+        data = {}
+        for symbol in symbols:
+            candles = archive.read(symbol, interval, start_ms, end_ms, columns=columns)
+            if candles['open_time'].size:
+                data[symbol] = candles
+        return data
+
+    def _roi(self, price, entry, direction):
+        return (price - entry) / entry * direction * self.lev * 100
+
+    def _roi_price(self, entry, direction, roi):
+        """Giá mà tại đó ROI (trên entry) bằng `roi`%"""
+        return entry * (1 + direction * roi / (100 * self.lev))
+
+    def run_symbol(self, symbol, candles):
+        """Danh sách lệnh (dict) của 1 symbol"""
+        open_time = np.asarray(candles['open_time'], dtype=np.int64)
+        o = np.asarray(candles['open'], dtype=float)
+        h = np.asarray(candles['high'], dtype=float)
+        l = np.asarray(candles['low'], dtype=float)
+        c = np.asarray(candles['close'], dtype=float)
+        v = np.asarray(candles['volume'], dtype=float)
+        n = c.size
+        if n < 20:
+            return []
+        bar_ms = int(np.median(np.diff(open_time[:1000])))
+
+        entry_signal = self._signals(symbol, c, o, v, self.entry_volume_threshold)
+        exit_signal = (self._signals(symbol, c, o, v, self.exit_volume_threshold)
+                       if self.roi_trigger is not None else None)
+        entry_bars = np.flatnonzero(entry_signal) + 1  # khớp ở nến kế tiếp
+        fraction = self.percent / 100
+        fib_levels = FIB_AVERAGE_DOWN_LEVELS
+        has_tp = self.tp is not None
+        has_sl = self.sl is not None and self.sl > 0
+
+        trades = []
+        next_allowed = 0
+        while True:
+            pos = np.searchsorted(entry_bars, next_allowed)
+            if pos >= entry_bars.size or entry_bars[pos] >= n:
+                break
+            e = int(entry_bars[pos])
+            direction = float(entry_signal[e - 1])
+            entry = base = o[e]
+            margin = fraction
+            qty = margin * self.lev / entry
+            notional_traded = qty * entry
+            count = 0
+
+            k = e
+            exit_bar = exit_price = None
+            reason = "END"
+            window = self.SCAN_WINDOW
+            while k < n:
+                end = min(n, k + window)
+                idx = np.arange(k, end)
+                worst = l[k:end] if direction > 0 else h[k:end]
+                best = h[k:end] if direction > 0 else l[k:end]
+                events = np.zeros(end - k, dtype=bool)
+
+                smart = None
+                if exit_signal is not None:
+                    smart = (idx > e) & (exit_signal[idx - 1] != 0) & \
+                            (self._roi(o[k:end], entry, direction) >= self.roi_trigger)
+                    events |= smart
+                sl_hit = self._roi(worst, entry, direction) <= -self.sl if has_sl else None
+                if sl_hit is not None:
+                    events |= sl_hit
+                fib_hit = None
+                if self.average_down and count < len(fib_levels):
+                    fib_hit = self._roi(worst, base, direction) <= -fib_levels[count]
+                    events |= fib_hit
+                tp_hit = self._roi(best, entry, direction) >= self.tp if has_tp else None
+                if tp_hit is not None:
+                    events |= tp_hit
+
+                if not events.any():
+                    k = end
+                    window = min(window * 2, 8192)
+                    continue
+
+                j = int(np.argmax(events))
+                bar = k + j
+                if smart is not None and smart[j]:
+                    exit_bar, exit_price, reason = bar, o[bar], "ROI_TRIGGER"
+                    break
+                if sl_hit is not None and sl_hit[j]:
+                    level = self._roi_price(entry, direction, -self.sl)
+                    price = min(o[bar], level) if direction > 0 else max(o[bar], level)
+                    exit_bar, exit_price, reason = bar, price, "SL"
+                    break
+                if fib_hit is not None and fib_hit[j]:
+                    level = self._roi_price(base, direction, -fib_levels[count])
+                    price = min(o[bar], level) if direction > 0 else max(o[bar], level)
+                    add_margin = fraction * (count + 1)
+                    add_qty = add_margin * self.lev / price
+                    entry = (qty * entry + add_qty * price) / (qty + add_qty)
+                    qty += add_qty
+                    margin += add_margin
+                    notional_traded += add_qty * price
+                    count += 1
+                    k = bar + 1
+                    window = self.SCAN_WINDOW
+                    continue
+                level = self._roi_price(entry, direction, self.tp)
+                price = max(o[bar], level) if direction > 0 else min(o[bar], level)
+                exit_bar, exit_price, reason = bar, price, "TP"
+                break
+
+            if exit_bar is None:
+                exit_bar, exit_price = n - 1, c[-1]
+
+            pnl = (exit_price - entry) * qty * direction
+            fees = (notional_traded + qty * exit_price) * self.fee_rate
+            trades.append({
+                'symbol': symbol,
+                'side': "BUY" if direction > 0 else "SELL",
+                'entry_time': int(open_time[e]),
+                'exit_time': int(open_time[exit_bar]) + bar_ms,
+                'entry_price': float(o[e]),
+                'avg_entry': float(entry),
+                'exit_price': float(exit_price),
+                'average_down_count': count,
+                'roi': float(pnl / (entry * qty / self.lev) * 100),
+                'return': float(pnl - fees),  # tỷ lệ trên số dư lúc vào lệnh
+                'fees': float(fees),
+                'reason': reason,
+            })
+            if reason == "END":
+                break
+            # Cooldown sau khi đóng lệnh
+            next_allowed = exit_bar + 1 + int(math.ceil(self.cooldown_seconds * 1000 / bar_ms))
+
+        return trades
+
+    def run(self, data, initial_balance=1000.0):
+        """Backtest nhiều symbol: {'trades', 'equity': {'time', 'balance'}, 'stats'}"""
+        trades = []
+        for symbol, candles in data.items():
+            trades.extend(self.run_symbol(symbol, candles))
+        trades.sort(key=lambda t: t['exit_time'])
+
+        returns = np.array([t['return'] for t in trades], dtype=float)
+        times = np.array([t['exit_time'] for t in trades], dtype=np.int64)
+        balance = initial_balance * np.cumprod(np.maximum(1 + returns, 0))
+        return {
+            'trades': trades,
+            'equity': {'time': times, 'balance': balance},
+            'stats': backtest_stats(returns, balance, initial_balance),
+        }
+
+BACKTEST_RUIN_FRACTION = 0.05  # số dư rơi xuống dưới 5% ban đầu được coi là cháy tài khoản
+
+def backtest_stats(returns, balance, initial_balance):
+    """Thống kê kết quả: lợi nhuận tổng, drawdown lớn nhất, tỷ lệ thắng, cháy tài khoản"""
+    if balance.size == 0:
+        return {'trades': 0, 'total_return': 0.0, 'max_drawdown': 0.0, 'win_rate': 0.0, 'ruined': False}
+    curve = np.concatenate(([initial_balance], balance))
+    peak = np.maximum.accumulate(curve)
+    drawdown = np.divide(peak - curve, peak, out=np.ones_like(curve), where=peak > 0)
+    return {
+        'trades': int(returns.size),
+        'total_return': float(balance[-1] / initial_balance - 1) * 100,
+        'max_drawdown': float(drawdown.max()) * 100,
+        'win_rate': float((returns > 0).mean()) * 100,
+        'ruined': bool(curve.min() <= initial_balance * BACKTEST_RUIN_FRACTION),
+    }
+
+# ========== QUÉT THAM SỐ ĐA NHÂN ==========
+SWEEP_COLUMNS = ('open_time', 'open', 'high', 'low', 'close', 'volume')
+_SWEEP_DATA = {}
+_SWEEP_SIGNALS = {}
+
+def ruin_probability(returns, paths=500, seed=0, block=100):
+    """Xác suất cháy tài khoản (Monte Carlo): xáo lại chuỗi lợi nhuận lệnh có hoàn lại,
+    tỷ lệ đường equity chạm mức BACKTEST_RUIN_FRACTION"""
+    returns = np.asarray(returns, dtype=float)
+    if returns.size == 0:
+        return 0.0
+    rng = np.random.default_rng(seed)
+    # Cộng log để tránh tràn số; lợi nhuận <= -100% coi như cháy ngay
+    log_growth = np.log(np.maximum(1 + returns, 1e-12))
+    threshold = math.log(BACKTEST_RUIN_FRACTION)
+    ruined = 0
+    for start in range(0, paths, block):
+        size = min(block, paths - start)
+        sample = rng.choice(log_growth, size=(size, returns.size))
+        ruined += int((np.cumsum(sample, axis=1).min(axis=1) <= threshold).sum())
+    return ruined / paths
+
+def parameter_grid(**space):
+    """Lưới tham số: parameter_grid(tp=[50, 100], sl=[None, 50]) → list dict"""
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+def parameter_samples(space, count, seed=0):
+    """Lấy mẫu ngẫu nhiên: giá trị là list (chọn 1) hoặc tuple (min, max) (phân phối đều)"""
+    rng = random.Random(seed)
+    samples = []
+    for _ in range(count):
+        params = {}
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                low, high = values
+                params[name] = rng.randint(low, high) if isinstance(low, int) and isinstance(high, int) \
+                    else rng.uniform(low, high)
+            else:
+                params[name] = rng.choice(list(values))
+        samples.append(params)
+    return samples
+
+def _sweep_worker_init(cache_dir, symbols):
+    """Mở dữ liệu nến bằng memmap chỉ đọc - mọi tiến trình dùng chung page cache, không sao chép"""
+    _SWEEP_DATA.clear()
+    _SWEEP_SIGNALS.clear()
+    for symbol in symbols:
+        _SWEEP_DATA[symbol] = {
+            column: np.load(os.path.join(cache_dir, f"{symbol}.{column}.npy"), mmap_mode='r')
+            for column in SWEEP_COLUMNS
+        }
+
+def _sweep_worker_run(task):
+    index, params, initial_balance, ruin_paths = task
+    try:
+        result = Backtester(signal_cache=_SWEEP_SIGNALS, **params).run(_SWEEP_DATA, initial_balance)
+        returns = np.array([t['return'] for t in result['trades']], dtype=float)
+        stats = dict(result['stats'], ruin_probability=ruin_probability(returns, paths=ruin_paths, seed=index))
+        return index, stats, None
+    except Exception as e:
+        return index, None, str(e)
+
+class ParameterSweep:
+    """Chạy Backtester cho hàng nghìn bộ tham số trên process pool
+
+    Nến được ghi 1 lần ra file .npy tạm (mỗi cột 1 file) và mọi worker mở bằng memmap chỉ đọc.
+    Kết quả xếp hạng theo tổng thứ hạng của lợi nhuận, drawdown và xác suất cháy tài khoản.
+    """
+    def __init__(self, data, workers=None, initial_balance=1000.0, ruin_paths=500):
+        self.data = data
+        self.workers = workers or os.cpu_count() or 1
+        self.initial_balance = initial_balance
+        self.ruin_paths = ruin_paths
+
+    @classmethod
+    def from_archive(cls, symbols, interval='5m', start_ms=None, end_ms=None, **kwargs):
+        return cls(Backtester.load(symbols, interval, start_ms, end_ms), **kwargs)
+
+    def _write_cache(self, cache_dir):
+        for symbol, candles in self.data.items():
+            for column in SWEEP_COLUMNS:
+                np.save(os.path.join(cache_dir, f"{symbol}.{column}.npy"), np.ascontiguousarray(candles[column]))
+
+    def run(self, param_sets):
+        """Trả về list {'params', 'stats', 'rank'} đã xếp hạng (tốt nhất trước)"""
+        param_sets = list(param_sets)
+        if not param_sets or not self.data:
+            return []
+        started = time.time()
+        results = [None] * len(param_sets)
+        cache_dir = tempfile.mkdtemp(prefix="sweep_")
+        try:
+            self._write_cache(cache_dir)
+            tasks = [(i, params, self.initial_balance, self.ruin_paths) for i, params in enumerate(param_sets)]
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_sweep_worker_init,
+                initargs=(cache_dir, list(self.data)),
+            ) as executor:
+                chunksize = max(1, len(tasks) // (self.workers * 8))
+                for done, (index, stats, error) in enumerate(
+                        executor.map(_sweep_worker_run, tasks, chunksize=chunksize), 1):
+                    if error:
+                        logger.error(f"❌ Lỗi backtest {param_sets[index]}: {error}")
+                    else:
+                        results[index] = {'params': param_sets[index], 'stats': stats}
+                    if done % 100 == 0:
+                        logger.info(f"🔬 Đã chạy {done}/{len(tasks)} bộ tham số")
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+        ranked = self.rank([r for r in results if r is not None])
+        logger.info(f"✅ Quét {len(param_sets)} bộ tham số xong sau {time.time() - started:.1f}s")
+        return ranked
+
+    @staticmethod
+    def rank(results):
+        """Xếp hạng theo tổng thứ hạng: lợi nhuận cao, drawdown thấp, xác suất cháy thấp"""
+        if not results:
+            return []
+        total_return = np.array([r['stats']['total_return'] for r in results])
+        drawdown = np.array([r['stats']['max_drawdown'] for r in results])
+        ruin = np.array([r['stats']['ruin_probability'] for r in results])
+        score = (np.argsort(np.argsort(-total_return)) + np.argsort(np.argsort(drawdown)) +
+                 np.argsort(np.argsort(ruin)))
+        order = np.lexsort((-total_return, score))
+        return [dict(results[i], rank=position + 1) for position, i in enumerate(order)]
+
 # ========== COIN MANAGER ==========
 class CoinManager:
     def __init__(self):
@@ -597,7 +2009,7 @@ class SmartCoinFinder:
         try:
             # Lấy dữ liệu kline 5 phút
             data = binance_api_request(
-                "https://fapi.binance.com/fapi/v1/klines",
+                f"{BINANCE_FAPI_URL}/fapi/v1/klines",
                 params={"symbol": symbol, "interval": "5m", "limit": 15}
             )
             if not data or len(data) < 15:
@@ -790,7 +2202,7 @@ class WebSocketManager:
         if self._stop_event.is_set():
             return
         stream = f"{symbol.lower()}@trade"
-        url = f"wss://fstream.binance.com/ws/{stream}"
+        url = f"{BINANCE_WS_URL}/ws/{stream}"
         
         def on_message(ws, message):
             try:
@@ -848,13 +2260,303 @@ class WebSocketManager:
                 del self.connections[symbol]
                 logger.info(f"WebSocket đã xóa cho {symbol}")
                 
+    def remove_symbols(self, symbols):
+        """Hủy nhiều stream cùng lúc - gỡ khỏi danh sách dưới 1 lần khóa rồi đóng song song"""
+        with self._lock:
+            removed = []
+            for symbol in {s.upper() for s in symbols if s}:
+                connection = self.connections.pop(symbol, None)
+                if connection:
+                    removed.append((symbol, connection['ws']))
+        if not removed:
+            return 0
+
+        def close(item):
+            symbol, ws = item
+            try:
+                ws.close()
+            except Exception as e:
+                logger.error(f"Lỗi đóng WebSocket {symbol}: {str(e)}")
+
+        with ThreadPoolExecutor(max_workers=min(16, len(removed))) as ex:
+            list(ex.map(close, removed))
+        logger.info(f"WebSocket đã xóa {len(removed)} stream")
+        return len(removed)
+
     def stop(self):
         self._stop_event.set()
-        for symbol in list(self.connections.keys()):
-            self.remove_symbol(symbol)
+        self.remove_symbols(list(self.connections.keys()))
+
+# ========== SNAPSHOT TRẠNG THÁI BOT ==========
+# Các trường symbol_data cần giữ qua restart (giá realtime / mốc kiểm tra tạm thời thì bỏ)
+PERSISTED_SYMBOL_FIELDS = (
+    'status', 'side', 'qty', 'entry', 'position_open', 'last_trade_time', 'last_close_time',
+    'entry_base', 'average_down_count', 'last_average_down_time', 'high_water_mark_roi',
+    'roi_check_activated', 'pending_order'
+)
+
+def account_tag(api_key):
+    """Định danh tài khoản trong snapshot / nhật ký (không lưu API key)"""
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:12]
+
+class BotStateStore:
+    """Lưu định kỳ trạng thái BaseBot ra đĩa (1 file JSON/bot, ghi nguyên tử tmp + os.replace)
+
+    1 luồng nền cho cả tiến trình; chỉ ghi khi nội dung đổi. Bot dừng chủ động thì xóa file,
+    tiến trình chết/restart thì file còn lại để bot cùng bot_id tiếp tục từ đó.
+    """
+    def __init__(self, directory=None, interval=None, max_age=None):
+        self.directory = directory or os.getenv("BOT_STATE_DIR", "./bot_state")
+        self.interval = float(interval if interval is not None else os.getenv("BOT_STATE_INTERVAL", "10"))
+        self.max_age = float(max_age if max_age is not None else os.getenv("BOT_STATE_MAX_AGE", str(6 * 3600)))
+        self._bots = {}
+        self._written = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _path(self, bot_id):
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in str(bot_id))
+        return os.path.join(self.directory, f"{safe}.json")
+
+    def register(self, bot):
+        with self._lock:
+            self._bots[bot.bot_id] = bot
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="bot-state-store", daemon=True)
+                self._thread.start()
+
+    def discard(self, bot_id):
+        """Bot dừng chủ động: bỏ theo dõi và xóa snapshot"""
+        with self._lock:
+            self._bots.pop(bot_id, None)
+            self._written.pop(bot_id, None)
+        try:
+            os.remove(self._path(bot_id))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Lỗi xóa snapshot {bot_id}: {str(e)}")
+
+    def snapshot(self, bot):
+        symbol_data = {}
+        for symbol in list(bot.active_symbols):
+            data = bot.symbol_data.get(symbol)
+            if data is not None:
+                symbol_data[symbol] = {k: data.get(k) for k in PERSISTED_SYMBOL_FIELDS}
+        return {
+            'version': 1,
+            'bot_id': bot.bot_id,
+            'account': account_tag(bot.api_key),
+            'saved_at': time.time(),
+            'symbol': bot.symbol,
+            'max_coins': bot.max_coins,
+            'active_symbols': list(bot.active_symbols),
+            'symbol_data': symbol_data,
+            'last_trade_completion_time': bot.last_trade_completion_time
+        }
+
+    def save(self, bot):
+        state = self.snapshot(bot)
+        # So sánh bỏ qua saved_at để không ghi lại khi không có gì đổi
+        body = json.dumps(dict(state, saved_at=0), separators=(',', ':'), sort_keys=True)
+        if self._written.get(bot.bot_id) == body:
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(bot.bot_id)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._written[bot.bot_id] = body
+        return True
+
+    def load(self, bot_id, api_key):
+        """Snapshot còn hạn của bot_id cho đúng tài khoản, hoặc None"""
+        try:
+            with open(self._path(bot_id)) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error(f"Snapshot {bot_id} hỏng, bỏ qua: {str(e)}")
+            return None
+        if state.get('version') != 1 or state.get('account') != account_tag(api_key):
+            return None
+        if time.time() - float(state.get('saved_at', 0)) > self.max_age:
+            return None
+        return state
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                bots = list(self._bots.values())
+            for bot in bots:
+                try:
+                    if bot._stop:
+                        self.discard(bot.bot_id)
+                    else:
+                        self.save(bot)
+                except Exception as e:
+                    logger.error(f"Lỗi lưu snapshot {bot.bot_id}: {str(e)}")
+
+bot_state_store = BotStateStore()
+
+# ========== NHẬT KÝ GIAO DỊCH ==========
+TRADE_JOURNAL_FIELDS = (
+    'ts', 'account', 'bot_id', 'symbol', 'event', 'side', 'order_id', 'client_order_id', 'qty', 'price',
+    'commission', 'commission_asset', 'realized_pnl', 'roi', 'reason', 'average_down_count', 'extra'
+)
+
+class TradeJournal:
+    """Nhật ký sự kiện giao dịch (mở / đóng / nhồi lệnh) trong SQLite WAL, append-only
+
+    record() chỉ đưa vào hàng đợi (không bao giờ chặn luồng giao dịch); 1 luồng nền gom
+    theo lô và ghi trong 1 transaction. Index theo thời gian để truy vấn khoảng nhanh.
+    """
+    def __init__(self, path=None, batch_size=500, flush_interval=0.5, max_queue=100000):
+        self.path = path or os.getenv("TRADE_JOURNAL_PATH", "./trade_journal.db")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._dropped = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _ensure_schema(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS trade_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                account TEXT,
+                bot_id TEXT,
+                symbol TEXT,
+                event TEXT NOT NULL,
+                side TEXT,
+                order_id TEXT,
+                client_order_id TEXT,
+                qty REAL,
+                price REAL,
+                commission REAL,
+                commission_asset TEXT,
+                realized_pnl REAL,
+                roi REAL,
+                reason TEXT,
+                average_down_count INTEGER,
+                extra TEXT
+            );
+            CREATE INDEX IF NOT EXISTS ix_trade_events_ts ON trade_events (ts);
+            CREATE INDEX IF NOT EXISTS ix_trade_events_account_ts ON trade_events (account, ts);
+            CREATE INDEX IF NOT EXISTS ix_trade_events_bot_ts ON trade_events (bot_id, ts);
+            CREATE INDEX IF NOT EXISTS ix_trade_events_symbol_ts ON trade_events (symbol, ts);
+        """)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer_loop, name="trade-journal", daemon=True)
+                self._thread.start()
+
+    def record(self, event, **fields):
+        """Ghi 1 sự kiện (không chặn); trả về False nếu hàng đợi đầy và sự kiện bị bỏ"""
+        fields['event'] = event
+        fields.setdefault('ts', time.time())
+        if isinstance(fields.get('extra'), dict):
+            fields['extra'] = json.dumps(fields['extra'], separators=(',', ':'))
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(tuple(fields.get(k) for k in TRADE_JOURNAL_FIELDS))
+            return True
+        except queue.Full:
+            self._dropped += 1
+            if self._dropped % 1000 == 1:
+                logger.error(f"❌ Hàng đợi nhật ký giao dịch đầy, đã bỏ {self._dropped} sự kiện")
+            return False
+
+    def _writer_loop(self):
+        conn = None
+        sql = (f"INSERT INTO trade_events ({', '.join(TRADE_JOURNAL_FIELDS)}) "
+               f"VALUES ({', '.join('?' for _ in TRADE_JOURNAL_FIELDS)})")
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Thử lại vài lần nếu DB bận (nhiều tiến trình worker ghi chung file)
+            for attempt in range(5):
+                try:
+                    if conn is None:
+                        conn = self._connect()
+                        self._ensure_schema(conn)
+                    with conn:
+                        conn.executemany(sql, batch)
+                    break
+                except sqlite3.Error as e:
+                    logger.error(f"❌ Lỗi ghi nhật ký giao dịch (lần {attempt + 1}): {str(e)}")
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                    conn = None
+                    time.sleep(1)
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self, timeout=5):
+        """Chờ hàng đợi ghi hết (dùng khi tắt tiến trình)"""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+        return not self._queue.unfinished_tasks
+
+    def query(self, start=None, end=None, account=None, bot_id=None, symbol=None, event=None, limit=1000):
+        """Sự kiện trong khoảng thời gian [start, end) (epoch giây), mới nhất trước"""
+        clauses, params = [], []
+        for column, op, value in (('ts', '>=', start), ('ts', '<', end), ('account', '=', account),
+                                  ('bot_id', '=', bot_id), ('symbol', '=', symbol), ('event', '=', event)):
+            if value is not None:
+                clauses.append(f"{column} {op} ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        params.append(int(limit))
+        try:
+            conn = self._connect()
+        except sqlite3.Error as e:
+            logger.error(f"❌ Không mở được nhật ký giao dịch: {str(e)}")
+            return []
+        try:
+            self._ensure_schema(conn)
+            rows = conn.execute(
+                f"SELECT {', '.join(TRADE_JOURNAL_FIELDS)} FROM trade_events {where} ORDER BY ts DESC LIMIT ?",
+                params
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(zip(TRADE_JOURNAL_FIELDS, row)) for row in rows]
+
+trade_journal = TradeJournal()
 
 # ========== BASE BOT VỚI HỆ THỐNG RSI + KHỐI LƯỢNG MỚI ==========
 class BaseBot:
+    # Tín hiệu đóng lệnh dựa trên nến 5m → chỉ gọi REST klines tối đa 1 lần mỗi nến cho mỗi symbol
+    EXIT_SIGNAL_CANDLE_SECONDS = 300
+
     def __init__(self, symbol, lev, percent, tp, sl, roi_trigger, ws_manager, api_key, api_secret,
                  telegram_bot_token, telegram_chat_id, strategy_name, config_key=None, bot_id=None,
                  coin_manager=None, symbol_locks=None, max_coins=1):
@@ -884,6 +2586,8 @@ class BaseBot:
 
         # Biến để quản lý tuần tự TRONG CÙNG 1 BOT
         self.current_processing_symbol = None
+        # Khóa xử lý từng coin: vòng lặp bot giữ khi đặt/đóng lệnh, luồng dừng coin chờ khóa rồi mới dọn
+        self._symbol_work_locks = {}
         self.last_trade_completion_time = 0
         self.trade_cooldown = 3  # Chờ 3s sau mỗi lệnh
 
@@ -910,9 +2614,14 @@ class BaseBot:
         self.find_new_bot_after_close = True
         self.bot_creation_time = time.time()
 
+        # Có snapshot từ lần chạy trước → gắn lại coin/vị thế cũ, không quét lại từ đầu
+        snapshot = bot_state_store.load(self.bot_id, api_key)
+        if snapshot:
+            self._resume_from_snapshot(snapshot)
         # Khởi tạo symbol đầu tiên nếu có
-        if symbol and not self.coin_finder.has_existing_position(symbol):
+        elif symbol and not self.coin_finder.has_existing_position(symbol):
             self._add_symbol(symbol)
+        bot_state_store.register(self)
         
         self.thread = threading.Thread(target=self._run, daemon=True)
         self.thread.start()
@@ -938,19 +2647,25 @@ class BaseBot:
                         time.sleep(3)
                     else:
                         time.sleep(5)
-                
+
+                # 🔴 KIỂM TRA TẤT CẢ VỊ THẾ ĐANG MỞ TRONG 1 LƯỢT (ROI/TP/SL/NHỒI LỆNH)
+                self._check_open_positions()
+
                 # 🔴 SỬA: XỬ LÝ TUẦN TỰ TỪNG COIN TRONG BOT
                 if self.active_symbols:
                     # Chọn coin tiếp theo để xử lý (theo thứ tự)
                     symbol_to_process = self.active_symbols[0]
-                    self.current_processing_symbol = symbol_to_process
-                    
-                    # Kiểm tra cooldown giữa các coin trong cùng bot
-                    if current_time - self.last_symbol_process_time > self.symbol_process_cooldown:
-                        trade_executed = self._process_single_symbol(symbol_to_process)
-                        self.last_symbol_process_time = current_time
-                    
-                    self.current_processing_symbol = None
+                    with self._symbol_lock(symbol_to_process):
+                        # Coin có thể vừa bị dừng trong lúc chờ khóa
+                        if not self._stop and symbol_to_process in self.symbol_data:
+                            self.current_processing_symbol = symbol_to_process
+
+                            # Kiểm tra cooldown giữa các coin trong cùng bot
+                            if current_time - self.last_symbol_process_time > self.symbol_process_cooldown:
+                                trade_executed = self._process_single_symbol(symbol_to_process)
+                                self.last_symbol_process_time = current_time
+
+                            self.current_processing_symbol = None
                 
                 time.sleep(1)  # Giảm CPU usage
                 
@@ -979,15 +2694,8 @@ class BaseBot:
             
             # Xử lý theo trạng thái
             if symbol_info['position_open']:
-                # 🔴 KIỂM TRA ĐÓNG LỆNH THÔNG MINH (ROI + TÍN HIỆU 40%)
-                if self._check_smart_exit_condition(symbol):
-                    return True
-                
-                # Kiểm tra TP/SL truyền thống
-                self._check_symbol_tp_sl(symbol)
-                
-                # Kiểm tra nhồi lệnh
-                self._check_symbol_averaging_down(symbol)
+                # Vị thế đang mở được kiểm tra chung trong _check_open_positions (mỗi tick)
+                return False
             else:
                 # Tìm cơ hội vào lệnh - CHỈ KHI ĐỦ THỜI GIAN CHỜ
                 if (current_time - symbol_info['last_trade_time'] > 60 and 
@@ -1015,34 +2723,98 @@ class BaseBot:
             self.log(f"❌ Lỗi xử lý {symbol}: {str(e)}")
             return False
 
-    def _check_smart_exit_condition(self, symbol):
+    def _evaluate_symbols(self, symbols):
+        """Đánh giá ROI/TP/SL/nhồi lệnh cho nhiều symbol trong 1 lượt - ưu tiên giá WebSocket"""
+        rows = []
+        now = time.time()
+        for symbol in symbols:
+            data = self.symbol_data.get(symbol)
+            if not data or not data['position_open'] or data['entry'] <= 0:
+                continue
+            price = data.get('current_price', 0)
+            if price <= 0 or now - data.get('last_price_update', 0) > 5:
+                # Giá WebSocket chưa có hoặc đã cũ → lấy qua REST
+                price = get_current_price(symbol)
+            if price <= 0:
+                continue
+            rows.append((symbol, data, price))
+
+        if not rows:
+            return {}
+
+        result = evaluate_positions(
+            entry=[data['entry'] for _, data, _ in rows],
+            qty=[data['qty'] for _, data, _ in rows],
+            side=[data['side'] for _, data, _ in rows],
+            lev=self.lev,
+            price=[price for _, _, price in rows],
+            high_water_mark_roi=[data['high_water_mark_roi'] for _, data, _ in rows],
+            tp=self.tp,
+            sl=self.sl,
+            roi_trigger=self.roi_trigger,
+            entry_base=[data['entry_base'] for _, data, _ in rows],
+            average_down_count=[data['average_down_count'] for _, data, _ in rows],
+        )
+
+        evaluations = {}
+        for i, (symbol, _, price) in enumerate(rows):
+            evaluations[symbol] = {key: values[i].item() for key, values in result.items()}
+            evaluations[symbol]['price'] = price
+        return evaluations
+
+    def _check_open_positions(self):
+        """Kiểm tra TẤT CẢ vị thế đang mở của bot bằng 1 lượt đánh giá vector hóa"""
+        open_symbols = [s for s in self.active_symbols
+                        if self.symbol_data.get(s, {}).get('position_open')]
+        if not open_symbols:
+            return
+
+        evaluations = self._evaluate_symbols(open_symbols)
+        for symbol, evaluation in evaluations.items():
+            if self._stop:
+                break
+            with self._symbol_lock(symbol):
+                if self._stop or symbol not in self.symbol_data:
+                    continue
+                self.current_processing_symbol = symbol
+                try:
+                    # 🔴 KIỂM TRA ĐÓNG LỆNH THÔNG MINH (ROI + TÍN HIỆU 40%)
+                    if self._check_smart_exit_condition(symbol, evaluation):
+                        continue
+
+                    # Kiểm tra TP/SL truyền thống
+                    self._check_symbol_tp_sl(symbol, evaluation)
+
+                    # Kiểm tra nhồi lệnh
+                    self._check_symbol_averaging_down(symbol, evaluation)
+                finally:
+                    self.current_processing_symbol = None
+
+    def _check_smart_exit_condition(self, symbol, evaluation=None):
         """Kiểm tra điều kiện đóng lệnh thông minh - GIỐNG HỆT ĐIỀU KIỆN VÀO LỆNH"""
         try:
-            if not self.symbol_data[symbol]['position_open']:
+            if not self.symbol_data.get(symbol, {}).get('position_open'):
                 return False
-            
+
             # Chỉ kiểm tra nếu đã kích hoạt ROI trigger
             if not self.symbol_data[symbol]['roi_check_activated']:
                 return False
-            
-            current_price = get_current_price(symbol)
-            if current_price <= 0:
-                return False
-            
-            # Tính ROI hiện tại
-            if self.symbol_data[symbol]['side'] == "BUY":
-                profit = (current_price - self.symbol_data[symbol]['entry']) * abs(self.symbol_data[symbol]['qty'])
-            else:
-                profit = (self.symbol_data[symbol]['entry'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-                
-            invested = self.symbol_data[symbol]['entry'] * abs(self.symbol_data[symbol]['qty']) / self.lev
-            if invested <= 0:
+
+            if evaluation is None:
+                evaluation = self._evaluate_symbols([symbol]).get(symbol)
+            if not evaluation or not evaluation['valid']:
                 return False
-                
-            current_roi = (profit / invested) * 100
-            
+
+            current_roi = evaluation['roi']
+
             # Kiểm tra nếu đạt ROI trigger
-            if current_roi >= self.roi_trigger:
+            if evaluation['roi_exit_ready']:
+                # Mỗi tick chỉ đánh giá ROI (rẻ); tín hiệu đóng lệnh lấy tối đa 1 lần mỗi nến 5m
+                candle = int(time.time() // self.EXIT_SIGNAL_CANDLE_SECONDS)
+                if self.symbol_data[symbol].get('exit_signal_candle') == candle:
+                    return False
+                self.symbol_data[symbol]['exit_signal_candle'] = candle
+
                 # 🔴 SỬ DỤNG TÍN HIỆU ĐÓNG LỆNH (40% khối lượng) - GIỐNG HỆT ĐIỀU KIỆN VÀO LỆNH
                 exit_signal = self.coin_finder.get_exit_signal(symbol)
                 
@@ -1111,7 +2883,22 @@ class BaseBot:
             return False
         
         # Khởi tạo dữ liệu cho symbol
-        self.symbol_data[symbol] = {
+        self.symbol_data[symbol] = self._new_symbol_data()
+        self._attach_symbol(symbol)
+        
+        # Kiểm tra vị thế hiện tại
+        self._check_symbol_position(symbol)
+        
+        # 🔴 KIỂM TRA LẦN CUỐI: Nếu phát hiện có vị thế, dừng ngay
+        if self.symbol_data[symbol]['position_open']:
+            self.stop_symbol(symbol)
+            return False
+        
+        return True
+
+    @staticmethod
+    def _new_symbol_data():
+        return {
             'status': 'waiting',
             'side': '',
             'qty': 0,
@@ -1127,27 +2914,78 @@ class BaseBot:
             'roi_check_activated': False,
             'close_attempted': False,
             'last_close_attempt': 0,
-            'last_position_check': 0
+            'last_position_check': 0,
+            'last_price_update': 0,
+            'exit_signal_candle': -1,
+            'pending_order': None
         }
-        
+
+    def _attach_symbol(self, symbol):
         self.active_symbols.append(symbol)
         self.coin_manager.register_coin(symbol)
         self.ws_manager.add_symbol(symbol, lambda price, sym=symbol: self._handle_price_update(price, sym))
-        
-        # Kiểm tra vị thế hiện tại
-        self._check_symbol_position(symbol)
-        
-        # 🔴 KIỂM TRA LẦN CUỐI: Nếu phát hiện có vị thế, dừng ngay
-        if self.symbol_data[symbol]['position_open']:
-            self.stop_symbol(symbol)
-            return False
-        
-        return True
+
+    def _resume_from_snapshot(self, snapshot):
+        """Khôi phục coin + thang nhồi lệnh/ROI từ snapshot, rồi đối chiếu vị thế thật trên Binance"""
+        resumed = []
+        for symbol in snapshot.get('active_symbols', [])[:self.max_coins]:
+            data = self._new_symbol_data()
+            data.update({k: v for k, v in snapshot.get('symbol_data', {}).get(symbol, {}).items()
+                         if k in PERSISTED_SYMBOL_FIELDS})
+            self.symbol_data[symbol] = data
+            self._attach_symbol(symbol)
+            # Vị thế đã đóng trong lúc dừng → reset; còn mở → giữ entry_base/average_down_count/ROI
+            self._check_symbol_position(symbol)
+            resumed.append(symbol)
+        self.last_trade_completion_time = snapshot.get('last_trade_completion_time', 0)
+        if resumed:
+            self.status = "waiting"
+        open_count = sum(1 for s in resumed if self.symbol_data[s]['position_open'])
+        self.log(f"♻️ Khôi phục từ snapshot: {len(resumed)} coin ({open_count} vị thế đang mở)")
+
+    def _client_order_id(self, symbol, action, side):
+        """Client order id cho 1 ý định lệnh của symbol
+
+        Mỗi ý định có nonce riêng (không lặp lại sau khi thêm lại coin / khởi động lại bot).
+        Chỉ khi lượt trước của CÙNG ý định chưa rõ kết quả (place_order trả về None) thì mới
+        dùng lại id đó; trả về (client_order_id, retry) - retry=True thì place_order tra cứu trước khi gửi.
+        """
+        data = self.symbol_data[symbol]
+        intent = f"{action}:{side}"
+        pending = data.get('pending_order')
+        if (pending and pending.get('intent') == intent and
+                time.time() - pending.get('created_at', 0) < ORDER_INTENT_RETRY_WINDOW):
+            return pending['client_order_id'], True
+        client_order_id = make_client_order_id(self.bot_id, symbol, action, uuid.uuid4().hex)
+        data['pending_order'] = {'intent': intent, 'client_order_id': client_order_id, 'created_at': time.time()}
+        return client_order_id, False
+
+    def _finish_order_intent(self, symbol, result):
+        """Ý định lệnh đã có kết quả chắc chắn (khớp hoặc bị từ chối) → lần sau dùng id mới"""
+        if result is not None and symbol in self.symbol_data:
+            self.symbol_data[symbol]['pending_order'] = None
+
+    def _journal(self, event, symbol, execution, client_order_id, **fields):
+        """Ghi 1 sự kiện khớp lệnh vào nhật ký giao dịch (không chặn)"""
+        fields.setdefault('average_down_count', self.symbol_data.get(symbol, {}).get('average_down_count', 0))
+        trade_journal.record(
+            event,
+            account=account_tag(self.api_key),
+            bot_id=self.bot_id,
+            symbol=symbol,
+            side=execution.get('side'),
+            order_id=str(execution.get('order_id')) if execution.get('order_id') is not None else None,
+            client_order_id=client_order_id,
+            commission=execution.get('commission'),
+            commission_asset=execution.get('commission_asset'),
+            **fields
+        )
 
     def _handle_price_update(self, price, symbol):
         """Xử lý cập nhật giá cho từng symbol"""
         if symbol in self.symbol_data:
             self.symbol_data[symbol]['current_price'] = price
+            self.symbol_data[symbol]['last_price_update'] = time.time()
 
     def _check_symbol_position(self, symbol):
         """Kiểm tra vị thế cho một symbol cụ thể"""
@@ -1170,18 +3008,10 @@ class BaseBot:
                         self.symbol_data[symbol]['entry'] = float(pos.get('entryPrice', 0))
                         
                         # Kích hoạt ROI check nếu đang có lợi nhuận
-                        current_price = get_current_price(symbol)
-                        if current_price > 0:
-                            if self.symbol_data[symbol]['side'] == "BUY":
-                                profit = (current_price - self.symbol_data[symbol]['entry']) * abs(self.symbol_data[symbol]['qty'])
-                            else:
-                                profit = (self.symbol_data[symbol]['entry'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-                                
-                            invested = self.symbol_data[symbol]['entry'] * abs(self.symbol_data[symbol]['qty']) / self.lev
-                            if invested > 0:
-                                current_roi = (profit / invested) * 100
-                                if current_roi >= self.roi_trigger:
-                                    self.symbol_data[symbol]['roi_check_activated'] = True
+                        evaluation = self._evaluate_symbols([symbol]).get(symbol)
+                        if evaluation and evaluation['valid']:
+                            if self.roi_trigger is not None and evaluation['roi'] >= self.roi_trigger:
+                                self.symbol_data[symbol]['roi_check_activated'] = True
                         break
                     else:
                         position_found = True
@@ -1265,21 +3095,29 @@ class BaseBot:
             cancel_all_orders(symbol, self.api_key, self.api_secret)
             time.sleep(0.2)
 
-            result = place_order(symbol, side, qty, self.api_key, self.api_secret)
+            client_order_id, retry = self._client_order_id(symbol, "OPEN", side)
+            result = place_order(symbol, side, qty, self.api_key, self.api_secret,
+                                 client_order_id=client_order_id, lookup_first=retry)
+            self._finish_order_intent(symbol, result)
             if result and 'orderId' in result:
-                executed_qty = float(result.get('executedQty', 0))
-                avg_price = float(result.get('avgPrice', current_price))
+                execution = get_execution_report(symbol, result, self.api_key, self.api_secret)
+                executed_qty = execution['qty']
+                avg_price = execution['avg_price'] or current_price
 
                 if executed_qty >= 0:
-                    # 🔴 KIỂM TRA LẦN CUỐI: Đảm bảo vị thế thực sự được mở
-                    time.sleep(1)
-                    self._check_symbol_position(symbol)
-                    
-                    if not self.symbol_data[symbol]['position_open']:
-                        self.log(f"❌ {symbol} - Lệnh đã khớp nhưng không tạo được vị thế, có thể bị hủy")
-                        self.stop_symbol(symbol)
-                        return False
-                    
+                    if executed_qty <= 0:
+                        # 🔴 KHÔNG CÓ THÔNG TIN KHỚP: Đối chiếu vị thế thực tế trên Binance
+                        time.sleep(1)
+                        self._check_symbol_position(symbol)
+                        
+                        if not self.symbol_data[symbol]['position_open']:
+                            self.log(f"❌ {symbol} - Lệnh đã khớp nhưng không tạo được vị thế, có thể bị hủy")
+                            self.stop_symbol(symbol)
+                            return False
+                        
+                        executed_qty = abs(self.symbol_data[symbol]['qty'])
+                        avg_price = self.symbol_data[symbol]['entry'] or avg_price
+
                     # Cập nhật thông tin vị thế
                     self.symbol_data[symbol]['entry'] = avg_price
                     self.symbol_data[symbol]['entry_base'] = avg_price
@@ -1290,6 +3128,8 @@ class BaseBot:
                     self.symbol_data[symbol]['status'] = "open"
                     self.symbol_data[symbol]['high_water_mark_roi'] = 0
                     self.symbol_data[symbol]['roi_check_activated'] = False
+                    self._journal("OPEN", symbol, execution, client_order_id,
+                                  qty=executed_qty, price=avg_price, extra={'lev': self.lev})
 
                     message = (
                         f"✅ <b>ĐÃ MỞ VỊ THẾ {symbol}</b>\n"
@@ -1298,12 +3138,14 @@ class BaseBot:
                         f"🏷️ Giá vào: {avg_price:.4f}\n"
                         f"📊 Khối lượng: {executed_qty:.4f}\n"
                         f"💰 Đòn bẩy: {self.lev}x\n"
-                        f"🎯 TP: {self.tp}% | 🛡️ SL: {self.sl}%"
                     )
+                    if execution['commission'] is not None:
+                        message += f"💸 Phí: {execution['commission']:.4f} {execution['commission_asset']}\n"
+                    message += f"🎯 TP: {self.tp}% | 🛡️ SL: {self.sl}%"
                     if self.roi_trigger:
                         message += f" | 🎯 ROI Trigger: {self.roi_trigger}%"
                     
-                    self.log(message)
+                    self.log(message, priority=TELEGRAM_PRIORITY_HIGH)
                     return True
                 else:
                     self.log(f"❌ {symbol} - Lệnh không khớp")
@@ -1349,26 +3191,46 @@ class BaseBot:
             cancel_all_orders(symbol, self.api_key, self.api_secret)
             time.sleep(0.5)
             
-            result = place_order(symbol, close_side, close_qty, self.api_key, self.api_secret)
+            client_order_id, retry = self._client_order_id(symbol, "CLOSE", close_side)
+            result = place_order(symbol, close_side, close_qty, self.api_key, self.api_secret,
+                                 client_order_id=client_order_id, lookup_first=retry)
+            self._finish_order_intent(symbol, result)
             if result and 'orderId' in result:
-                current_price = get_current_price(symbol)
-                pnl = 0
-                if self.symbol_data[symbol]['entry'] > 0:
-                    if self.symbol_data[symbol]['side'] == "BUY":
-                        pnl = (current_price - self.symbol_data[symbol]['entry']) * abs(self.symbol_data[symbol]['qty'])
-                    else:
-                        pnl = (self.symbol_data[symbol]['entry'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-                
+                execution = get_execution_report(symbol, result, self.api_key, self.api_secret)
+                # Giá ra = giá khớp thực tế; chỉ khi thiếu mới dùng giá WebSocket gần nhất
+                exit_price = execution['avg_price'] or self.symbol_data[symbol].get('current_price', 0)
+                pnl = execution['realized_pnl']
+                if pnl is None:
+                    pnl = 0
+                    if self.symbol_data[symbol]['entry'] > 0 and exit_price > 0:
+                        pnl = float(evaluate_positions(
+                            entry=self.symbol_data[symbol]['entry'],
+                            qty=self.symbol_data[symbol]['qty'],
+                            side=self.symbol_data[symbol]['side'],
+                            lev=self.lev,
+                            price=exit_price
+                        )['profit'][0])
+
+                # ROI trên vốn ký quỹ (entry * qty / lev), cùng cách tính với TP/SL
+                entry = self.symbol_data[symbol]['entry']
+                margin = entry * close_qty / self.lev if entry > 0 and self.lev else 0
+                self._journal("CLOSE", symbol, execution, client_order_id,
+                              qty=close_qty, price=exit_price, realized_pnl=pnl,
+                              roi=pnl / margin * 100 if margin > 0 else None, reason=reason,
+                              extra={'entry': entry, 'lev': self.lev})
+
                 message = (
                     f"⛔ <b>ĐÃ ĐÓNG VỊ THẾ {symbol}</b>\n"
                     f"🤖 Bot: {self.bot_id}\n"
                     f"📌 Lý do: {reason}\n"
-                    f"🏷️ Giá ra: {current_price:.4f}\n"
+                    f"🏷️ Giá ra: {exit_price:.4f}\n"
                     f"📊 Khối lượng: {close_qty:.4f}\n"
                     f"💰 PnL: {pnl:.2f} USDC\n"
-                    f"📈 Số lần nhồi: {self.symbol_data[symbol]['average_down_count']}"
                 )
-                self.log(message)
+                if execution['commission'] is not None:
+                    message += f"💸 Phí: {execution['commission']:.4f} {execution['commission_asset']}\n"
+                message += f"📈 Số lần nhồi: {self.symbol_data[symbol]['average_down_count']}"
+                self.log(message, priority=TELEGRAM_PRIORITY_HIGH)
                 
                 self.symbol_data[symbol]['last_close_time'] = time.time()
                 self._reset_symbol_position(symbol)
@@ -1385,90 +3247,57 @@ class BaseBot:
             self.symbol_data[symbol]['close_attempted'] = False
             return False
 
-    def _check_symbol_tp_sl(self, symbol):
+    def _check_symbol_tp_sl(self, symbol, evaluation=None):
         """Kiểm tra TP/SL cho một symbol cụ thể"""
-        if (not self.symbol_data[symbol]['position_open'] or 
-            self.symbol_data[symbol]['entry'] <= 0 or 
+        if (not self.symbol_data.get(symbol, {}).get('position_open') or
+            self.symbol_data[symbol]['entry'] <= 0 or
             self.symbol_data[symbol]['close_attempted']):
             return
 
-        current_price = get_current_price(symbol)
-        if current_price <= 0:
+        if evaluation is None:
+            evaluation = self._evaluate_symbols([symbol]).get(symbol)
+        if not evaluation or not evaluation['valid']:
             return
 
-        if self.symbol_data[symbol]['side'] == "BUY":
-            profit = (current_price - self.symbol_data[symbol]['entry']) * abs(self.symbol_data[symbol]['qty'])
-        else:
-            profit = (self.symbol_data[symbol]['entry'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-            
-        invested = self.symbol_data[symbol]['entry'] * abs(self.symbol_data[symbol]['qty']) / self.lev
-        if invested <= 0:
-            return
-            
-        roi = (profit / invested) * 100
+        roi = evaluation['roi']
 
         # CẬP NHẬT ROI CAO NHẤT
-        if roi > self.symbol_data[symbol]['high_water_mark_roi']:
-            self.symbol_data[symbol]['high_water_mark_roi'] = roi
+        self.symbol_data[symbol]['high_water_mark_roi'] = evaluation['high_water_mark_roi']
 
         # KIỂM TRA ĐIỀU KIỆN ROI TRIGGER
-        if (self.roi_trigger is not None and 
-            self.symbol_data[symbol]['high_water_mark_roi'] >= self.roi_trigger and 
-            not self.symbol_data[symbol]['roi_check_activated']):
+        if evaluation['roi_check_activated'] and not self.symbol_data[symbol]['roi_check_activated']:
             self.symbol_data[symbol]['roi_check_activated'] = True
 
         # TP/SL TRUYỀN THỐNG
-        if self.tp is not None and roi >= self.tp:
+        if evaluation['tp_hit']:
             self._close_symbol_position(symbol, f"✅ Đạt TP {self.tp}% (ROI: {roi:.2f}%)")
-        elif self.sl is not None and self.sl > 0 and roi <= -self.sl:
+        elif evaluation['sl_hit']:
             self._close_symbol_position(symbol, f"❌ Đạt SL {self.sl}% (ROI: {roi:.2f}%)")
 
-    def _check_symbol_averaging_down(self, symbol):
+    def _check_symbol_averaging_down(self, symbol, evaluation=None):
         """Kiểm tra nhồi lệnh cho một symbol cụ thể"""
-        if (not self.symbol_data[symbol]['position_open'] or 
-            not self.symbol_data[symbol]['entry_base'] or 
-            self.symbol_data[symbol]['average_down_count'] >= 7):
+        if (not self.symbol_data.get(symbol, {}).get('position_open') or
+            not self.symbol_data[symbol]['entry_base'] or
+            self.symbol_data[symbol]['average_down_count'] >= len(FIB_AVERAGE_DOWN_LEVELS)):
             return
-            
+
         try:
             current_time = time.time()
             if current_time - self.symbol_data[symbol]['last_average_down_time'] < 60:
                 return
-                
-            current_price = get_current_price(symbol)
-            if current_price <= 0:
-                return
-                
-            # Tính ROI ÂM hiện tại (lỗ)
-            if self.symbol_data[symbol]['side'] == "BUY":
-                profit = (current_price - self.symbol_data[symbol]['entry_base']) * abs(self.symbol_data[symbol]['qty'])
-            else:
-                profit = (self.symbol_data[symbol]['entry_base'] - current_price) * abs(self.symbol_data[symbol]['qty'])
-                
-            invested = self.symbol_data[symbol]['entry_base'] * abs(self.symbol_data[symbol]['qty']) / self.lev
-            if invested <= 0:
-                return
-                
-            current_roi = (profit / invested) * 100
-            
-            # Chỉ xét khi ROI ÂM (đang lỗ)
-            if current_roi >= 0:
+
+            if evaluation is None:
+                evaluation = self._evaluate_symbols([symbol]).get(symbol)
+            if not evaluation:
                 return
-                
-            # Chuyển ROI âm thành số dương để so sánh
-            roi_negative = abs(current_roi)
-            
-            # Các mốc Fibonacci
-            fib_levels = [200, 300, 500, 800, 1300, 2100, 3400]
-            
-            if self.symbol_data[symbol]['average_down_count'] < len(fib_levels):
-                current_fib_level = fib_levels[self.symbol_data[symbol]['average_down_count']]
-                
-                if roi_negative >= current_fib_level:
-                    if self._execute_symbol_average_down(symbol):
-                        self.symbol_data[symbol]['last_average_down_time'] = current_time
-                        self.symbol_data[symbol]['average_down_count'] += 1
-                        self.log(f"📈 {symbol} - Đã nhồi lệnh Fibonacci ở mốc {current_fib_level}% lỗ")
+
+            # Chỉ nhồi khi ROI âm (tính trên entry_base) vượt mốc Fibonacci hiện tại
+            if evaluation['fib_hit']:
+                current_fib_level = evaluation['fib_level']
+                if self._execute_symbol_average_down(symbol):
+                    self.symbol_data[symbol]['last_average_down_time'] = current_time
+                    self.symbol_data[symbol]['average_down_count'] += 1
+                    self.log(f"📈 {symbol} - Đã nhồi lệnh Fibonacci ở mốc {current_fib_level:.0f}% lỗ")
                         
         except Exception as e:
             self.log(f"❌ {symbol} - Lỗi kiểm tra nhồi lệnh: {str(e)}")
@@ -1498,36 +3327,65 @@ class BaseBot:
                 return False
                 
             # Đặt lệnh cùng hướng với vị thế hiện tại
-            result = place_order(symbol, self.symbol_data[symbol]['side'], qty, self.api_key, self.api_secret)
+            client_order_id, retry = self._client_order_id(symbol, "AVG", self.symbol_data[symbol]['side'])
+            result = place_order(symbol, self.symbol_data[symbol]['side'], qty, self.api_key, self.api_secret,
+                                 client_order_id=client_order_id, lookup_first=retry)
             
             if result and 'orderId' in result:
-                executed_qty = float(result.get('executedQty', 0))
-                avg_price = float(result.get('avgPrice', current_price))
+                execution = get_execution_report(symbol, result, self.api_key, self.api_secret)
+                executed_qty = execution['qty']
+                avg_price = execution['avg_price'] or current_price
+                previous_qty = abs(self.symbol_data[symbol]['qty'])
+                previous_entry = self.symbol_data[symbol]['entry']
+
+                if executed_qty > 0:
+                    total_qty = previous_qty + executed_qty
+                    new_entry = (previous_qty * previous_entry + executed_qty * avg_price) / total_qty
+                else:
+                    # 🔴 KHÔNG CÓ THÔNG TIN KHỚP (lệnh tra cứu còn NEW / userTrades chưa cập nhật): đối chiếu vị thế
+                    time.sleep(1)
+                    self._check_symbol_position(symbol)
+                    total_qty = abs(self.symbol_data[symbol]['qty'])
+                    if total_qty <= previous_qty:
+                        # Chưa xác nhận được khớp → giữ ý định lệnh: lượt sau tra cứu CÙNG client id thay vì nhồi lệnh mới
+                        self.symbol_data[symbol]['last_average_down_time'] = time.time()
+                        self.log(f"⚠️ {symbol} - Chưa xác nhận được lệnh nhồi {client_order_id}, sẽ đối chiếu lại")
+                        return False
+                    executed_qty = total_qty - previous_qty
+                    new_entry = self.symbol_data[symbol]['entry'] or previous_entry
+
+                self._finish_order_intent(symbol, result)
+                # Cập nhật giá trung bình và khối lượng
+                self.symbol_data[symbol]['entry'] = new_entry
+                self.symbol_data[symbol]['qty'] = total_qty if self.symbol_data[symbol]['side'] == "BUY" else -total_qty
+                self._journal("AVERAGE_DOWN", symbol, execution, client_order_id,
+                              qty=executed_qty, price=avg_price,
+                              average_down_count=self.symbol_data[symbol]['average_down_count'] + 1,
+                              extra={'new_entry': new_entry, 'total_qty': total_qty, 'lev': self.lev})
                 
-                if executed_qty >= 0:
-                    # Cập nhật giá trung bình và khối lượng
-                    total_qty = abs(self.symbol_data[symbol]['qty']) + executed_qty
-                    new_entry = (abs(self.symbol_data[symbol]['qty']) * self.symbol_data[symbol]['entry'] + executed_qty * avg_price) / total_qty
-                    self.symbol_data[symbol]['entry'] = new_entry
-                    self.symbol_data[symbol]['qty'] = total_qty if self.symbol_data[symbol]['side'] == "BUY" else -total_qty
-                    
-                    message = (
-                        f"📈 <b>ĐÃ NHỒI LỆNH {symbol}</b>\n"
-                        f"🔢 Lần nhồi: {self.symbol_data[symbol]['average_down_count'] + 1}\n"
-                        f"📊 Khối lượng thêm: {executed_qty:.4f}\n"
-                        f"🏷️ Giá nhồi: {avg_price:.4f}\n"
-                        f"📈 Giá trung bình mới: {new_entry:.4f}\n"
-                        f"💰 Tổng khối lượng: {total_qty:.4f}"
-                    )
-                    self.log(message)
-                    return True
-                    
+                message = (
+                    f"📈 <b>ĐÃ NHỒI LỆNH {symbol}</b>\n"
+                    f"🔢 Lần nhồi: {self.symbol_data[symbol]['average_down_count'] + 1}\n"
+                    f"📊 Khối lượng thêm: {executed_qty:.4f}\n"
+                    f"🏷️ Giá nhồi: {avg_price:.4f}\n"
+                    f"📈 Giá trung bình mới: {new_entry:.4f}\n"
+                    f"💰 Tổng khối lượng: {total_qty:.4f}"
+                )
+                self.log(message, priority=TELEGRAM_PRIORITY_HIGH)
+                return True
+
+            # Bị từ chối rõ ràng → ý định kết thúc; None (chưa rõ kết quả) thì giữ để tra cứu lại
+            self._finish_order_intent(symbol, result)
             return False
             
         except Exception as e:
             self.log(f"❌ {symbol} - Lỗi nhồi lệnh: {str(e)}")
             return False
 
+    def _symbol_lock(self, symbol):
+        """Khóa xử lý của 1 coin (RLock: vòng lặp bot tự dừng coin trong lúc đang giữ khóa vẫn được)"""
+        return self._symbol_work_locks.setdefault(symbol, threading.RLock())
+
     def stop_symbol(self, symbol):
         """Dừng một symbol cụ thể (đóng vị thế và ngừng theo dõi)"""
         if symbol not in self.active_symbols:
@@ -1535,41 +3393,57 @@ class BaseBot:
         
         self.log(f"⛔ Đang dừng coin {symbol}...")
         
-        # Nếu đang xử lý coin này, đợi nó xong
-        if self.current_processing_symbol == symbol:
-            timeout = time.time() + 10
-            while self.current_processing_symbol == symbol and time.time() < timeout:
-                time.sleep(0.5)
-        
-        # Đóng vị thế nếu đang mở
-        if self.symbol_data[symbol]['position_open']:
-            self._close_symbol_position(symbol, "Dừng coin theo lệnh")
-        
-        # Dọn dẹp
-        self.ws_manager.remove_symbol(symbol)
-        self.coin_manager.unregister_coin(symbol)
-        
-        if symbol in self.symbol_data:
-            del self.symbol_data[symbol]
-        
-        if symbol in self.active_symbols:
-            self.active_symbols.remove(symbol)
+        # Nếu vòng lặp bot đang đặt/đóng lệnh coin này, chờ nó xong (không dọn dữ liệu giữa chừng)
+        with self._symbol_lock(symbol):
+            if symbol not in self.active_symbols:
+                return False
+
+            # Đóng vị thế nếu đang mở
+            if self.symbol_data.get(symbol, {}).get('position_open'):
+                self._close_symbol_position(symbol, "Dừng coin theo lệnh")
+            
+            # Dọn dẹp
+            self._release_symbol(symbol)
         
         self.log(f"✅ Đã dừng coin {symbol}")
         
         return True
 
+    def _release_symbol(self, symbol, remove_stream=True):
+        """Ngừng theo dõi symbol: hủy stream, bỏ đăng ký coin, xóa dữ liệu"""
+        if remove_stream:
+            self.ws_manager.remove_symbol(symbol)
+        self.coin_manager.unregister_coin(symbol)
+        self.symbol_data.pop(symbol, None)
+        try:
+            self.active_symbols.remove(symbol)
+        except ValueError:
+            pass
+
+    def _shutdown_symbol(self, symbol):
+        """Đóng vị thế + dọn dữ liệu 1 coin khi dừng hàng loạt (stream được hủy chung sau đó)
+
+        Chờ khóa xử lý của coin: lệnh mở đang chạy dở (timeout, tra cứu, đọc fill) xong hẳn rồi mới
+        đóng vị thế nó vừa mở và xóa symbol_data; ShutdownCoordinator báo quá hạn nếu chờ quá deadline.
+        """
+        outcome = {'bot_id': self.bot_id, 'symbol': symbol, 'had_position': False, 'closed': True}
+        with self._symbol_lock(symbol):
+            if symbol not in self.active_symbols:
+                return outcome
+
+            if self.symbol_data.get(symbol, {}).get('position_open'):
+                outcome['had_position'] = True
+                outcome['closed'] = bool(self._close_symbol_position(symbol, "Dừng coin theo lệnh"))
+
+            self._release_symbol(symbol, remove_stream=False)
+        return outcome
+
     def stop_all_symbols(self):
         """Dừng tất cả coin nhưng vẫn giữ bot chạy"""
         self.log("⛔ Đang dừng tất cả coin...")
         
-        symbols_to_stop = self.active_symbols.copy()
-        stopped_count = 0
-        
-        for symbol in symbols_to_stop:
-            if self.stop_symbol(symbol):
-                stopped_count += 1
-                time.sleep(1)
+        report = ShutdownCoordinator().run([self], stop_bots=False)
+        stopped_count = report['stopped']
         
         self.log(f"✅ Đã dừng {stopped_count} coin, bot vẫn chạy và có thể thêm coin mới")
         return stopped_count
@@ -1578,6 +3452,7 @@ class BaseBot:
         """Dừng toàn bộ bot (đóng tất cả vị thế)"""
         self._stop = True
         stopped_count = self.stop_all_symbols()
+        bot_state_store.discard(self.bot_id)
         self.log(f"🔴 Bot dừng - Đã dừng {stopped_count} coin")
 
     def check_global_positions(self):
@@ -1631,8 +3506,8 @@ class BaseBot:
         else:
             return random.choice(["BUY", "SELL"])
 
-    def log(self, message):
-        """Log và gửi tất cả các thông điệp"""
+    def log(self, message, priority=TELEGRAM_PRIORITY_LOW):
+        """Log và gửi tất cả các thông điệp (Telegram qua hàng đợi nền, không chặn)"""
         # Luôn log tất cả message
         logger.info(f"[SYSTEM] {message}")
         
@@ -1640,14 +3515,119 @@ class BaseBot:
         if self.telegram_bot_token and self.telegram_chat_id:
             send_telegram(f"<b>SYSTEM</b>: {message}", 
                          bot_token=self.telegram_bot_token, 
-                         default_chat_id=self.telegram_chat_id)
+                         default_chat_id=self.telegram_chat_id,
+                         priority=priority)
+
+# ========== DỪNG SONG SONG CÓ DEADLINE ==========
+class ShutdownCoordinator:
+    """Đóng song song tất cả coin của nhiều bot trong thời hạn cho trước, trả về báo cáo"""
+    def __init__(self, deadline=20, max_workers=16):
+        self.deadline = deadline
+        self.max_workers = max_workers
+
+    def run(self, bots, stop_bots=True):
+        """Dừng các coin của `bots`; stop_bots=True thì dừng luôn vòng lặp bot trước khi đóng"""
+        start_time = time.time()
+        report = {
+            'bots': len(bots),
+            'symbols': 0,
+            'stopped': 0,
+            'closed': [],
+            'failed': [],
+            'timed_out': [],
+            'elapsed': 0.0
+        }
+
+        # Chặn vòng lặp bot trước để không mở thêm lệnh trong lúc đóng
+        if stop_bots:
+            for bot in bots:
+                bot._stop = True
+
+        tasks = [(bot, symbol) for bot in bots for symbol in list(bot.active_symbols)]
+        report['symbols'] = len(tasks)
+
+        if tasks:
+            executor = ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(tasks))))
+            futures = {
+                executor.submit(bot._shutdown_symbol, symbol): (bot, symbol)
+                for bot, symbol in tasks
+            }
+            done, not_done = wait(futures, timeout=self.deadline)
+            # Không chờ các lệnh đóng quá hạn - chúng tiếp tục chạy nền
+            executor.shutdown(wait=False)
+
+            for future in done:
+                bot, symbol = futures[future]
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    report['failed'].append({'bot_id': bot.bot_id, 'symbol': symbol, 'error': str(e)})
+                    continue
+                report['stopped'] += 1
+                if not outcome['closed']:
+                    report['failed'].append({'bot_id': bot.bot_id, 'symbol': symbol,
+                                             'error': 'Không đóng được vị thế'})
+                elif outcome['had_position']:
+                    report['closed'].append({'bot_id': bot.bot_id, 'symbol': symbol})
+
+            for future in not_done:
+                bot, symbol = futures[future]
+                report['timed_out'].append({'bot_id': bot.bot_id, 'symbol': symbol})
+
+            # Hủy stream hàng loạt theo từng WebSocketManager
+            streams = defaultdict(list)
+            managers = {}
+            for bot, symbol in tasks:
+                streams[id(bot.ws_manager)].append(symbol)
+                managers[id(bot.ws_manager)] = bot.ws_manager
+            for key, symbols in streams.items():
+                managers[key].remove_symbols(symbols)
+
+        report['elapsed'] = round(time.time() - start_time, 3)
+        return report
+
+# ========== CACHE TRẠNG THÁI TÀI KHOẢN ==========
+class AccountStateCache:
+    """Cache ngắn hạn số dư/vị thế - nhiều lệnh cùng lúc chỉ tốn 1 lần gọi Binance (single-flight)"""
+    def __init__(self, api_key, api_secret, ttl=5):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.ttl = ttl
+        self._entries = {}
+        self._locks = defaultdict(threading.Lock)
+
+    def _get(self, name, loader, max_age=None):
+        max_age = self.ttl if max_age is None else max_age
+        entry = self._entries.get(name)
+        if entry and time.time() - entry[0] < max_age:
+            return entry[1]
+        with self._locks[name]:
+            # Luồng khác có thể vừa tải xong trong lúc chờ khóa
+            entry = self._entries.get(name)
+            if entry and time.time() - entry[0] < max_age:
+                return entry[1]
+            value = loader()
+            if value is not None:
+                self._entries[name] = (time.time(), value)
+            return value
+
+    def get_balance(self, max_age=None):
+        return self._get('balance', lambda: get_balance(self.api_key, self.api_secret), max_age)
+
+    def get_positions(self, max_age=None):
+        return self._get('positions', lambda: get_positions(api_key=self.api_key, api_secret=self.api_secret), max_age)
+
+    def invalidate(self, *names):
+        for name in names or list(self._entries):
+            self._entries.pop(name, None)
 
 # ========== KHỞI TẠO GLOBAL INSTANCES ==========
 coin_manager = CoinManager()
 # trading_bot_lib_complete_part2.py - PHẦN 2: BOT MANAGER VÀ HỆ THỐNG ĐIỀU KHIỂN
 # ========== BOT MANAGER HOÀN CHỈNH VỚI HỆ THỐNG RSI + KHỐI LƯỢNG ==========
 class BotManager:
-    def __init__(self, api_key=None, api_secret=None, telegram_bot_token=None, telegram_chat_id=None):
+    def __init__(self, api_key=None, api_secret=None, telegram_bot_token=None, telegram_chat_id=None,
+                 telegram_mode=None):
         self.ws_manager = WebSocketManager()
         self.bots = {}
         self.running = True
@@ -1658,17 +3638,27 @@ class BotManager:
         self.api_secret = api_secret
         self.telegram_bot_token = telegram_bot_token
         self.telegram_chat_id = telegram_chat_id
+        # "polling" (getUpdates riêng) hoặc "webhook" (nhận qua telegram_router dùng chung)
+        self.telegram_mode = telegram_mode or os.getenv("TELEGRAM_MODE", "polling")
 
         # ✅ tài nguyên dùng chung cho tất cả bot
         self.coin_manager = CoinManager()
         self.symbol_locks = defaultdict(threading.Lock)
 
+        # Lệnh Telegram nặng (thống kê, số dư, vị thế) chạy trên pool riêng, đọc cache tài khoản
+        self.account_cache = AccountStateCache(api_key, api_secret)
+        self.command_executor = ThreadPoolExecutor(max_workers=2)
+        tradable_universe.refresh_async()
+
         if api_key and api_secret:
             self._verify_api_connection()
             self.log("🟢 HỆ THỐNG BOT RSI + KHỐI LƯỢNG ĐÃ KHỞI ĐỘNG - MỖI BOT NHIỀU COIN NỐI TIẾP")
 
-            self.telegram_thread = threading.Thread(target=self._telegram_listener, daemon=True)
-            self.telegram_thread.start()
+            if self.telegram_mode == "webhook" and self.telegram_bot_token and self.telegram_chat_id:
+                telegram_router.register(self)
+            else:
+                self.telegram_thread = threading.Thread(target=self._telegram_listener, daemon=True)
+                self.telegram_thread.start()
 
             if self.telegram_chat_id:
                 self.send_main_menu(self.telegram_chat_id)
@@ -1676,9 +3666,9 @@ class BotManager:
             self.log("⚡ BotManager khởi động ở chế độ không config")
 
     def _verify_api_connection(self):
-        """Kiểm tra kết nối API"""
+        """Kiểm tra kết nối API (qua cache - khởi tạo + add_bot liền nhau chỉ tốn 1 lần gọi)"""
         try:
-            balance = get_balance(self.api_key, self.api_secret)
+            balance = self.account_cache.get_balance()
             if balance is None:
                 self.log("❌ LỖI: Không thể kết nối Binance API. Kiểm tra:")
                 self.log("   - API Key và Secret có đúng không?")
@@ -1695,7 +3685,7 @@ class BotManager:
     def get_position_summary(self):
         """Lấy thống kê tổng quan - SỬA: HIỂN THỊ THEO MÔ HÌNH MỚI"""
         try:
-            all_positions = get_positions(api_key=self.api_key, api_secret=self.api_secret)
+            all_positions = self.account_cache.get_positions()
             
             total_long_count = 0
             total_short_count = 0
@@ -1774,7 +3764,7 @@ class BotManager:
             summary = "📊 **THỐNG KÊ CHI TIẾT - MỖI BOT NHIỀU COIN NỐI TIẾP**\n\n"
             
             # Phần 1: Số dư
-            balance = get_balance(self.api_key, self.api_secret)
+            balance = self.account_cache.get_balance()
             if balance is not None:
                 summary += f"💰 **SỐ DƯ**: {balance:.2f} USDC\n"
                 summary += f"📈 **Tổng PnL**: {total_unrealized_pnl:.2f} USDC\n\n"
@@ -1831,8 +3821,8 @@ class BotManager:
         except Exception as e:
             return f"❌ Lỗi thống kê: {str(e)}"
 
-    def log(self, message):
-        """Log và gửi tất cả các thông điệp"""
+    def log(self, message, priority=TELEGRAM_PRIORITY_LOW):
+        """Log và gửi tất cả các thông điệp (Telegram qua hàng đợi nền, không chặn)"""
         # Luôn log tất cả message
         logger.info(f"[SYSTEM] {message}")
         
@@ -1840,7 +3830,8 @@ class BotManager:
         if self.telegram_bot_token and self.telegram_chat_id:
             send_telegram(f"<b>SYSTEM</b>: {message}", 
                          bot_token=self.telegram_bot_token, 
-                         default_chat_id=self.telegram_chat_id)
+                         default_chat_id=self.telegram_chat_id,
+                         priority=priority)
     def send_main_menu(self, chat_id):
         """Gửi menu chính - SỬA: CẬP NHẬT MÔ HÌNH MỚI"""
         welcome = (
@@ -1892,10 +3883,13 @@ class BotManager:
         
         # 🔴 SỬA QUAN TRỌNG: CHỈ TẠO 1 BOT, NHƯNG BOT ĐÓ QUẢN LÝ bot_count COIN
         try:
-            if bot_mode == 'static' and symbol:
-                bot_id = f"STATIC_{strategy_type}_{int(time.time())}"
-            else:
-                bot_id = f"DYNAMIC_{strategy_type}_{int(time.time())}"
+            # bot_id cố định (vd theo id cấu hình) cho phép khôi phục đúng bot sau restart
+            bot_id = kwargs.get('bot_id')
+            if not bot_id:
+                if bot_mode == 'static' and symbol:
+                    bot_id = f"STATIC_{strategy_type}_{int(time.time())}"
+                else:
+                    bot_id = f"DYNAMIC_{strategy_type}_{int(time.time())}"
             
             if bot_id in self.bots:
                 return False
@@ -1977,18 +3971,15 @@ class BotManager:
             return stopped_count
         return 0
 
-    def stop_all_coins(self):
+    def stop_all_coins(self, deadline=20):
         """Dừng tất cả coin trong tất cả bot nhưng vẫn giữ bot manager chạy"""
         self.log("⛔ Đang dừng tất cả coin trong tất cả bot...")
         
-        total_stopped = 0
-        for bot_id, bot in self.bots.items():
-            if hasattr(bot, 'stop_all_symbols'):
-                stopped_count = bot.stop_all_symbols()
-                total_stopped += stopped_count
-                self.log(f"⛔ Đã dừng {stopped_count} coin trong bot {bot_id}")
+        report = ShutdownCoordinator(deadline=deadline).run(list(self.bots.values()), stop_bots=False)
+        total_stopped = report['stopped']
         
-        self.log(f"✅ Đã dừng tổng cộng {total_stopped} coin, hệ thống vẫn chạy và có thể thêm coin mới")
+        self.log(f"✅ Đã dừng tổng cộng {total_stopped} coin, hệ thống vẫn chạy và có thể thêm coin mới\n"
+                 f"{self._format_shutdown_report(report)}", priority=TELEGRAM_PRIORITY_HIGH)
         return total_stopped
 
     def stop_bot(self, bot_id):
@@ -2001,12 +3992,48 @@ class BotManager:
             return True
         return False
 
-    def stop_all(self):
-        """Dừng tất cả bot (đóng tất cả vị thế và xóa tất cả bot)"""
+    def stop_all(self, deadline=20):
+        """Dừng tất cả bot (đóng song song tất cả vị thế và xóa tất cả bot) - trả về báo cáo"""
         self.log("🔴 Đang dừng tất cả bot...")
-        for bot_id in list(self.bots.keys()):
-            self.stop_bot(bot_id)
-        self.log("🔴 Đã dừng tất cả bot, hệ thống vẫn chạy và có thể thêm bot mới")
+        bot_ids = list(self.bots.keys())
+        report = ShutdownCoordinator(deadline=deadline).run([self.bots[b] for b in bot_ids], stop_bots=True)
+        for bot_id in bot_ids:
+            self.bots.pop(bot_id, None)
+        self.log(f"🔴 Đã dừng {len(bot_ids)} bot, hệ thống vẫn chạy và có thể thêm bot mới\n"
+                 f"{self._format_shutdown_report(report)}", priority=TELEGRAM_PRIORITY_HIGH)
+        return report
+
+    @staticmethod
+    def _format_shutdown_report(report):
+        message = (f"✅ Đóng: {len(report['closed'])} vị thế | ❌ Lỗi: {len(report['failed'])} | "
+                   f"⏳ Quá hạn: {len(report['timed_out'])} | ⏱️ {report['elapsed']:.1f}s")
+        for item in report['failed'] + report['timed_out']:
+            message += f"\n⚠️ {item['symbol']} ({item['bot_id']})"
+        return message
+
+    def close(self):
+        """Ngừng nhận lệnh Telegram (dừng long-poll / gỡ khỏi webhook router)"""
+        self.running = False
+        if self.telegram_bot_token:
+            telegram_router.unregister(self)
+        self.command_executor.shutdown(wait=False)
+
+    def get_runtime_status(self):
+        """Trạng thái runtime gọn (dùng cho API/IPC): số bot, các coin đang chạy và bot sở hữu từng coin"""
+        active_symbols = []
+        symbol_owners = {}
+        for bot_id, bot in list(self.bots.items()):
+            symbols = list(getattr(bot, 'active_symbols', None) or [])
+            active_symbols.extend(symbols)
+            for symbol in symbols:
+                symbol_owners[symbol] = bot_id
+        return {
+            'running': bool(self.bots),
+            'bot_count': len(self.bots),
+            'bot_ids': list(self.bots),
+            'active_symbols': active_symbols,
+            'symbol_owners': symbol_owners
+        }
 
     def _telegram_listener(self):
         """Listener Telegram - SỬA: HOẠT ĐỘNG LẠI VÀ XỬ LÝ TẤT CẢ CHỨC NĂNG"""
@@ -2044,6 +4071,95 @@ class BotManager:
                 logger.error(f"Lỗi Telegram listener: {str(e)}")
                 time.sleep(5)
 
+    def _reply(self, chat_id, message, reply_markup=None):
+        send_telegram(message, chat_id, reply_markup,
+                      bot_token=self.telegram_bot_token,
+                      default_chat_id=self.telegram_chat_id)
+
+    def _heavy_commands(self):
+        """Các lệnh cần gọi Binance/tính toán lâu - chạy ngoài luồng listener"""
+        return {
+            "📊 Danh sách Bot": self._cmd_position_summary,
+            "📊 Thống kê": self._cmd_position_summary,
+            "💰 Số dư": self._cmd_balance,
+            "📈 Vị thế": self._cmd_positions,
+            "⚙️ Cấu hình": self._cmd_config,
+        }
+
+    def _run_heavy_command(self, command, chat_id):
+        try:
+            command(chat_id)
+        except Exception as e:
+            logger.error(f"Lỗi xử lý lệnh Telegram: {str(e)}")
+            self._reply(chat_id, f"⚠️ Lỗi xử lý lệnh: {str(e)}")
+
+    def _cmd_position_summary(self, chat_id):
+        self._reply(chat_id, self.get_position_summary())
+
+    def _cmd_balance(self, chat_id):
+        try:
+            balance = self.account_cache.get_balance()
+            if balance is None:
+                self._reply(chat_id, "❌ <b>LỖI KẾT NỐI BINANCE</b>\nVui lòng kiểm tra API Key và kết nối mạng!")
+            else:
+                self._reply(chat_id, f"💰 <b>SỐ DƯ KHẢ DỤNG</b>: {balance:.2f} USDT")
+        except Exception as e:
+            self._reply(chat_id, f"⚠️ Lỗi lấy số dư: {str(e)}")
+
+    def _cmd_positions(self, chat_id):
+        try:
+            positions = self.account_cache.get_positions()
+            if not positions:
+                self._reply(chat_id, "📭 Không có vị thế nào đang mở")
+                return
+            
+            message = "📈 <b>VỊ THẾ ĐANG MỞ</b>\n\n"
+            for pos in positions:
+                position_amt = float(pos.get('positionAmt', 0))
+                if position_amt != 0:
+                    symbol = pos.get('symbol', 'UNKNOWN')
+                    entry = float(pos.get('entryPrice', 0))
+                    side = "LONG" if position_amt > 0 else "SHORT"
+                    pnl = float(pos.get('unRealizedProfit', 0))
+                    
+                    message += (
+                        f"🔹 {symbol} | {side}\n"
+                        f"📊 Khối lượng: {abs(position_amt):.4f}\n"
+                        f"🏷️ Giá vào: {entry:.4f}\n"
+                        f"💰 PnL: {pnl:.2f} USDT\n\n"
+                    )
+            
+            self._reply(chat_id, message)
+        except Exception as e:
+            self._reply(chat_id, f"⚠️ Lỗi lấy vị thế: {str(e)}")
+
+    def _cmd_config(self, chat_id):
+        balance = self.account_cache.get_balance()
+        api_status = "✅ Đã kết nối" if balance is not None else "❌ Lỗi kết nối"
+        
+        total_bots_with_coins = 0
+        trading_bots = 0
+        
+        for bot in list(self.bots.values()):
+            if hasattr(bot, 'active_symbols'):
+                if len(bot.active_symbols) > 0:
+                    total_bots_with_coins += 1
+                for symbol, data in list(bot.symbol_data.items()):
+                    if data.get('position_open', False):
+                        trading_bots += 1
+        
+        config_info = (
+            "⚙️ <b>CẤU HÌNH HỆ THỐNG RSI + KHỐI LƯỢNG</b>\n\n"
+            f"🔑 Binance API: {api_status}\n"
+            f"🤖 Tổng số bot: {len(self.bots)}\n"
+            f"📊 Bot có coin: {total_bots_with_coins}\n"
+            f"🟢 Bot đang trade: {trading_bots}\n"
+            f"🌐 WebSocket: {len(self.ws_manager.connections)} kết nối\n\n"
+            f"🔄 <b>CƠ CHẾ NỐI TIẾP ĐANG HOẠT ĐỘNG</b>\n"
+            f"🎯 <b>6 ĐIỀU KIỆN RSI ĐANG HOẠT ĐỘNG</b>"
+        )
+        self._reply(chat_id, config_info)
+
     def _handle_telegram_message(self, chat_id, text):
         """Xử lý tin nhắn Telegram - SỬA: KÍCH HOẠT LẠI TẤT CẢ CHỨC NĂNG"""
         user_state = self.user_states.get(chat_id, {})
@@ -2051,13 +4167,19 @@ class BotManager:
         
         # 🔴 SỬA: XỬ LÝ TẤT CẢ CÁC LỆNH CHÍNH TRƯỚC KHI XỬ LÝ STEP
         
+        # LỆNH NẶNG: chuyển sang pool lệnh, listener chỉ điều phối
+        heavy_command = self._heavy_commands().get(text)
+        if heavy_command:
+            self.command_executor.submit(self._run_heavy_command, heavy_command, chat_id)
+            return
+        
         # XỬ LÝ LỆNH CHÍNH
         if text == "➕ Thêm Bot":
             self.user_states[chat_id] = {'step': 'waiting_bot_count'}
-            balance = get_balance(self.api_key, self.api_secret)
+            balance = self.account_cache.get_balance()
             if balance is None:
                 send_telegram("❌ <b>LỖI KẾT NỐI BINANCE</b>\nVui lòng kiểm tra API Key và kết nối mạng!", chat_id,
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
                 return
             
             send_telegram(
@@ -2066,26 +4188,14 @@ class BotManager:
                 f"Chọn số lượng coin mà bot sẽ quản lý (nối tiếp):",
                 chat_id,
                 create_bot_count_keyboard(),
-                self.telegram_bot_token, self.telegram_chat_id
+                bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
             )
             return
         
-        elif text == "📊 Danh sách Bot":
-            summary = self.get_position_summary()
-            send_telegram(summary, chat_id,
-                         self.telegram_bot_token, self.telegram_chat_id)
-            return
-        
-        elif text == "📊 Thống kê":
-            summary = self.get_position_summary()
-            send_telegram(summary, chat_id,
-                         self.telegram_bot_token, self.telegram_chat_id)
-            return
-        
         elif text == "⛔ Dừng Bot":
             if not self.bots:
                 send_telegram("🤖 Không có bot nào đang chạy", chat_id,
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             else:
                 message = "⛔ <b>CHỌN BOT ĐỂ DỪNG</b>\n\n"
                 
@@ -2108,55 +4218,10 @@ class BotManager:
                     message, 
                     chat_id, 
                     {"keyboard": keyboard, "resize_keyboard": True, "one_time_keyboard": True},
-                    self.telegram_bot_token, self.telegram_chat_id
+                    bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
                 )
             return
         
-        elif text == "💰 Số dư":
-            try:
-                balance = get_balance(self.api_key, self.api_secret)
-                if balance is None:
-                    send_telegram("❌ <b>LỖI KẾT NỐI BINANCE</b>\nVui lòng kiểm tra API Key và kết nối mạng!", chat_id,
-                                self.telegram_bot_token, self.telegram_chat_id)
-                else:
-                    send_telegram(f"💰 <b>SỐ DƯ KHẢ DỤNG</b>: {balance:.2f} USDT", chat_id,
-                                self.telegram_bot_token, self.telegram_chat_id)
-            except Exception as e:
-                send_telegram(f"⚠️ Lỗi lấy số dư: {str(e)}", chat_id,
-                            self.telegram_bot_token, self.telegram_chat_id)
-            return
-        
-        elif text == "📈 Vị thế":
-            try:
-                positions = get_positions(api_key=self.api_key, api_secret=self.api_secret)
-                if not positions:
-                    send_telegram("📭 Không có vị thế nào đang mở", chat_id,
-                                self.telegram_bot_token, self.telegram_chat_id)
-                    return
-                
-                message = "📈 <b>VỊ THẾ ĐANG MỞ</b>\n\n"
-                for pos in positions:
-                    position_amt = float(pos.get('positionAmt', 0))
-                    if position_amt != 0:
-                        symbol = pos.get('symbol', 'UNKNOWN')
-                        entry = float(pos.get('entryPrice', 0))
-                        side = "LONG" if position_amt > 0 else "SHORT"
-                        pnl = float(pos.get('unRealizedProfit', 0))
-                        
-                        message += (
-                            f"🔹 {symbol} | {side}\n"
-                            f"📊 Khối lượng: {abs(position_amt):.4f}\n"
-                            f"🏷️ Giá vào: {entry:.4f}\n"
-                            f"💰 PnL: {pnl:.2f} USDT\n\n"
-                        )
-                
-                send_telegram(message, chat_id,
-                            self.telegram_bot_token, self.telegram_chat_id)
-            except Exception as e:
-                send_telegram(f"⚠️ Lỗi lấy vị thế: {str(e)}", chat_id,
-                            self.telegram_bot_token, self.telegram_chat_id)
-            return
-        
         elif text == "🎯 Chiến lược":
             strategy_info = (
                 "🎯 <b>HỆ THỐNG RSI + KHỐI LƯỢNG NÂNG CAO</b>\n\n"
@@ -2187,36 +4252,7 @@ class BotManager:
                 "• Tự động chuyển sang tìm coin khác"
             )
             send_telegram(strategy_info, chat_id,
-                        self.telegram_bot_token, self.telegram_chat_id)
-            return
-        
-        elif text == "⚙️ Cấu hình":
-            balance = get_balance(self.api_key, self.api_secret)
-            api_status = "✅ Đã kết nối" if balance is not None else "❌ Lỗi kết nối"
-            
-            total_bots_with_coins = 0
-            trading_bots = 0
-            
-            for bot in self.bots.values():
-                if hasattr(bot, 'active_symbols'):
-                    if len(bot.active_symbols) > 0:
-                        total_bots_with_coins += 1
-                    for symbol, data in bot.symbol_data.items():
-                        if data.get('position_open', False):
-                            trading_bots += 1
-            
-            config_info = (
-                "⚙️ <b>CẤU HÌNH HỆ THỐNG RSI + KHỐI LƯỢNG</b>\n\n"
-                f"🔑 Binance API: {api_status}\n"
-                f"🤖 Tổng số bot: {len(self.bots)}\n"
-                f"📊 Bot có coin: {total_bots_with_coins}\n"
-                f"🟢 Bot đang trade: {trading_bots}\n"
-                f"🌐 WebSocket: {len(self.ws_manager.connections)} kết nối\n\n"
-                f"🔄 <b>CƠ CHẾ NỐI TIẾP ĐANG HOẠT ĐỘNG</b>\n"
-                f"🎯 <b>6 ĐIỀU KIỆN RSI ĐANG HOẠT ĐỘNG</b>"
-            )
-            send_telegram(config_info, chat_id,
-                        self.telegram_bot_token, self.telegram_chat_id)
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             return
         
         # XỬ LÝ LỆNH DỪNG TỪNG COIN
@@ -2228,17 +4264,17 @@ class BotManager:
                 
                 if self.stop_bot_symbol(bot_id, symbol):
                     send_telegram(f"✅ Đã dừng coin {symbol} trong bot {bot_id}", chat_id,
-                                self.telegram_bot_token, self.telegram_chat_id)
+                                bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
                 else:
                     send_telegram(f"❌ Không thể dừng coin {symbol}", chat_id,
-                                self.telegram_bot_token, self.telegram_chat_id)
+                                bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             return
         
         # XỬ LÝ LỆNH DỪNG TẤT CẢ COIN
         elif text == "⛔ DỪNG TẤT CẢ COIN":
             stopped_count = self.stop_all_coins()
             send_telegram(f"✅ Đã dừng {stopped_count} coin, hệ thống vẫn chạy", chat_id,
-                        self.telegram_bot_token, self.telegram_chat_id)
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             return
         
         # XỬ LÝ LỆNH DỪNG BOT
@@ -2246,17 +4282,17 @@ class BotManager:
             bot_id = text.replace("⛔ Bot: ", "").strip()
             if self.stop_bot(bot_id):
                 send_telegram(f"✅ Đã dừng bot {bot_id}", chat_id,
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             else:
                 send_telegram(f"❌ Không tìm thấy bot {bot_id}", chat_id,
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             return
         
         # XỬ LÝ LỆNH DỪNG TẤT CẢ BOT
         elif text == "⛔ DỪNG TẤT CẢ BOT":
-            stopped_count = self.stop_all()
-            send_telegram(f"✅ Đã dừng {stopped_count} bot, hệ thống vẫn chạy", chat_id,
-                        self.telegram_bot_token, self.telegram_chat_id)
+            report = self.stop_all()
+            send_telegram(f"✅ Đã dừng {report['bots']} bot, hệ thống vẫn chạy", chat_id,
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             return
 
         # XỬ LÝ CÁC BƯỚC TẠO BOT
@@ -2264,14 +4300,14 @@ class BotManager:
             if text == '❌ Hủy bỏ':
                 self.user_states[chat_id] = {}
                 send_telegram("❌ Đã hủy thêm bot", chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             else:
                 try:
                     bot_count = int(text)
                     if bot_count <= 0 or bot_count > 10:
                         send_telegram("⚠️ Số lượng coin phải từ 1 đến 10. Vui lòng chọn lại:",
                                     chat_id, create_bot_count_keyboard(),
-                                    self.telegram_bot_token, self.telegram_chat_id)
+                                    bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
                         return
     
                     user_state['bot_count'] = bot_count
@@ -2282,18 +4318,18 @@ class BotManager:
                         f"Chọn chế độ bot:",
                         chat_id,
                         create_bot_mode_keyboard(),
-                        self.telegram_bot_token, self.telegram_chat_id
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
                     )
                 except ValueError:
                     send_telegram("⚠️ Vui lòng nhập số hợp lệ cho số lượng coin:",
                                 chat_id, create_bot_count_keyboard(),
-                                self.telegram_bot_token, self.telegram_chat_id)
+                                bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
     
         elif current_step == 'waiting_bot_mode':
             if text == '❌ Hủy bỏ':
                 self.user_states[chat_id] = {}
                 send_telegram("❌ Đã hủy thêm bot", chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             elif text in ["🤖 Bot Tĩnh - Coin cụ thể", "🔄 Bot Động - Tự tìm coin"]:
                 if text == "🤖 Bot Tĩnh - Coin cụ thể":
                     user_state['bot_mode'] = 'static'
@@ -2305,7 +4341,7 @@ class BotManager:
                         "Chọn coin:",
                         chat_id,
                         create_symbols_keyboard(),
-                        self.telegram_bot_token, self.telegram_chat_id
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
                     )
                 else:
                     user_state['bot_mode'] = 'dynamic'
@@ -2317,14 +4353,14 @@ class BotManager:
                         "Chọn đòn bẩy:",
                         chat_id,
                         create_leverage_keyboard(),
-                        self.telegram_bot_token, self.telegram_chat_id
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
                     )
     
         elif current_step == 'waiting_symbol':
             if text == '❌ Hủy bỏ':
                 self.user_states[chat_id] = {}
                 send_telegram("❌ Đã hủy thêm bot", chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             else:
                 user_state['symbol'] = text
                 user_state['step'] = 'waiting_leverage'
@@ -2333,14 +4369,14 @@ class BotManager:
                     f"Chọn đòn bẩy:",
                     chat_id,
                     create_leverage_keyboard(),
-                    self.telegram_bot_token, self.telegram_chat_id
+                    bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
                 )
     
         elif current_step == 'waiting_leverage':
             if text == '❌ Hủy bỏ':
                 self.user_states[chat_id] = {}
                 send_telegram("❌ Đã hủy thêm bot", chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             else:
                 if text.endswith('x'):
                     lev_text = text[:-1]
@@ -2352,13 +4388,13 @@ class BotManager:
                     if leverage <= 0 or leverage > 100:
                         send_telegram("⚠️ Đòn bẩy phải từ 1 đến 100. Vui lòng chọn lại:",
                                     chat_id, create_leverage_keyboard(),
-                                    self.telegram_bot_token, self.telegram_chat_id)
+                                    bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
                         return
     
                     user_state['leverage'] = leverage
                     user_state['step'] = 'waiting_percent'
                     
-                    balance = get_balance(self.api_key, self.api_secret)
+                    balance = self.account_cache.get_balance()
                     balance_info = f"\n💰 Số dư hiện có: {balance:.2f} USDT" if balance else ""
                     
                     send_telegram(
@@ -2366,31 +4402,31 @@ class BotManager:
                         f"Chọn % số dư cho mỗi lệnh:",
                         chat_id,
                         create_percent_keyboard(),
-                        self.telegram_bot_token, self.telegram_chat_id
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
                     )
                 except ValueError:
                     send_telegram("⚠️ Vui lòng nhập số hợp lệ cho đòn bẩy:",
                                 chat_id, create_leverage_keyboard(),
-                                self.telegram_bot_token, self.telegram_chat_id)
+                                bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
     
         elif current_step == 'waiting_percent':
             if text == '❌ Hủy bỏ':
                 self.user_states[chat_id] = {}
                 send_telegram("❌ Đã hủy thêm bot", chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             else:
                 try:
                     percent = float(text)
                     if percent <= 0 or percent > 100:
                         send_telegram("⚠️ % số dư phải từ 0.1 đến 100. Vui lòng chọn lại:",
                                     chat_id, create_percent_keyboard(),
-                                    self.telegram_bot_token, self.telegram_chat_id)
+                                    bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
                         return
     
                     user_state['percent'] = percent
                     user_state['step'] = 'waiting_tp'
                     
-                    balance = get_balance(self.api_key, self.api_secret)
+                    balance = self.account_cache.get_balance()
                     actual_amount = balance * (percent / 100) if balance else 0
                     
                     send_telegram(
@@ -2399,25 +4435,25 @@ class BotManager:
                         f"Chọn Take Profit (%):",
                         chat_id,
                         create_tp_keyboard(),
-                        self.telegram_bot_token, self.telegram_chat_id
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
                     )
                 except ValueError:
                     send_telegram("⚠️ Vui lòng nhập số hợp lệ cho % số dư:",
                                 chat_id, create_percent_keyboard(),
-                                self.telegram_bot_token, self.telegram_chat_id)
+                                bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
     
         elif current_step == 'waiting_tp':
             if text == '❌ Hủy bỏ':
                 self.user_states[chat_id] = {}
                 send_telegram("❌ Đã hủy thêm bot", chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             else:
                 try:
                     tp = float(text)
                     if tp <= 0:
                         send_telegram("⚠️ Take Profit phải lớn hơn 0. Vui lòng chọn lại:",
                                     chat_id, create_tp_keyboard(),
-                                    self.telegram_bot_token, self.telegram_chat_id)
+                                    bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
                         return
     
                     user_state['tp'] = tp
@@ -2428,25 +4464,25 @@ class BotManager:
                         f"Chọn Stop Loss (%):",
                         chat_id,
                         create_sl_keyboard(),
-                        self.telegram_bot_token, self.telegram_chat_id
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
                     )
                 except ValueError:
                     send_telegram("⚠️ Vui lòng nhập số hợp lệ cho Take Profit:",
                                 chat_id, create_tp_keyboard(),
-                                self.telegram_bot_token, self.telegram_chat_id)
+                                bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
     
         elif current_step == 'waiting_sl':
             if text == '❌ Hủy bỏ':
                 self.user_states[chat_id] = {}
                 send_telegram("❌ Đã hủy thêm bot", chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             else:
                 try:
                     sl = float(text)
                     if sl < 0:
                         send_telegram("⚠️ Stop Loss phải lớn hơn hoặc bằng 0. Vui lòng chọn lại:",
                                     chat_id, create_sl_keyboard(),
-                                    self.telegram_bot_token, self.telegram_chat_id)
+                                    bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
                         return
     
                     user_state['sl'] = sl
@@ -2458,18 +4494,18 @@ class BotManager:
                         f"Chọn ngưỡng ROI trigger (%):",
                         chat_id,
                         create_roi_trigger_keyboard(),
-                        self.telegram_bot_token, self.telegram_chat_id
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id
                     )
                 except ValueError:
                     send_telegram("⚠️ Vui lòng nhập số hợp lệ cho Stop Loss:",
                                 chat_id, create_sl_keyboard(),
-                                self.telegram_bot_token, self.telegram_chat_id)
+                                bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
     
         elif current_step == 'waiting_roi_trigger':
             if text == '❌ Hủy bỏ':
                 self.user_states[chat_id] = {}
                 send_telegram("❌ Đã hủy thêm bot", chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             elif text == '❌ Tắt tính năng':
                 user_state['roi_trigger'] = None
                 self._finish_bot_creation(chat_id, user_state)
@@ -2479,7 +4515,7 @@ class BotManager:
                     if roi_trigger <= 0:
                         send_telegram("⚠️ ROI Trigger phải lớn hơn 0. Vui lòng chọn lại:",
                                     chat_id, create_roi_trigger_keyboard(),
-                                    self.telegram_bot_token, self.telegram_chat_id)
+                                    bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
                         return
     
                     user_state['roi_trigger'] = roi_trigger
@@ -2488,7 +4524,7 @@ class BotManager:
                 except ValueError:
                     send_telegram("⚠️ Vui lòng nhập số hợp lệ cho ROI Trigger:",
                                 chat_id, create_roi_trigger_keyboard(),
-                                self.telegram_bot_token, self.telegram_chat_id)
+                                bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
     
         # Nếu không xử lý được gì, gửi menu chính
         else:
@@ -2546,15 +4582,356 @@ class BotManager:
                 success_msg += f"• Tự động kiểm tra vị thế trước khi vào lệnh"
                 
                 send_telegram(success_msg, chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             else:
                 send_telegram("❌ Có lỗi khi tạo bot. Vui lòng thử lại.",
                             chat_id, create_main_menu(),
-                            self.telegram_bot_token, self.telegram_chat_id)
+                            bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             
             self.user_states[chat_id] = {}
             
         except Exception as e:
             send_telegram(f"❌ Lỗi tạo bot: {str(e)}", chat_id, create_main_menu(),
-                        self.telegram_bot_token, self.telegram_chat_id)
+                        bot_token=self.telegram_bot_token, default_chat_id=self.telegram_chat_id)
             self.user_states[chat_id] = {}
+
+# ========== BOT WORKER POOL - CHIA SHARD BOTMANAGER THEO TIẾN TRÌNH ==========
+class ConsistentHashRing:
+    """Vòng băm nhất quán: user_id → worker, ít xáo trộn khi thay đổi số worker"""
+    def __init__(self, nodes, replicas=100):
+        self._ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self._ring.append((self._hash(f"{node}#{i}"), node))
+        self._ring.sort()
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(str(key).encode()).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[index][1]
+
+def _bot_worker_dispatch(managers, managers_lock, op, user_id, kwargs):
+    """Thực thi một lệnh IPC trên BotManager của user trong worker"""
+    if op == 'ping':
+        return {'pid': os.getpid(), 'users': len(managers)}
+
+    with managers_lock:
+        bm = managers.get(user_id)
+
+    if op == 'start':
+        if bm is None:
+            bm = BotManager(api_key=kwargs.get('api_key'), api_secret=kwargs.get('api_secret'))
+            with managers_lock:
+                bm = managers.setdefault(user_id, bm)
+        return bool(bm.add_bot(**kwargs.get('bot', {})))
+
+    if op == 'stop':
+        if bm is None:
+            return None
+        # Chỉ gỡ khỏi registry sau khi dừng xong: stop_all lỗi / caller hết timeout thì các bot còn chạy
+        # vẫn điều khiển được qua IPC (status, stop lần nữa)
+        report = bm.stop_all(deadline=kwargs.get('deadline', 20))
+        with managers_lock:
+            if managers.get(user_id) is bm:
+                del managers[user_id]
+        bm.close()
+        return report
+
+    if op == 'telegram_update':
+        return telegram_router.dispatch(kwargs.get('token_id'), kwargs.get('update') or {}, kwargs.get('secret'))
+
+    if op == 'telegram_tokens':
+        return telegram_router.token_ids()
+
+    if op == 'status':
+        if bm is None:
+            return {'running': False, 'bot_count': 0, 'bot_ids': [], 'active_symbols': [], 'symbol_owners': {}}
+        return bm.get_runtime_status()
+
+    if op == 'summary':
+        if bm is None:
+            return None
+        return bm.get_position_summary()
+
+    raise ValueError(f"Lệnh IPC không hợp lệ: {op}")
+
+def _bot_worker_main(address, authkey):
+    """Tiến trình worker: sở hữu BotManager của các user thuộc shard, nhận lệnh qua IPC"""
+    managers = {}
+    managers_lock = threading.Lock()
+    try:
+        # Xác thực authkey làm trong luồng phục vụ để kết nối sai key chỉ bị đóng, không chặn accept
+        listener = Listener(address)
+    except OSError as e:
+        # Tiến trình web khác đã dựng worker ở địa chỉ này trước
+        logger.info(f"🧩 Bot worker {address} đã có tiến trình khác giữ ({str(e)}), thoát")
+        return
+    logger.info(f"🧩 Bot worker {os.getpid()} lắng nghe tại {address}")
+
+    def serve(conn):
+        try:
+            deliver_challenge(conn, authkey)
+            answer_challenge(conn, authkey)
+        except (AuthenticationError, EOFError, OSError) as e:
+            logger.debug(f"Bỏ kết nối worker không xác thực được: {str(e)}")
+            conn.close()
+            return
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                result = _bot_worker_dispatch(managers, managers_lock, request.get('op'),
+                                              request.get('user_id'), request.get('kwargs') or {})
+                response = {'ok': True, 'result': result}
+            except Exception as e:
+                logger.error(f"❌ Lỗi worker xử lý {request.get('op')}: {str(e)}")
+                response = {'ok': False, 'error': str(e)}
+            try:
+                conn.send(response)
+            except (EOFError, OSError):
+                break
+        conn.close()
+
+    backoff = 0
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            # Lỗi lặp lại (vd. hết file descriptor) → chờ tăng dần thay vì lặp nóng
+            backoff = min(backoff * 2 or 0.1, 5)
+            logger.error(f"❌ Lỗi nhận kết nối worker (thử lại sau {backoff:.1f}s): {str(e)}")
+            time.sleep(backoff)
+            continue
+        backoff = 0
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+class BotWorkerPool:
+    """Nhóm tiến trình worker - mỗi worker sở hữu 1 shard BotManager theo consistent hash của user_id
+
+    Worker thuộc về 1 tiến trình giám sát riêng (supervise - vd. `python main.py bot-workers`),
+    không phải con của tiến trình web nào: web khởi động lại/thoát không kéo bot theo.
+    Các tiến trình web (uvicorn --workers N) chỉ gắn vào qua địa chỉ + authkey, nên lệnh điều khiển
+    bot của 1 user luôn tới đúng tiến trình sở hữu BotManager của user đó.
+    """
+    RESPAWN_INTERVAL = 15
+    TELEGRAM_REFRESH_INTERVAL = 10
+
+    def __init__(self, worker_count, host="127.0.0.1", base_port=17000, authkey=None):
+        self.worker_count = worker_count
+        self.addresses = [(host, base_port + i) for i in range(worker_count)]
+        self.authkey = authkey or os.urandom(16)
+        self.ring = ConsistentHashRing(range(worker_count))
+        self.processes = {}
+        self._last_spawn = {}
+        self._idle = [[] for _ in range(worker_count)]
+        self._lock = threading.Lock()
+        self._telegram_owners = {}      # token_id -> {worker} (worker có BotManager dùng bot token đó)
+        self._telegram_refreshed = 0
+        self._stopping = threading.Event()
+
+    def _spawn(self, worker):
+        ctx = multiprocessing.get_context("spawn")
+        process = ctx.Process(target=_bot_worker_main, args=(self.addresses[worker], self.authkey), daemon=True)
+        process.start()
+        self.processes[worker] = process
+        self._last_spawn[worker] = time.time()
+
+    def ping(self, worker):
+        try:
+            conn = Client(self.addresses[worker], authkey=self.authkey)
+        except (ConnectionRefusedError, FileNotFoundError, OSError):
+            return False
+        try:
+            conn.send({'op': 'ping', 'user_id': None, 'kwargs': {}})
+            return bool(conn.poll(2) and conn.recv().get('ok'))
+        except Exception:
+            return False
+        finally:
+            conn.close()
+
+    def _await_ready(self, worker, on_start, timeout=30):
+        """Chờ worker vừa dựng nhận lệnh rồi gọi on_start(worker) (khôi phục bot của shard)"""
+        deadline = time.time() + timeout
+        while not self._stopping.is_set() and time.time() < deadline:
+            process = self.processes.get(worker)
+            if process is None or not process.is_alive():
+                # Thoát ngay (vd. địa chỉ đang bị tiến trình giám sát khác giữ) → không khôi phục
+                return
+            if self.ping(worker):
+                try:
+                    on_start(worker)
+                except Exception as e:
+                    logger.error(f"❌ Lỗi khôi phục shard của bot worker {worker}: {str(e)}")
+                return
+            time.sleep(0.2)
+        logger.error(f"❌ Bot worker {worker} không sẵn sàng sau {timeout}s")
+
+    def supervise(self, on_start=None, interval=1):
+        """Tiến trình giám sát: dựng mọi worker, dựng lại worker chết; on_start(worker) chạy sau mỗi lần dựng
+
+        Worker dựng lại là tiến trình rỗng → on_start nạp lại bot của shard đó.
+        Chặn tới khi stop() được gọi (vd. từ signal handler), rồi dừng các worker.
+        """
+        logger.info(f"🧩 Giám sát {self.worker_count} bot worker")
+        while not self._stopping.is_set():
+            for worker in range(self.worker_count):
+                process = self.processes.get(worker)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    if time.time() - self._last_spawn.get(worker, 0) <= self.RESPAWN_INTERVAL:
+                        continue
+                    logger.warning(f"⚠️ Bot worker {worker} đã thoát (mã {process.exitcode}), khởi động lại")
+                self._spawn(worker)
+                if on_start is not None:
+                    threading.Thread(target=self._await_ready, args=(worker, on_start),
+                                     name=f"bot-worker-ready-{worker}", daemon=True).start()
+            self._stopping.wait(interval)
+
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=5)
+        self.processes = {}
+
+    def start(self, timeout=0):
+        """Tiến trình web: chỉ gắn vào worker của tiến trình giám sát (chờ tối đa timeout giây), không tự dựng worker"""
+        deadline = time.time() + timeout
+        pending = set(range(self.worker_count))
+        while True:
+            pending = {worker for worker in pending if not self.ping(worker)}
+            if not pending or time.time() >= deadline:
+                break
+            time.sleep(0.5)
+        attached = self.worker_count - len(pending)
+        if attached < self.worker_count:
+            logger.warning(f"⚠️ Mới gắn được {attached}/{self.worker_count} bot worker - "
+                           f"tiến trình giám sát (bot-workers) đã chạy chưa?")
+        else:
+            logger.info(f"🧩 Gắn vào {attached} bot worker")
+
+    def stop(self):
+        """Đóng kết nối của tiến trình này; dừng vòng giám sát nếu đang chạy (worker do nó sở hữu)"""
+        self._stopping.set()
+        with self._lock:
+            for idle in self._idle:
+                for conn in idle:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                idle.clear()
+
+    def worker_for(self, user_id):
+        return self.ring.get_node(user_id)
+
+    def _connect(self, worker, timeout=10):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return Client(self.addresses[worker], authkey=self.authkey)
+            except (ConnectionRefusedError, FileNotFoundError):
+                if time.time() > deadline:
+                    raise
+                # Worker đang được tiến trình giám sát dựng lại → chờ
+                time.sleep(0.2)
+
+    def _request(self, worker, op, user_id=None, timeout=10, **kwargs):
+        with self._lock:
+            conn = self._idle[worker].pop() if self._idle[worker] else None
+        if conn is None:
+            conn = self._connect(worker)
+
+        try:
+            conn.send({'op': op, 'user_id': user_id, 'kwargs': kwargs})
+            if not conn.poll(timeout):
+                raise TimeoutError(f"Worker {worker} không phản hồi lệnh {op} sau {timeout}s")
+            response = conn.recv()
+        except Exception:
+            # Kết nối có thể còn phản hồi trễ → bỏ luôn, không trả về pool
+            conn.close()
+            raise
+
+        with self._lock:
+            self._idle[worker].append(conn)
+
+        if not response.get('ok'):
+            raise RuntimeError(response.get('error', 'Lỗi worker không xác định'))
+        return response.get('result')
+
+    def start_bot(self, user_id, api_key, api_secret, timeout=60, **bot_kwargs):
+        worker = self.worker_for(user_id)
+        result = self._request(worker, 'start', user_id, timeout=timeout,
+                               api_key=api_key, api_secret=api_secret, bot=bot_kwargs)
+        self._refresh_telegram_owners([worker])
+        return result
+
+    def stop_user(self, user_id, deadline=20):
+        return self._request(self.worker_for(user_id), 'stop', user_id, timeout=deadline + 10, deadline=deadline)
+
+    def status(self, user_id, timeout=5):
+        return self._request(self.worker_for(user_id), 'status', user_id, timeout=timeout)
+
+    def _refresh_telegram_owners(self, workers, timeout=2):
+        """Hỏi worker đang nhận những token_id nào (BotManager đăng ký với telegram_router của worker đó)"""
+        for worker in workers:
+            try:
+                token_ids = set(self._request(worker, 'telegram_tokens', timeout=timeout) or [])
+            except Exception as e:
+                logger.debug(f"Không lấy được token Telegram của worker {worker}: {str(e)}")
+                continue
+            with self._lock:
+                for token_id, owners in list(self._telegram_owners.items()):
+                    if token_id not in token_ids:
+                        owners.discard(worker)
+                for token_id in token_ids:
+                    self._telegram_owners.setdefault(token_id, set()).add(worker)
+
+    def _send_telegram_update(self, workers, token_id, update, secret, timeout):
+        accepted = False
+        for worker in workers:
+            try:
+                accepted = self._request(worker, 'telegram_update', timeout=timeout,
+                                         token_id=token_id, update=update, secret=secret) or accepted
+            except Exception as e:
+                logger.error(f"❌ Lỗi chuyển update Telegram tới worker {worker}: {str(e)}")
+        return accepted
+
+    def _route_unknown_telegram_update(self, token_id, update, secret, timeout):
+        # Tiến trình web khác có thể đã khởi động bot → làm mới bản đồ token (có giới hạn tần suất)
+        with self._lock:
+            stale = time.time() - self._telegram_refreshed > self.TELEGRAM_REFRESH_INTERVAL
+            if stale:
+                self._telegram_refreshed = time.time()
+        if stale:
+            self._refresh_telegram_owners(range(self.worker_count))
+        with self._lock:
+            owners = sorted(self._telegram_owners.get(token_id, ()))
+        if owners:
+            self._send_telegram_update(owners, token_id, update, secret, timeout)
+
+    def dispatch_telegram_update(self, token_id, update, secret=None, timeout=5):
+        """Chuyển update webhook tới worker đang nhận bot token đó (thường chỉ 1 worker)
+
+        Token chưa có trong bản đồ → nhận ngay, làm mới bản đồ và chuyển tiếp ở thread nền
+        (không giữ request webhook chờ từng worker).
+        """
+        with self._lock:
+            owners = sorted(self._telegram_owners.get(token_id, ()))
+        if not owners:
+            threading.Thread(target=self._route_unknown_telegram_update,
+                             args=(token_id, update, secret, timeout),
+                             name="telegram-route", daemon=True).start()
+            return True
+        return self._send_telegram_update(owners, token_id, update, secret, timeout)
+
+    def summary(self, user_id, timeout=30):
+        return self._request(self.worker_for(user_id), 'summary', user_id, timeout=timeout)